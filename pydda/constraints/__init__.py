@@ -21,13 +21,26 @@ simply add (name) into the model_fields option of
      make_constraint_from_wrf
      add_hrrr_constraint_to_grid
      make_constraint_from_era_interim
+     add_model_constraint
      download_needed_era_data
+     ERACache
      get_iem_obs
+     IEMTransport
+     IEMFileTransport
+     PointObservations
+     get_interpolation_weights
+     InterpolationWeights
 
 """
 
 from .model_data import make_constraint_from_wrf
 from .model_data import add_hrrr_constraint_to_grid
 from .model_data import make_constraint_from_era_interim
+from .model_data import add_model_constraint
 from .model_data import download_needed_era_data
+from .model_cache import ERACache
 from .station_data import get_iem_obs
+from .station_data import IEMTransport, IEMFileTransport
+from .point_observations import PointObservations
+from .interpolation import get_interpolation_weights
+from .interpolation import InterpolationWeights
@@ -0,0 +1,360 @@
+import numpy as np
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict
+from scipy import sparse
+from scipy.spatial import cKDTree, Delaunay
+
+
+def _nearest_indices(source_points, target_points, rescale=True):
+    """
+    Finds the index of the nearest source point to each target point using
+    a single KD-tree, so that any number of variables on the source points
+    can be interpolated with one query.
+
+    Parameters
+    ----------
+    source_points: tuple of 1D arrays
+        The coordinates of the source points, one array per dimension.
+    target_points: tuple of arrays
+        The coordinates of the target points, one array per dimension.
+        These arrays must all have the same shape.
+    rescale: bool
+        If True, each dimension is scaled to unit range before finding the
+        nearest points, as in scipy.interpolate.NearestNDInterpolator.
+
+    Returns
+    -------
+    indices: array of ints
+        The index of the nearest source point to each target point. This
+        has the same shape as the arrays in target_points.
+    """
+    source = np.stack([np.asarray(p, dtype=float).ravel()
+                       for p in source_points], axis=-1)
+    target_shape = np.shape(target_points[0])
+    target = np.stack([np.asarray(p, dtype=float).ravel()
+                       for p in target_points], axis=-1)
+    if rescale:
+        offset = source.mean(axis=0)
+        scale = np.ptp(source, axis=0)
+        scale[~(scale > 0)] = 1.0
+        source = (source - offset) / scale
+        target = (target - offset) / scale
+
+    tree = cKDTree(source)
+    indices = tree.query(target)[1]
+    return np.reshape(indices, target_shape)
+
+
+class InterpolationWeights(object):
+    """
+    This class holds the interpolation from a set of model points to the
+    points of an analysis grid as a sparse matrix, so that interpolating
+    each variable is a single sparse matrix-vector product. These are
+    created by :func:`pydda.constraints.get_interpolation_weights`.
+
+    Attributes
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        The weight of each source point (columns) at each target point
+        (rows). Target points outside of the source points have no weights
+        and are interpolated to 0.
+    target_shape: tuple
+        The shape of the interpolated arrays.
+    method: str
+        The interpolation method, either 'nearest', 'linear' or
+        'structured'.
+    key: str
+        The key that the weights are cached under.
+    """
+    def __init__(self, matrix, target_shape, method, key=None):
+        self.matrix = matrix
+        self.target_shape = tuple(target_shape)
+        self.method = method
+        self.key = key
+
+    def __call__(self, values):
+        """
+        Interpolates values on the source points to the target points.
+
+        Parameters
+        ----------
+        values: array
+            The values at each of the source points. This must have as many
+            elements as there are source points.
+
+        Returns
+        -------
+        new_values: array
+            The interpolated values in the shape of the target points.
+        """
+        values = np.asarray(np.ma.getdata(values), dtype=float).ravel()
+        return np.reshape(self.matrix.dot(values), self.target_shape)
+
+
+# Weights that have been calculated recently, with the most recently used
+# weights last. The constraints may be built in several threads at once, so
+# the cache is only used while holding _WEIGHT_CACHE_LOCK.
+_WEIGHT_CACHE = OrderedDict()
+_WEIGHT_CACHE_LOCK = threading.Lock()
+_MAX_CACHED_WEIGHTS = 8
+
+
+# Makes a sparse matrix that takes each target point from its nearest
+# source point
+def _nearest_weights(source_points, target_points):
+    nearest = _nearest_indices(source_points, target_points).ravel()
+    num_source = np.size(source_points[0])
+    return sparse.csr_matrix(
+        (np.ones(len(nearest)), (np.arange(len(nearest)), nearest)),
+        shape=(len(nearest), num_source))
+
+
+# Makes a sparse matrix that linearly interpolates from the source points
+# using a Delaunay triangulation, as in scipy.interpolate.griddata
+def _linear_weights(source_points, target_points):
+    source = np.stack([np.asarray(p, dtype=float).ravel()
+                       for p in source_points], axis=-1)
+    target = np.stack([np.asarray(p, dtype=float).ravel()
+                       for p in target_points], axis=-1)
+    ndim = source.shape[1]
+    triangulation = Delaunay(source)
+    simplex = triangulation.find_simplex(target)
+    inside = np.where(simplex >= 0)[0]
+    simplex = simplex[inside]
+    transform = triangulation.transform[simplex]
+    bary = np.einsum('ijk,ik->ij', transform[:, :ndim],
+                     target[inside] - transform[:, ndim])
+    bary = np.concatenate([bary, 1 - bary.sum(axis=1, keepdims=True)],
+                          axis=1)
+    rows = np.repeat(inside, ndim + 1)
+    cols = triangulation.simplices[simplex].ravel()
+    return sparse.csr_matrix((bary.ravel(), (rows, cols)),
+                             shape=(len(target), len(source)))
+
+
+# Makes a sparse matrix that interpolates from a model grid that is regular
+# in x and y but has a different height profile in each column, such as
+# WRF. Each target point is bilinearly interpolated from the four columns
+# around it, after interpolating linearly in height within each column.
+# Columns that do not span the target's height are left out and the other
+# weights are renormalized. Points outside of the model grid get no weights.
+def _structured_weights(z, y, x, target_points, chunk_size=100000):
+    nz, ny, nx = z.shape
+    tz, ty, tx = [np.asarray(p, dtype=float).ravel() for p in target_points]
+    z = np.asarray(z, dtype=float)
+    rows = []
+    cols = []
+    vals = []
+    for start in range(0, len(tz), chunk_size):
+        end = min(start + chunk_size, len(tz))
+        cz, cy, cx = tz[start:end], ty[start:end], tx[start:end]
+        ix = np.clip(np.searchsorted(x, cx) - 1, 0, nx - 2)
+        iy = np.clip(np.searchsorted(y, cy) - 1, 0, ny - 2)
+        fx = (cx - x[ix]) / (x[ix + 1] - x[ix])
+        fy = (cy - y[iy]) / (y[iy + 1] - y[iy])
+        inside = np.logical_and.reduce(
+            (cx >= x[0], cx <= x[-1], cy >= y[0], cy <= y[-1]))
+        for dj, di in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            j = iy + dj
+            i = ix + di
+            horizontal = (np.where(dj, fy, 1 - fy) *
+                          np.where(di, fx, 1 - fx))
+            # Find the level below each target point in this column
+            k = np.full(len(cz), -1)
+            for level in range(nz):
+                k += z[level, j, i] <= cz
+            valid = np.logical_and(inside, k >= 0)
+            at_top = np.logical_and(valid, k >= nz - 1)
+            valid = np.logical_and(valid, np.logical_or(
+                k < nz - 1, z[nz - 1, j, i] == cz))
+            k = np.clip(k, 0, nz - 2)
+            z_below = z[k, j, i]
+            z_above = z[k + 1, j, i]
+            fz = np.where(at_top, 1.,
+                          (cz - z_below) / np.where(z_above > z_below,
+                                                    z_above - z_below, 1.))
+            row = np.arange(start, end)[valid]
+            base = (j * nx + i)[valid]
+            rows += [row, row]
+            cols += [k[valid] * ny * nx + base,
+                     (k[valid] + 1) * ny * nx + base]
+            vals += [horizontal[valid] * (1 - fz[valid]),
+                     horizontal[valid] * fz[valid]]
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(tz), z.size))
+    row_sums = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.where(row_sums > 0, 1. / np.where(row_sums > 0, row_sums, 1.),
+                     0.)
+    return sparse.diags(scale).dot(matrix).tocsr()
+
+
+# Makes a key from the coordinates of the source and target points. With
+# height_tolerance, the heights (the first coordinate of the source points)
+# are rounded to that many meters so that small changes in the model heights
+# give the same key.
+def _get_weights_key(source_points, target_points, method,
+                     height_tolerance=None):
+    the_hash = hashlib.sha1(method.encode())
+    for i, coords in enumerate(source_points):
+        coords = np.asarray(coords, dtype=float).ravel()
+        if i == 0 and height_tolerance is not None:
+            coords = np.round(coords / height_tolerance)
+        the_hash.update(np.ascontiguousarray(coords).tobytes())
+    the_hash.update(b'target')
+    for coords in target_points:
+        the_hash.update(str(np.shape(coords)).encode())
+        the_hash.update(np.ascontiguousarray(
+            np.asarray(coords, dtype=float)).tobytes())
+    return the_hash.hexdigest()
+
+
+# Saves the weights to file_name. The weights are written to a temporary
+# file first so that other processes never read a partly written file.
+def _save_weights(weights, file_name):
+    matrix = weights.matrix
+    temp_name = file_name + '.%d.%d.tmp' % (os.getpid(),
+                                            threading.get_ident())
+    with open(temp_name, 'wb') as the_file:
+        np.savez(the_file, data=matrix.data, indices=matrix.indices,
+                 indptr=matrix.indptr, shape=matrix.shape,
+                 target_shape=weights.target_shape, method=weights.method)
+    os.replace(temp_name, file_name)
+
+
+def _load_weights(file_name, key):
+    with np.load(file_name) as the_file:
+        matrix = sparse.csr_matrix(
+            (the_file['data'], the_file['indices'], the_file['indptr']),
+            shape=tuple(the_file['shape']))
+        return InterpolationWeights(
+            matrix, tuple(the_file['target_shape']), str(the_file['method']),
+            key)
+
+
+def get_interpolation_weights(source_points, target_points, method='nearest',
+                              cache_dir=None, height_tolerance=None):
+    """
+    Gets the interpolation from model points to analysis grid points as a
+    sparse weight matrix. The weights are cached in memory by the
+    coordinates of the source and target points, and optionally on disk,
+    so that each new time of a model whose grid does not move only needs
+    one sparse matrix-vector product per variable.
+
+    Parameters
+    ----------
+    source_points: tuple of arrays
+        The coordinates of the model points, one array per dimension.
+        The first coordinate is taken to be height.
+    target_points: tuple of arrays
+        The coordinates of the analysis grid points, one array per dimension.
+    method: str
+        'nearest' for nearest neighbor interpolation (with each coordinate
+        scaled to unit range) or 'linear' for linear interpolation on a
+        Delaunay triangulation of the model points. Points outside of the
+        model points are set to 0 with 'linear'.
+    cache_dir: str or None
+        If this is not None, the weights are also saved in and loaded from
+        this directory, so they can be reused between Python sessions.
+    height_tolerance: float or None
+        Model heights vary slightly with time. If this is set, model heights
+        that are within about this many meters of the heights that the
+        cached weights were calculated with reuse those weights. Set to None
+        to only reuse the weights for identical coordinates.
+
+    Returns
+    -------
+    weights: InterpolationWeights
+        The interpolation weights. Call weights(values) to interpolate
+        values on the model points to the analysis grid.
+    """
+    if method not in ['nearest', 'linear']:
+        raise ValueError("method must be 'nearest' or 'linear'!")
+
+    key = _get_weights_key(source_points, target_points, method,
+                           height_tolerance)
+    if method == 'nearest':
+        make_matrix = _nearest_weights
+    else:
+        make_matrix = _linear_weights
+    return _get_cached_weights(
+        key, lambda: make_matrix(source_points, target_points),
+        np.shape(target_points[0]), method, cache_dir)
+
+
+def get_structured_interpolation_weights(z, y, x, target_points,
+                                         cache_dir=None,
+                                         height_tolerance=None):
+    """
+    Gets the interpolation from a model grid that is regular in the
+    horizontal but whose heights vary in each column, such as WRF, to
+    analysis grid points as a sparse weight matrix. Each analysis grid
+    point is interpolated linearly in height within each of the four model
+    columns around it, and then bilinearly between the columns. This only
+    needs memory for the weights, unlike a triangulation of the model
+    points. The weights are cached like in
+    :py:func:`pydda.constraints.get_interpolation_weights`.
+
+    Parameters
+    ----------
+    z: 3D array
+        The height of each model point in the shape (nz, ny, nx). The
+        heights must increase with the first index.
+    y: 1D array
+        The increasing y coordinates of the model columns.
+    x: 1D array
+        The increasing x coordinates of the model columns.
+    target_points: tuple of arrays
+        The (z, y, x) coordinates of the analysis grid points.
+    cache_dir: str or None
+        If this is not None, the weights are also saved in and loaded from
+        this directory.
+    height_tolerance: float or None
+        Reuse cached weights calculated with model heights within about
+        this many meters of z.
+
+    Returns
+    -------
+    weights: InterpolationWeights
+        The interpolation weights. Points outside of the model grid are
+        interpolated to 0.
+    """
+    key = _get_weights_key((z, y, x), target_points, 'structured',
+                           height_tolerance)
+    return _get_cached_weights(
+        key, lambda: _structured_weights(z, y, x, target_points),
+        np.shape(target_points[0]), 'structured', cache_dir)
+
+
+# Gets the weights under key from memory or cache_dir, or calculates them
+# with make_matrix and caches them. The lock is not held while the weights
+# are read or calculated, so two threads may both calculate the same
+# weights, but the cache is never changed by two threads at once.
+def _get_cached_weights(key, make_matrix, target_shape, method, cache_dir):
+    with _WEIGHT_CACHE_LOCK:
+        if key in _WEIGHT_CACHE:
+            _WEIGHT_CACHE.move_to_end(key)
+            return _WEIGHT_CACHE[key]
+
+    weights = None
+    if cache_dir is not None:
+        file_name = os.path.join(cache_dir, key + '.npz')
+        if os.path.isfile(file_name):
+            weights = _load_weights(file_name, key)
+
+    if weights is None:
+        weights = InterpolationWeights(make_matrix(), target_shape, method,
+                                       key)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            _save_weights(weights, file_name)
+
+    with _WEIGHT_CACHE_LOCK:
+        _WEIGHT_CACHE[key] = weights
+        while len(_WEIGHT_CACHE) > _MAX_CACHED_WEIGHTS:
+            _WEIGHT_CACHE.popitem(last=False)
+    return weights
@@ -0,0 +1,353 @@
+import numpy as np
+import hashlib
+import json
+import os
+import logging
+import shutil
+import socket
+import threading
+import time
+
+from datetime import datetime, timedelta
+from netCDF4 import Dataset
+
+logger = logging.getLogger(__name__)
+
+# We really only need the API to download the data, make ECMWF API an
+# optional dependency since not everyone will have a login from the start.
+try:
+    from ecmwfapi import ECMWFDataServer
+    ECMWF_AVAILABLE = True
+except:
+    ECMWF_AVAILABLE = False
+
+# psutil is used to check whether the process holding a lock is still
+# running, which os.kill cannot do safely on Windows.
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# The keys of an ECMWF request that a cached file has to match exactly
+_EXACT_KEYS = ['dataset', 'class', 'stream', 'levtype', 'param', 'grid',
+               'step', 'format']
+
+
+def _describe_request(retrieve_dict):
+    """
+    Turns an ECMWF request into a description that can be compared with
+    the descriptions of the cached files. The levels, dates, times and area
+    are parsed so that a cached file that covers more than the request can
+    be used.
+    """
+    description = {key: str(retrieve_dict.get(key, ''))
+                   for key in _EXACT_KEYS}
+    description['levels'] = sorted(
+        float(level) for level in retrieve_dict['levelist'].split('/'))
+    description['times'] = sorted(
+        int(the_time) for the_time in
+        str(retrieve_dict.get('time', '00')).split('/'))
+
+    dates = retrieve_dict['date'].split('/')
+    if len(dates) == 3 and dates[1] == 'to':
+        start_date = datetime.strptime(dates[0], "%Y-%m-%d")
+        end_date = datetime.strptime(dates[2], "%Y-%m-%d")
+        dates = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d")
+                 for i in range((end_date - start_date).days + 1)]
+    description['dates'] = sorted(dates)
+    description['area'] = [float(x) for x in retrieve_dict['area'].split('/')]
+    return description
+
+
+def _covers(cached, wanted):
+    """
+    Returns True if the cached file with the description cached has all of
+    the data asked for by the description wanted.
+    """
+    for key in _EXACT_KEYS:
+        if cached[key] != wanted[key]:
+            return False
+    for key in ['levels', 'times', 'dates']:
+        if not set(wanted[key]).issubset(cached[key]):
+            return False
+    north, west, south, east = cached['area']
+    wanted_north, wanted_west, wanted_south, wanted_east = wanted['area']
+    return (north >= wanted_north and south <= wanted_south and
+            west <= wanted_west and east >= wanted_east)
+
+
+def _download_era(retrieve_dict, file_name):
+    if ECMWF_AVAILABLE is False:
+        raise ModuleNotFoundError(
+            "The ECMWF API is not installed. Go to" +
+            "https://confluence.ecmwf.int/display/WEBAPI" +
+            "/Access+ECMWF+Public+Datasets" +
+            " in order to use the auto download feature.")
+    retrieve_dict = dict(retrieve_dict)
+    retrieve_dict['target'] = file_name
+    server = ECMWFDataServer()
+    server.retrieve(retrieve_dict)
+
+
+class ERACache(object):
+    """
+    This class keeps the ERA Interim files downloaded by PyDDA in a
+    directory so that they are only downloaded once. Each file is stored
+    under a hash of its request, along with a description of the levels,
+    dates, times and area that it holds. A request is served from any
+    cached file that covers it, so a file downloaded with
+    :func:`pydda.constraints.download_needed_era_data` for a whole event
+    is reused for every grid in the event. When several threads or
+    processes ask for the same data at once, only one downloads it and
+    the rest wait for that download. The lock of a download records the
+    host and process that holds it and is touched while the download runs,
+    so a download that is waiting in the ECMWF queue is not started again.
+
+    Parameters
+    ----------
+    cache_dir: str
+        The directory to keep the files in. This is created if it does
+        not exist.
+    download: function or None
+        The function that downloads a request. It is called as
+        download(retrieve_dict, file_name) and has to write the data to
+        file_name. Set to None to use the ECMWF API.
+    lock_timeout: float
+        The time in seconds after which a lock that has not been touched is
+        assumed to belong to a download that failed, so another one can be
+        started. The lock is touched every quarter of this while the
+        download runs. A lock held by a process on this host that is no
+        longer running is taken over right away.
+    poll_interval: float
+        The time in seconds between checks for a download by another
+        thread or process to finish.
+    """
+    def __init__(self, cache_dir, download=None, lock_timeout=3600.,
+                 poll_interval=1.):
+        self.cache_dir = cache_dir
+        if download is None:
+            download = _download_era
+        self.download = download
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def find(self, retrieve_dict):
+        """
+        Returns the name of a cached file that has all of the data asked
+        for by the ECMWF request retrieve_dict, or None if there is none.
+        """
+        wanted = _describe_request(retrieve_dict)
+        file_name = self._get_file_name(wanted)
+        if os.path.isfile(file_name):
+            return file_name
+
+        for name in sorted(os.listdir(self.cache_dir)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.cache_dir, name), 'r') as the_file:
+                cached = json.load(the_file)
+            file_name = os.path.join(self.cache_dir, name[:-5] + '.nc')
+            if _covers(cached, wanted) and os.path.isfile(file_name):
+                return file_name
+        return None
+
+    def get(self, retrieve_dict):
+        """
+        Returns the name of a cached file that has all of the data asked for
+        by the ECMWF request retrieve_dict, downloading it if needed.
+        """
+        description = _describe_request(retrieve_dict)
+        file_name = self._get_file_name(description)
+        lock_name = file_name + '.lock'
+        while True:
+            cached_file = self.find(retrieve_dict)
+            if cached_file is not None:
+                return cached_file
+            if self._acquire(lock_name):
+                break
+            time.sleep(self.poll_interval)
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._refresh,
+                                     args=(lock_name, stop), daemon=True)
+        heartbeat.start()
+        try:
+            # Another process may have finished the download while we
+            # were getting the lock
+            cached_file = self.find(retrieve_dict)
+            if cached_file is not None:
+                return cached_file
+
+            logger.info("Downloading ERA Interim data")
+            temp_name = file_name + '.%d.tmp' % os.getpid()
+            try:
+                self.download(retrieve_dict, temp_name)
+                self._save_description(file_name, description)
+                os.replace(temp_name, file_name)
+            finally:
+                if os.path.isfile(temp_name):
+                    os.remove(temp_name)
+            return file_name
+        finally:
+            stop.set()
+            heartbeat.join()
+            os.remove(lock_name)
+
+    def add(self, file_name, retrieve_dict=None):
+        """
+        Copies an ERA Interim file that was downloaded elsewhere into the
+        cache so that it is used instead of downloading the data.
+
+        Parameters
+        ----------
+        file_name: str
+            The ERA Interim NetCDF file to add.
+        retrieve_dict: dict or None
+            The ECMWF request that the file was downloaded with. Set to None
+            to work out the levels, dates, times and area from the file and
+            use the request that PyDDA makes for everything else.
+
+        Returns
+        -------
+        cached_file: str
+            The name of the file in the cache.
+        """
+        if retrieve_dict is None:
+            retrieve_dict = _get_file_request(file_name)
+        description = _describe_request(retrieve_dict)
+        cached_file = self._get_file_name(description)
+        temp_name = cached_file + '.%d.tmp' % os.getpid()
+        shutil.copyfile(file_name, temp_name)
+        self._save_description(cached_file, description)
+        os.replace(temp_name, cached_file)
+        return cached_file
+
+    def _get_file_name(self, description):
+        key = hashlib.sha1(json.dumps(
+            description, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.nc')
+
+    def _save_description(self, file_name, description):
+        description_name = file_name[:-3] + '.json'
+        temp_name = description_name + '.%d.tmp' % os.getpid()
+        with open(temp_name, 'w') as the_file:
+            json.dump(description, the_file)
+        os.replace(temp_name, description_name)
+
+    def _acquire(self, lock_name):
+        try:
+            lock_file = os.open(lock_name,
+                                os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Break the lock of a download that never finished
+            try:
+                if self._is_stale(lock_name):
+                    os.remove(lock_name)
+            except OSError:
+                pass
+            return False
+
+        with os.fdopen(lock_file, 'w') as the_file:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid()},
+                      the_file)
+        return True
+
+    def _is_stale(self, lock_name):
+        age = time.time() - os.path.getmtime(lock_name)
+        try:
+            with open(lock_name, 'r') as the_file:
+                holder = json.load(the_file)
+        except ValueError:
+            # The holder has not written to the lock yet
+            holder = None
+        if (holder is not None and holder['host'] == socket.gethostname()
+                and not _pid_exists(holder['pid'])):
+            return True
+        return age > self.lock_timeout
+
+    def _refresh(self, lock_name, stop):
+        # Touch the lock until stop is set so that it does not go stale
+        while not stop.wait(self.lock_timeout / 4.):
+            try:
+                os.utime(lock_name, None)
+            except OSError:
+                pass
+
+
+# Checks whether the process pid is running on this host. If that cannot be
+# found out, it is assumed to be running.
+def _pid_exists(pid):
+    if PSUTIL_AVAILABLE:
+        return psutil.pid_exists(pid)
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _make_era_request(Grid, date, times=None, step='0'):
+    """
+    Makes the ECMWF request for the ERA Interim winds and geopotential that
+    PyDDA uses over the area of a Grid. date and times are in the ECMWF
+    format, such as "2006-01-20/to/2006-01-25" and "00/06/12/18". Set times
+    to None to leave it out of the request.
+    """
+    # ERA interim data is in pressure coordinates
+    # Retrieve u, v, w, and geopotential
+    # Geopotential is needed to convert into height coordinates
+    retrieve_dict = {}
+    retrieve_dict['stream'] = "oper"
+    retrieve_dict['levtype'] = "pl"
+    retrieve_dict['param'] = "131.128/132.128/135.128/129.128"
+    retrieve_dict['dataset'] = "interim"
+    retrieve_dict['levelist'] = ("1/2/3/5/7/10/20/30/50/70/100/125/150/" +
+                                 "175/200/225/250/300/350/400/450/500/" +
+                                 "550/600/650/700/750/775/800/825/850/" +
+                                 "875/900/925/950/975/1000")
+    retrieve_dict['step'] = step
+    if times is not None:
+        retrieve_dict['time'] = times
+    retrieve_dict['date'] = date
+    retrieve_dict['class'] = "ei"
+    retrieve_dict['grid'] = "0.75/0.75"
+    N = "%4.1f" % Grid.point_latitude["data"].max()
+    S = "%4.1f" % Grid.point_latitude["data"].min()
+    E = "%4.1f" % Grid.point_longitude["data"].max()
+    W = "%4.1f" % Grid.point_longitude["data"].min()
+
+    retrieve_dict['area'] = N + "/" + W + "/" + S + "/" + E
+    retrieve_dict['format'] = "netcdf"
+    return retrieve_dict
+
+
+# Works out the request that an ERA Interim file was downloaded with
+def _get_file_request(file_name):
+    with Dataset(file_name, mode='r') as ERA_grid:
+        base_time = datetime.strptime(ERA_grid.variables["time"].units,
+                                      "hours since %Y-%m-%d %H:%M:%S.%f")
+        era_times = [base_time + timedelta(hours=float(x))
+                     for x in ERA_grid.variables["time"][:]]
+        lat = ERA_grid.variables["latitude"][:]
+        lon = ERA_grid.variables["longitude"][:]
+        levels = ERA_grid.variables["level"][:]
+
+    retrieve_dict = {
+        'stream': "oper", 'levtype': "pl",
+        'param': "131.128/132.128/135.128/129.128", 'dataset': "interim",
+        'step': "0", 'class': "ei", 'grid': "0.75/0.75", 'format': "netcdf"}
+    retrieve_dict['levelist'] = "/".join("%g" % level for level in levels)
+    retrieve_dict['date'] = "/".join(sorted(set(
+        the_time.strftime("%Y-%m-%d") for the_time in era_times)))
+    retrieve_dict['time'] = "/".join(sorted(set(
+        "%02d" % the_time.hour for the_time in era_times)))
+    lon = np.where(lon > 180, lon - 360, lon)
+    retrieve_dict['area'] = "%f/%f/%f/%f" % (lat.max(), lon.min(),
+                                             lat.min(), lon.max())
+    return retrieve_dict
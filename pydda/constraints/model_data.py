@@ -3,6 +3,8 @@ import pyart
 import gc
 import tempfile
 import os
+import logging
+import shutil
 
 # We want cfgrib to be an optional dependency to ensure Windows compatibility
 try:
@@ -19,13 +21,25 @@ try:
 except:
     ECMWF_AVAILABLE = False
 
+# xarray is only needed to read models with add_model_constraint
+try:
+    import xarray as xr
+    XARRAY_AVAILABLE = True
+except ImportError:
+    XARRAY_AVAILABLE = False
+
 from netCDF4 import Dataset
 from datetime import datetime, timedelta
-from scipy.interpolate import griddata, NearestNDInterpolator
 from copy import deepcopy
+from .interpolation import get_interpolation_weights
+from .interpolation import get_structured_interpolation_weights
+from .model_cache import ERACache, _make_era_request
+
+logger = logging.getLogger(__name__)
 
 
-def download_needed_era_data(Grid, start_date, end_date, file_name):
+def download_needed_era_data(Grid, start_date, end_date, file_name=None,
+                             era_cache_dir=None):
     """
     This function will download the ERA interim data in the region
     specified by the input Py-ART Grid within the interval specified by
@@ -48,50 +62,47 @@ def download_needed_era_data(Grid, start_date, end_date, file_name):
         The start date of the file to download.
     end_date: datetime
         The end date of the file to download.
-    file_name:
-        The name of the destination file.
-    """
+    file_name: str or None
+        The name of the destination file. This can be None if
+        era_cache_dir is set.
+    era_cache_dir: str or None
+        The directory of an :class:`pydda.constraints.ERACache` to download
+        the data into. The data is not downloaded again if the cache
+        already has it, and the ERA Interim functions with the same
+        era_cache_dir will use it for any grid in the area and time period.
 
-    if ECMWF_AVAILABLE is False and file_name is None:
-        raise (ModuleNotFoundError,
-               ("The ECMWF API is not installed. Go to" +
-                "https://confluence.ecmwf.int/display/WEBAPI" +
-                "/Access+ECMWF+Public+Datasets" +
-                " in order to use the auto download feature."))
-
-    print("Download ERA Interim data...")
-    # ERA interim data is in pressure coordinates
-    # Retrieve u, v, w, and geopotential
-    # Geopotential is needed to convert into height coordinates
-
-    retrieve_dict = {}
-    retrieve_dict['stream'] = "oper"
-    retrieve_dict['levtype'] = "pl"
-    retrieve_dict['param'] = "131.128/132.128/135.128/129.128"
-    retrieve_dict['dataset'] = "interim"
-    retrieve_dict['levelist'] = ("1/2/3/5/7/10/20/30/50/70/100/125/150/" +
-                                 "175/200/225/250/300/350/400/450/500/" +
-                                 "550/600/650/700/750/775/800/825/850/" +
-                                 "875/900/925/950/975/1000")
-    retrieve_dict['step'] = "0"
-    retrieve_dict['time'] = "00/06/12/18"
-    retrieve_dict['date'] = (start_date.strftime("%Y-%m-%d") + '/to/' +
-                             end_date.strftime("%Y-%m-%d"))
-    retrieve_dict['class'] = "ei"
-    retrieve_dict['grid'] = "0.75/0.75"
-    N = "%4.1f" % Grid.point_latitude["data"].max()
-    S = "%4.1f" % Grid.point_latitude["data"].min()
-    E = "%4.1f" % Grid.point_longitude["data"].max()
-    W = "%4.1f" % Grid.point_longitude["data"].min()
-
-    retrieve_dict['area'] = N + "/" + W + "/" + S + "/" + E
-    retrieve_dict['format'] = "netcdf"
+    Returns
+    -------
+    file_name: str
+        The name of the file with the data.
+    """
+    retrieve_dict = _make_era_request(
+        Grid, (start_date.strftime("%Y-%m-%d") + '/to/' +
+               end_date.strftime("%Y-%m-%d")), "00/06/12/18")
+    if era_cache_dir is not None:
+        cached_file = ERACache(era_cache_dir).get(retrieve_dict)
+        if file_name is None:
+            return cached_file
+        shutil.copyfile(cached_file, file_name)
+        return file_name
+
+    if ECMWF_AVAILABLE is False:
+        raise ModuleNotFoundError(
+            "The ECMWF API is not installed. Go to" +
+            "https://confluence.ecmwf.int/display/WEBAPI" +
+            "/Access+ECMWF+Public+Datasets" +
+            " in order to use the auto download feature.")
+
+    logger.info("Downloading ERA Interim data")
     retrieve_dict['target'] = file_name
     server = ECMWFDataServer()
     server.retrieve(retrieve_dict)
+    return file_name
 
 
-def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
+def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None,
+                                     cache_dir=None, height_tolerance=None,
+                                     era_cache_dir=None):
     """
     This function will read ERA Interim in NetCDF format and add it 
     to the Py-ART grid specified by Grid. PyDDA will automatically download
@@ -125,6 +136,20 @@ def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
     vel_field: str or None
         The name of the velocity field in the Py-ART grid. Set to None to
         have Py-DDA attempt to automatically detect it.
+    cache_dir: str or None
+        The directory to save the interpolation weights from the ERA grid
+        to the analysis grid in so they can be reused. The weights are
+        always cached in memory. See
+        :py:func:`pydda.constraints.get_interpolation_weights`.
+    height_tolerance: float or None
+        Reuse the cached weights when the ERA heights are within about this
+        many meters of the heights the weights were calculated with.
+    era_cache_dir: str or None
+        The directory of an :class:`pydda.constraints.ERACache` to keep the
+        downloaded ERA Interim data in. Data that is already in the cache,
+        including files downloaded for a longer period or a larger area, is
+        not downloaded again. Set to None to download the data into a
+        temporary file. This is not used if file_name is specified.
 
     Returns
     -------
@@ -136,12 +161,13 @@ def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
     if vel_field is None:
         vel_field = pyart.config.get_field_name('corrected_velocity')
 
-    if ECMWF_AVAILABLE is False and file_name is None:
-        raise (ModuleNotFoundError,
-               ("The ECMWF API is not installed. Go to" +
-                "https://confluence.ecmwf.int/display/WEBAPI" +
-                "/Access+ECMWF+Public+Datasets" +
-                " in order to use the auto download feature."))
+    if (ECMWF_AVAILABLE is False and file_name is None and
+            era_cache_dir is None):
+        raise ModuleNotFoundError(
+            "The ECMWF API is not installed. Go to" +
+            "https://confluence.ecmwf.int/display/WEBAPI" +
+            "/Access+ECMWF+Public+Datasets" +
+            " in order to use the auto download feature.")
 
     grid_time = datetime.strptime(Grid.time["units"],
                                   "seconds since %Y-%m-%dT%H:%M:%SZ")
@@ -163,83 +189,48 @@ def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
             raise FileNotFoundError(file_name + " not found!")
 
     if file_name is None:
-        print("Download ERA Interim data...")
-        # ERA interim data is in pressure coordinates
-        # Retrieve u, v, w, and geopotential
-        # Geopotential is needed to convert into height coordinates
-
-        retrieve_dict = {}
-        retrieve_dict['stream'] = "oper"
-        retrieve_dict['levtype'] = "pl"
-        retrieve_dict['param'] = "131.128/132.128/135.128/129.128"
-        retrieve_dict['dataset'] = "interim"
-        retrieve_dict['levelist'] = ("1/2/3/5/7/10/20/30/50/70/100/125/150/" +
-                                     "175/200/225/250/300/350/400/450/500/" +
-                                     "550/600/650/700/750/775/800/825/850/" +
-                                     "875/900/925/950/975/1000")
-        retrieve_dict['step'] = "0"
-        retrieve_dict['time'] = "%02d" % hour_rounded_to_nearest_6
-        retrieve_dict['date'] = grid_time.strftime("%Y-%m-%d")
-        retrieve_dict['class'] = "ei"
-        retrieve_dict['grid'] = "0.75/0.75"
-        N = "%4.1f" % Grid.point_latitude["data"].max()
-        S = "%4.1f" % Grid.point_latitude["data"].min()
-        E = "%4.1f" % Grid.point_longitude["data"].max()
-        W = "%4.1f" % Grid.point_longitude["data"].min()
-
-        retrieve_dict['area'] = N + "/" + W + "/" + S + "/" + E
-        retrieve_dict['format'] = "netcdf"
-        tfile = tempfile.NamedTemporaryFile()
-        retrieve_dict['target'] = tfile.name
-        file_name = tfile.name
-        server = ECMWFDataServer()
-        server.retrieve(retrieve_dict)
-        time_step = 0
+        retrieve_dict = _make_era_request(
+            Grid, grid_time.strftime("%Y-%m-%d"), "%02d" % grid_time.hour)
+        if era_cache_dir is not None:
+            file_name = ERACache(era_cache_dir).get(retrieve_dict)
+        else:
+            logger.info("Downloading ERA Interim data")
+            tfile = tempfile.NamedTemporaryFile()
+            retrieve_dict['target'] = tfile.name
+            file_name = tfile.name
+            server = ECMWFDataServer()
+            server.retrieve(retrieve_dict)
 
     ERA_grid = Dataset(file_name, mode='r')
-    base_time = datetime.strptime(ERA_grid.variables["time"].units,
-                                  "hours since %Y-%m-%d %H:%M:%S.%f")
-    time_seconds = ERA_grid.variables["time"][:]
-    our_time = np.array([base_time + timedelta(seconds=int(x)) for x in time_seconds])
-    time_step = np.argmin(np.abs(base_time - grid_time))
+    height_ERA, u_ERA, v_ERA, w_ERA, lat_ERA, lon_ERA = _read_era_window(
+        ERA_grid, Grid, grid_time)
 
     analysis_grid_shape = Grid.fields[vel_field]['data'].shape
 
-    height_ERA = ERA_grid.variables["z"][:]
-    u_ERA = ERA_grid.variables["u"][:]
-    v_ERA = ERA_grid.variables["v"][:]
-    w_ERA = ERA_grid.variables["w"][:]
-    lon_ERA = ERA_grid.variables["longitude"][:]
-    lat_ERA = ERA_grid.variables["latitude"][:]
     radar_grid_lat = Grid.point_latitude['data']
     radar_grid_lon = Grid.point_longitude['data']
     radar_grid_alt = Grid.point_z['data']
-    u_flattened = u_ERA[time_step].flatten()
-    v_flattened = v_ERA[time_step].flatten()
-    w_flattened = w_ERA[time_step].flatten()
+    u_flattened = u_ERA.flatten()
+    v_flattened = v_ERA.flatten()
+    w_flattened = w_ERA.flatten()
 
     the_shape = u_ERA.shape
     lon_mgrid, lat_mgrid = np.meshgrid(lon_ERA, lat_ERA)
 
-    lon_mgrid = np.tile(lon_mgrid, (the_shape[1], 1, 1))
-    lat_mgrid = np.tile(lat_mgrid, (the_shape[1], 1, 1))
+    lon_mgrid = np.tile(lon_mgrid, (the_shape[0], 1, 1))
+    lat_mgrid = np.tile(lat_mgrid, (the_shape[0], 1, 1))
     lon_flattened = lon_mgrid.flatten()
     lat_flattened = lat_mgrid.flatten()
-    height_flattened = height_ERA[time_step].flatten()
+    height_flattened = height_ERA.flatten()
     height_flattened -= Grid.radar_altitude["data"]
 
-    u_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        u_flattened, rescale=True)
-    v_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        v_flattened, rescale=True)
-    w_interp = NearestNDInterpolator(
+    weights = get_interpolation_weights(
         (height_flattened, lat_flattened, lon_flattened),
-        w_flattened, rescale=True)
-    u_new = u_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    v_new = v_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    w_new = w_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+        (radar_grid_alt, radar_grid_lat, radar_grid_lon), 'nearest',
+        cache_dir, height_tolerance)
+    u_new = weights(u_flattened)
+    v_new = weights(v_flattened)
+    w_new = weights(w_flattened)
 
     new_grid = deepcopy(Grid)
 
@@ -262,7 +253,8 @@ def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
 
 
 def make_constraint_from_wrf(Grid, file_path, wrf_time,
-                             radar_loc, vel_field=None):
+                             radar_loc, vel_field=None, cache_dir=None,
+                             height_tolerance=None):
     """
     This function makes an initalization field based off of the u and w
     from a WRF run in netCDF format.
@@ -285,6 +277,14 @@ def make_constraint_from_wrf(Grid, file_path, wrf_time,
     vel_field: str, or None
         This string contains the name of the velocity field in the
         Grid. None will try to automatically detect this value.
+    cache_dir: str or None
+        The directory to save the interpolation weights from the WRF grid
+        to the analysis grid in so they can be reused. The weights are
+        always cached in memory. See
+        :py:func:`pydda.constraints.get_interpolation_weights`.
+    height_tolerance: float or None
+        Reuse the cached weights when the WRF heights are within about this
+        many meters of the heights the weights were calculated with.
 
     Returns
     -------
@@ -304,12 +304,6 @@ def make_constraint_from_wrf(Grid, file_path, wrf_time,
 
     # Load WRF grid
     wrf_cdf = Dataset(file_path, mode='r')
-    W_wrf = wrf_cdf.variables['W'][:]
-    V_wrf = wrf_cdf.variables['V'][:]
-    U_wrf = wrf_cdf.variables['U'][:]
-    PH_wrf = wrf_cdf.variables['PH'][:]
-    PHB_wrf = wrf_cdf.variables['PHB'][:]
-    alt_wrf = (PH_wrf+PHB_wrf)/9.81
 
     new_grid_x = Grid.point_x['data']
     new_grid_y = Grid.point_y['data']
@@ -328,33 +322,10 @@ def make_constraint_from_wrf(Grid, file_path, wrf_time,
     if(len(timestep[0]) == 0):
         raise ValueError(("Time " + str(wrf_time) + " not found in WRF file!"))
 
-    x_len = wrf_cdf.__getattribute__('WEST-EAST_GRID_DIMENSION')
-    y_len = wrf_cdf.__getattribute__('SOUTH-NORTH_GRID_DIMENSION')
-    dx = wrf_cdf.DX
-    dy = wrf_cdf.DY
-    x = np.arange(0, x_len)*dx-radar_loc[0]*1e3
-    y = np.arange(0, y_len)*dy-radar_loc[1]*1e3
-    z = np.mean(alt_wrf[timestep[0], :, :, :], axis=(0, 2, 3))
-    x, y, z = np.meshgrid(x, y, z)
-    z = np.squeeze(alt_wrf[timestep[0], :, :, :])
-
-    z_stag = (z[1:, :, :]+z[:-1, :, :])/2.0
-    x_stag = (x[:, :, 1:]+x[:, :, :-1])/2.0
-    y_stag = (y[:, 1:, :]+y[:, :-1, :])/2.0
-
-    W_wrf = np.squeeze(W_wrf[timestep[0], :, :, :])
-    V_wrf = np.squeeze(V_wrf[timestep[0], :, :, :])
-    U_wrf = np.squeeze(U_wrf[timestep[0], :, :, :])
-
-    w = griddata((z_stag, y, x), W_wrf,
-                 (new_grid_z, new_grid_y, new_grid_x),
-                 fill_value=0.)
-    v = griddata((z, y_stag, x), V_wrf,
-                 (new_grid_z, new_grid_y, new_grid_x),
-                 fill_value=0.)
-    u = griddata((z, y, x_stag), U_wrf,
-                 (new_grid_z, new_grid_y, new_grid_x),
-                 fill_value=0.)
+    u, v, w = _interpolate_wrf_winds(
+        wrf_cdf, timestep[0][0], radar_loc,
+        (new_grid_z, new_grid_y, new_grid_x), cache_dir, height_tolerance)
+    wrf_cdf.close()
     u_dict = {'data': u, 'long_name': "U from WRF", 'units': "m/s"}
     v_dict = {'data': v, 'long_name': "V from WRF", 'units': "m/s"}
     w_dict = {'data': w, 'long_name': "W from WRF", 'units': "m/s"}
@@ -365,7 +336,8 @@ def make_constraint_from_wrf(Grid, file_path, wrf_time,
     return Grid
 
 
-def add_hrrr_constraint_to_grid(Grid, file_path):
+def add_hrrr_constraint_to_grid(Grid, file_path, cache_dir=None,
+                                height_tolerance=None):
     """
     This function will read an HRRR GRIB2 file and create the constraining
     u, v, and w fields for the model constraint
@@ -377,11 +349,23 @@ def add_hrrr_constraint_to_grid(Grid, file_path):
     will be interpolated to the Grid's specficiation and added as a field.
     file_path: string
         The path to the GRIB2 file to load.
+    cache_dir: str or None
+        The directory to save the interpolation weights from the HRRR grid
+        to the analysis grid in so they can be reused. The weights are
+        always cached in memory. See
+        :py:func:`pydda.constraints.get_interpolation_weights`.
+    height_tolerance: float or None
+        Reuse the cached weights when the HRRR heights are within about this
+        many meters of the heights the weights were calculated with.
 
     Returns
     -------
     Grid: Py-ART Grid
         This returns the Py-ART grid with the HRRR u, and v fields added.
+        The HRRR levels are placed at their geometric height above the
+        radar, found from the geopotential height. Versions of PyDDA before
+        the HRRR columns were subset placed them at the geopotential height
+        above sea level.
     """
 
     if(CFGRIB_AVAILABLE is False):
@@ -391,62 +375,24 @@ def add_hrrr_constraint_to_grid(Grid, file_path):
     the_grib = cfgrib.open_file(
         file_path, filter_by_keys={'typeOfLevel': 'isobaricInhPa'})
 
-    # Load the HRRR data and tranform longitude coordinates
-    grb_u = the_grib.variables['u']
-    grb_v = the_grib.variables['v']
-    grb_w = the_grib.variables['w']
-    gh = the_grib.variables['gh']
-
-    lat = the_grib.variables['latitude'].data[:, :]
-    lon = the_grib.variables['longitude'].data[:, :]
-    lon[lon > 180] = lon[lon > 180] - 360
-
-    # Convert geometric height to geopotential height
-    EARTH_MEAN_RADIUS = 6.3781e6
-    gh = gh.data[:, :, :]
-    height = (EARTH_MEAN_RADIUS*gh)/(EARTH_MEAN_RADIUS-gh)
-    height = height - Grid.radar_altitude['data']
+    # Only read the HRRR columns around the analysis grid
+    (height_flattened, lat_flattened, lon_flattened,
+     u_flattened, v_flattened, w_flattened) = _read_hrrr_window(
+        the_grib, Grid)
 
     radar_grid_lat = Grid.point_latitude['data']
     radar_grid_lon = Grid.point_longitude['data']
     radar_grid_alt = Grid.point_z['data']
-    lat_min = radar_grid_lat.min()
-    lat_max = radar_grid_lat.max()
-    lon_min = radar_grid_lon.min()
-    lon_max = radar_grid_lon.max()
-    lon_r = np.tile(lon, (height.shape[0], 1, 1))
-    lat_r = np.tile(lat, (height.shape[0], 1, 1))
-    lon_flattened = lon_r.flatten()
-    lat_flattened = lat_r.flatten()
-    height_flattened = gh.flatten()
-    the_box = np.where(np.logical_and.reduce(
-       (lon_flattened >= lon_min, lat_flattened >= lat_min,
-        lon_flattened <= lon_max, lat_flattened <= lat_max)))[0]
-
-    lon_flattened = lon_flattened[the_box]
-    lat_flattened = lat_flattened[the_box]
-    height_flattened = height_flattened[the_box]
-
-    u_flattened = grb_u.data[:, :, :].flatten()
-    u_flattened = u_flattened[the_box]
-    u_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        u_flattened, rescale=True)
-    u_new = u_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
 
-    v_flattened = grb_v.data[:, :, :].flatten()
-    v_flattened = v_flattened[the_box]
-    v_interp = NearestNDInterpolator(
+    # Find the nearest HRRR point to each grid point once and use it
+    # for every variable
+    weights = get_interpolation_weights(
         (height_flattened, lat_flattened, lon_flattened),
-        v_flattened, rescale=True)
-    v_new = v_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-
-    w_flattened = grb_w.data[:, :, :].flatten()
-    w_flattened = w_flattened[the_box]
-    w_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        w_flattened, rescale=True)
-    w_new = w_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+        (radar_grid_alt, radar_grid_lat, radar_grid_lon), 'nearest',
+        cache_dir, height_tolerance)
+    u_new = weights(u_flattened)
+    v_new = weights(v_flattened)
+    w_new = weights(w_flattened)
 
     new_grid = deepcopy(Grid)
 
@@ -459,7 +405,274 @@ def add_hrrr_constraint_to_grid(Grid, file_path):
     new_grid.add_field("W_hrrr", w_dict, replace_existing=True)
     
     # Free up memory
-    del grb_u, grb_v, grb_w, lat, lon
-    del the_grib 
+    del the_grib
     gc.collect()
     return new_grid
+
+
+def add_model_constraint(Grid, dataset, model_name, u_name='u', v_name='v',
+                         w_name='w', height_name='z', lat_name='latitude',
+                         lon_name='longitude', time_name='time',
+                         method='nearest', cache_dir=None,
+                         height_tolerance=None):
+    """
+    This function adds the winds from any model that can be opened as an
+    xarray Dataset, such as NetCDF, GRIB through cfgrib, or Zarr, to the
+    Py-ART Grid as a constraint. The Dataset can be lazily loaded with dask:
+    the time closest to the Grid's time and the model columns that cover
+    the Grid are selected first, and only those are read.
+
+    Parameters
+    ----------
+    Grid: Py-ART Grid
+        The Py-ART Grid to add the model winds to.
+    dataset: xarray Dataset or str
+        The model data. If this is a str, the file is opened lazily with
+        xarray.open_dataset, or with xarray.open_zarr if it ends in .zarr.
+        The winds and heights are dimensioned (time, level, y, x) or
+        (level, y, x), where y and x are the dimensions of the latitude and
+        longitude coordinates. The latitudes and longitudes can be 1D for
+        a regular latitude-longitude grid or 2D.
+    model_name: str
+        The name of the model. The winds are added to the Grid as the
+        fields "U_(model_name)", "V_(model_name)" and "W_(model_name)",
+        so add model_name to the model_fields of
+        :py:func:`pydda.retrieval.get_dd_wind_field` to use them.
+    u_name, v_name, w_name: str
+        The names of the u, v and w variables in m/s.
+    height_name: str
+        The name of the variable with the height of each model point above
+        sea level in m.
+    lat_name, lon_name: str
+        The names of the latitude and longitude coordinates.
+    time_name: str
+        The name of the time dimension. This is not needed if the variables
+        only have one time.
+    method: str
+        The interpolation to use, either 'nearest' or 'linear'. See
+        :py:func:`pydda.constraints.get_interpolation_weights`.
+    cache_dir: str or None
+        The directory to save the interpolation weights from the model to
+        the analysis grid in so they can be reused.
+    height_tolerance: float or None
+        Reuse the cached weights when the model heights are within about
+        this many meters of the heights the weights were calculated with.
+
+    Returns
+    -------
+    new_Grid: Py-ART Grid
+        The Py-ART Grid with the model winds added.
+    """
+    if XARRAY_AVAILABLE is False:
+        raise RuntimeError(("xarray needs to be installed in order to use " +
+                            "add_model_constraint."))
+
+    if isinstance(dataset, str):
+        if dataset.rstrip('/').endswith('.zarr'):
+            dataset = xr.open_zarr(dataset)
+        else:
+            dataset = xr.open_dataset(dataset, chunks={})
+
+    variables = dataset[[u_name, v_name, w_name, height_name]]
+    if time_name in variables.dims:
+        grid_time = datetime.strptime(Grid.time["units"],
+                                      "seconds since %Y-%m-%dT%H:%M:%SZ")
+        grid_time = grid_time + timedelta(
+            seconds=float(Grid.time["data"][0]))
+        variables = variables.sel({time_name: np.datetime64(grid_time)},
+                                  method='nearest')
+
+    # Only take the model columns that cover the analysis grid
+    lat = np.asarray(dataset[lat_name].values)
+    lon = np.asarray(dataset[lon_name].values)
+    lon = np.where(lon > 180, lon - 360, lon)
+    radar_grid_lat = Grid.point_latitude['data']
+    radar_grid_lon = Grid.point_longitude['data']
+    if lat.ndim == 1:
+        y_dim = dataset[lat_name].dims[0]
+        x_dim = dataset[lon_name].dims[0]
+        rows = _get_window(lat, radar_grid_lat.min(), radar_grid_lat.max())
+        cols = _get_window(lon, radar_grid_lon.min(), radar_grid_lon.max())
+        lon, lat = np.meshgrid(lon[cols], lat[rows])
+    else:
+        y_dim, x_dim = dataset[lat_name].dims
+        rows, cols = _get_box_window(
+            lat, lon, radar_grid_lat.min(), radar_grid_lat.max(),
+            radar_grid_lon.min(), radar_grid_lon.max())
+        lat = lat[rows, cols]
+        lon = lon[rows, cols]
+    variables = variables.isel({y_dim: rows, x_dim: cols})
+    variables = variables.transpose(..., y_dim, x_dim)
+
+    # Each variable is read separately, so only one is in memory at a time
+    height = np.asarray(variables[height_name].values, dtype=float)
+    height = height - Grid.radar_altitude['data']
+    lat = np.broadcast_to(lat, height.shape)
+    lon = np.broadcast_to(lon, height.shape)
+    weights = get_interpolation_weights(
+        (height.flatten(), lat.flatten(), lon.flatten()),
+        (Grid.point_z['data'], radar_grid_lat, radar_grid_lon), method,
+        cache_dir, height_tolerance)
+    del height
+
+    new_grid = deepcopy(Grid)
+    for var_name, field_name in [(u_name, "U_"), (v_name, "V_"),
+                                 (w_name, "W_")]:
+        the_data = np.asarray(variables[var_name].values).flatten()
+        field_dict = {'data': weights(the_data),
+                      'long_name': "%s from %s" % (field_name[0], model_name),
+                      'units': "m/s"}
+        new_grid.add_field(field_name + model_name, field_dict,
+                           replace_existing=True)
+    return new_grid
+
+
+def _interpolate_wrf_winds(wrf_cdf, time_index, radar_loc, new_points,
+                           cache_dir=None, height_tolerance=None):
+    """
+    Interpolates the WRF u, v and w at one time to the analysis grid points
+    in new_points. Only the given time and the columns around the analysis
+    grid are read from the file. Each wind
+    component is interpolated from its own staggered grid in the horizontal
+    and in height using the geopotential height PH + PHB.
+    """
+    x_len = wrf_cdf.__getattribute__('WEST-EAST_GRID_DIMENSION')
+    y_len = wrf_cdf.__getattribute__('SOUTH-NORTH_GRID_DIMENSION')
+    dx = wrf_cdf.DX
+    dy = wrf_cdf.DY
+    x = np.arange(0, x_len - 1) * dx - radar_loc[0] * 1e3
+    y = np.arange(0, y_len - 1) * dy - radar_loc[1] * 1e3
+
+    # Only read the columns around the analysis grid
+    x_window = _get_window(x, np.min(new_points[2]), np.max(new_points[2]),
+                           margin=2)
+    y_window = _get_window(y, np.min(new_points[1]), np.max(new_points[1]),
+                           margin=2)
+    x_stag_window = slice(x_window.start, x_window.stop + 1)
+    y_stag_window = slice(y_window.start, y_window.stop + 1)
+    x_stag = (np.arange(0, x_len) * dx - dx / 2.0 -
+              radar_loc[0] * 1e3)[x_stag_window]
+    y_stag = (np.arange(0, y_len) * dy - dy / 2.0 -
+              radar_loc[1] * 1e3)[y_stag_window]
+    x = x[x_window]
+    y = y[y_window]
+
+    W_wrf = wrf_cdf.variables['W'][time_index, :, y_window, x_window]
+    V_wrf = wrf_cdf.variables['V'][time_index, :, y_stag_window, x_window]
+    U_wrf = wrf_cdf.variables['U'][time_index, :, y_window, x_stag_window]
+    z_w = (wrf_cdf.variables['PH'][time_index, :, y_window, x_window] +
+           wrf_cdf.variables['PHB'][time_index, :, y_window, x_window]) / 9.81
+    z_w = np.ma.getdata(z_w)
+    z_mass = (z_w[1:] + z_w[:-1]) / 2.0
+
+    # The heights of the U and V points are the average of the heights
+    # of the mass points on either side
+    z_pad = np.concatenate([z_mass[:, :, :1], z_mass, z_mass[:, :, -1:]],
+                           axis=2)
+    z_u = (z_pad[:, :, 1:] + z_pad[:, :, :-1]) / 2.0
+    z_pad = np.concatenate([z_mass[:, :1], z_mass, z_mass[:, -1:]], axis=1)
+    z_v = (z_pad[:, 1:] + z_pad[:, :-1]) / 2.0
+
+    w = get_structured_interpolation_weights(
+        z_w, y, x, new_points, cache_dir, height_tolerance)(W_wrf)
+    v = get_structured_interpolation_weights(
+        z_v, y_stag, x, new_points, cache_dir, height_tolerance)(V_wrf)
+    u = get_structured_interpolation_weights(
+        z_u, y, x_stag, new_points, cache_dir, height_tolerance)(U_wrf)
+    return u, v, w
+
+
+def _get_window(coords, coord_min, coord_max, margin=1):
+    """
+    Gets the slice of the 1D array coords that covers the interval from
+    coord_min to coord_max plus margin points on each side. coords may be
+    increasing or decreasing.
+    """
+    inside = np.where(np.logical_and(coords >= coord_min,
+                                     coords <= coord_max))[0]
+    if len(inside) == 0:
+        inside = np.array([np.argmin(np.abs(
+            coords - (coord_min + coord_max) / 2.))])
+    return slice(max(inside.min() - margin, 0),
+                 min(inside.max() + margin + 1, len(coords)))
+
+
+def _read_era_window(ERA_grid, Grid, grid_time):
+    """
+    Reads the ERA geopotential height, u, v and w at the time closest to
+    grid_time over the horizontal extent of Grid, and the latitudes and
+    longitudes of the points that were read. Only this part of the file
+    is read. The longitudes are returned between -180 and 180 degrees.
+    """
+    base_time = datetime.strptime(ERA_grid.variables["time"].units,
+                                  "hours since %Y-%m-%d %H:%M:%S.%f")
+    era_hours = ERA_grid.variables["time"][:]
+    era_times = np.array([base_time + timedelta(hours=float(x))
+                          for x in era_hours])
+    time_step = int(np.argmin(np.abs(era_times - grid_time)))
+
+    lat_ERA = ERA_grid.variables["latitude"][:]
+    lon_ERA = ERA_grid.variables["longitude"][:]
+    lon_ERA = np.where(lon_ERA > 180, lon_ERA - 360, lon_ERA)
+    lat_window = _get_window(lat_ERA, Grid.point_latitude["data"].min(),
+                             Grid.point_latitude["data"].max())
+    lon_window = _get_window(lon_ERA, Grid.point_longitude["data"].min(),
+                             Grid.point_longitude["data"].max())
+    window = (time_step, slice(None), lat_window, lon_window)
+    return (ERA_grid.variables["z"][window], ERA_grid.variables["u"][window],
+            ERA_grid.variables["v"][window], ERA_grid.variables["w"][window],
+            lat_ERA[lat_window], lon_ERA[lon_window])
+
+
+def _get_box_window(lat, lon, lat_min, lat_max, lon_min, lon_max, margin=1):
+    """
+    Gets the row and column slices of the 2D lat and lon arrays that cover
+    the box from lat_min to lat_max and lon_min to lon_max plus margin
+    points on each side.
+    """
+    inside = np.logical_and.reduce(
+        (lon >= lon_min, lat >= lat_min, lon <= lon_max, lat <= lat_max))
+    if np.any(inside):
+        rows, cols = np.where(inside)
+    else:
+        # The box is between model points, so use the closest one
+        distance = ((lat - (lat_min + lat_max) / 2.)**2 +
+                    (lon - (lon_min + lon_max) / 2.)**2)
+        rows, cols = np.unravel_index(np.argmin(distance), lat.shape)
+    return (slice(max(np.min(rows) - margin, 0),
+                  min(np.max(rows) + margin + 1, lat.shape[0])),
+            slice(max(np.min(cols) - margin, 0),
+                  min(np.max(cols) + margin + 1, lat.shape[1])))
+
+
+def _read_hrrr_window(the_grib, Grid):
+    """
+    Reads the HRRR heights relative to the radar, latitudes, longitudes,
+    u, v and w in the columns that cover Grid from an open cfgrib file.
+    The columns are selected on the 2D latitude and longitude arrays before
+    any 3D variable is read, and all of the arrays are returned flattened.
+    """
+    lat = the_grib.variables['latitude'].data[:, :]
+    lon = the_grib.variables['longitude'].data[:, :]
+    lon = np.where(lon > 180, lon - 360, lon)
+
+    radar_grid_lat = Grid.point_latitude['data']
+    radar_grid_lon = Grid.point_longitude['data']
+    rows, cols = _get_box_window(
+        lat, lon, radar_grid_lat.min(), radar_grid_lat.max(),
+        radar_grid_lon.min(), radar_grid_lon.max())
+    window = (slice(None), rows, cols)
+
+    # Convert geopotential height to geometric height
+    EARTH_MEAN_RADIUS = 6.3781e6
+    gh = the_grib.variables['gh'].data[window]
+    height = (EARTH_MEAN_RADIUS*gh)/(EARTH_MEAN_RADIUS-gh)
+    height = height - Grid.radar_altitude['data']
+
+    num_levels = height.shape[0]
+    lat = np.tile(lat[rows, cols], (num_levels, 1, 1))
+    lon = np.tile(lon[rows, cols], (num_levels, 1, 1))
+    return (height.flatten(), lat.flatten(), lon.flatten(),
+            the_grib.variables['u'].data[window].flatten(),
+            the_grib.variables['v'].data[window].flatten(),
+            the_grib.variables['w'].data[window].flatten())
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+import threading
+
+# The columns of a PointObservations and their default values
+_POINT_DTYPE = np.dtype([('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
+                         ('u', 'f8'), ('v', 'f8'), ('w', 'f8'),
+                         ('lat', 'f8'), ('lon', 'f8'), ('site_id', 'U32')])
+_POINT_DEFAULTS = {'w': 0., 'lat': np.nan, 'lon': np.nan, 'site_id': ''}
+
+# The number of grids to keep the grid indices of
+_MAX_CACHED_GRIDS = 4
+
+
+class PointObservations(object):
+    """
+    This class holds point observations of the wind, such as those from
+    surface stations, as a NumPy structured array with one row per
+    observation. It behaves like the list of dicts that PyDDA used for
+    point observations: iterating over it or indexing it with an integer
+    gives a dict with the keys "x", "y", "z", "u", "v", "w", "lat", "lon"
+    and "site_id". The grid points that each observation constrains are
+    found once per grid and reused, so the point cost function is
+    evaluated for all of the observations at once.
+
+    Parameters
+    ----------
+    data: NumPy structured array or None
+        The observations. This must have the fields "x", "y", "z", "u" and
+        "v". The x, y, and z coordinates are in meters relative to the
+        origin of the analysis grid, and u and v are in m/s. Set to None to
+        make an empty set of observations.
+
+    Attributes
+    ----------
+    data: NumPy structured array
+        The observations.
+    """
+    def __init__(self, data=None):
+        if data is None:
+            data = np.zeros(0, dtype=_POINT_DTYPE)
+        self.data = _to_point_array(
+            len(data), lambda name: data[name], data.dtype.names)
+        self._grid_indices = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_list(cls, point_list):
+        """
+        Makes a PointObservations from a list of dicts such as the ones
+        returned by older versions of :func:`pydda.constraints.get_iem_obs`.
+        """
+        if isinstance(point_list, cls):
+            return point_list
+        names = set()
+        for the_point in point_list:
+            names.update(the_point.keys())
+        return cls(_to_point_array(
+            len(point_list),
+            lambda name: [the_point.get(name, _POINT_DEFAULTS.get(name))
+                          for the_point in point_list], names))
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        Makes a PointObservations from a pandas DataFrame with one row per
+        observation and the fields of the observations as its columns.
+        """
+        return cls(_to_point_array(
+            len(df), lambda name: df[name].values, df.columns))
+
+    @classmethod
+    def from_csv(cls, file_name, **kwargs):
+        """
+        Reads a PointObservations from a CSV file with a header row that
+        names the fields of the observations. The keyword arguments are
+        passed to pandas.read_csv.
+        """
+        return cls.from_dataframe(pd.read_csv(file_name, **kwargs))
+
+    def to_dataframe(self):
+        """
+        Returns the observations as a pandas DataFrame.
+        """
+        return pd.DataFrame(self.data)
+
+    def to_csv(self, file_name):
+        """
+        Writes the observations to a CSV file that can be read with
+        from_csv.
+        """
+        self.to_dataframe().to_csv(file_name, index=False)
+
+    def get_grid_indices(self, x, y, z, roi):
+        """
+        Finds the grid points that are within roi meters of each
+        observation in x, y and z. The result is cached for the last few
+        grids, so pass the same arrays each time.
+
+        Parameters
+        ----------
+        x, y, z: 3D float arrays
+            The coordinates of the grid points, such as Grid.point_x['data'].
+        roi: float
+            The radius of influence of each observation.
+
+        Returns
+        -------
+        grid_index: 1D int array
+            The flattened index of each grid point that is within the radius
+            of influence of an observation.
+        obs_index: 1D int array
+            The index of the observation for each entry of grid_index.
+        """
+        key = (float(roi), id(x), id(y), id(z))
+        with self._lock:
+            cached = self._grid_indices.get(key)
+        if cached is not None and all(
+                a is b for a, b in zip(cached[0], (x, y, z))):
+            return cached[1]
+
+        indices = self._find_grid_indices(x, y, z, roi)
+        with self._lock:
+            self._grid_indices[key] = ((x, y, z), indices)
+            while len(self._grid_indices) > _MAX_CACHED_GRIDS:
+                del self._grid_indices[next(iter(self._grid_indices))]
+        return indices
+
+    def _find_grid_indices(self, x, y, z, roi):
+        grid_shape = np.shape(x)
+        axes = [_get_axis(np.asarray(coords)) for coords in (x, y, z)]
+        if any(axis is None for axis in axes):
+            # Not a regular grid, so check every point
+            boxes = [np.flatnonzero(np.logical_and.reduce(
+                (np.abs(x - the_point["x"]) < roi,
+                 np.abs(y - the_point["y"]) < roi,
+                 np.abs(z - the_point["z"]) < roi)))
+                for the_point in self.data]
+        else:
+            # The points within the box of half width roi around each
+            # observation are a product of indices along each axis
+            boxes = []
+            for the_point in self.data:
+                inside = [np.ones(n, dtype=bool) for n in grid_shape]
+                for (dim, line), name in zip(axes, ['x', 'y', 'z']):
+                    inside[dim] &= np.abs(line - the_point[name]) < roi
+                box = np.ix_(*[np.flatnonzero(mask) for mask in inside])
+                boxes.append(np.ravel_multi_index(box, grid_shape).ravel())
+
+        if len(boxes) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        obs_index = np.repeat(np.arange(len(boxes)),
+                              [box.size for box in boxes])
+        return np.concatenate(boxes).astype(int), obs_index
+
+    def __getstate__(self):
+        # The cache and the lock are not sent to other processes
+        return {'data': self.data}
+
+    def __setstate__(self, state):
+        self.data = state['data']
+        self._grid_indices = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            row = self.data[index]
+            return {name: row[name].item() for name in self.data.dtype.names}
+        return PointObservations(self.data[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'PointObservations(%d observations)' % len(self)
+
+
+# Makes the structured array of n observations, getting each field with
+# get_field when it is in names and using its default otherwise
+def _to_point_array(n, get_field, names):
+    if n == 0:
+        return np.zeros(0, dtype=_POINT_DTYPE)
+    names = set(names)
+    for name in ['x', 'y', 'z', 'u', 'v']:
+        if name not in names:
+            raise KeyError("Point observations need the field %s" % name)
+
+    data = np.zeros(n, dtype=_POINT_DTYPE)
+    for name in _POINT_DTYPE.names:
+        if name in names:
+            data[name] = get_field(name)
+        else:
+            data[name] = _POINT_DEFAULTS[name]
+    return data
+
+
+# Finds the dimension that the coordinates in coords vary along and their
+# values along it, or returns None if they vary along more than one
+def _get_axis(coords):
+    for dim in range(coords.ndim):
+        index = [0] * coords.ndim
+        index[dim] = slice(None)
+        line = coords[tuple(index)]
+        shape = [1] * coords.ndim
+        shape[dim] = len(line)
+        if np.array_equal(coords, np.broadcast_to(line.reshape(shape),
+                                                  coords.shape)):
+            return dim, line
+    return None
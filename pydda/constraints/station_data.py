@@ -4,8 +4,11 @@ import warnings
 import numpy as np
 import pyart
 import time
+import os
+import logging
+import threading
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from six import StringIO
 
 try:
@@ -13,11 +16,168 @@ try:
 except ImportError:
     from urllib2 import urlopen
 
+from concurrent.futures import ThreadPoolExecutor
+from .point_observations import PointObservations
 
-def get_iem_obs(Grid, window=60.):
+logger = logging.getLogger(__name__)
+
+_REGIONS = """AF AL_ AI_ AQ_ AG_ AR_ AK AL AM_ AO_ AS_ AR AW_ AU_ AT_ 
+         AZ_ BA_ BE_ BB_ BG_ BO_ BR_ BF_ BT_ BS_ BI_ BM_ BB_ BY_ BZ_ BJ_ BW_ AZ CA CA_AB
+         CA_BC CD_ CK_ CF_ CG_ CL_ CM_ CO CO_ CN_ CR_ CT CU_ CV_ CY_ CZ_ DE DK_ DJ_ DM_ DO_ 
+         DZ EE_ ET_ FK_ FM_ FJ_ FI_ FR_ GF_ PF_ GA_ GM_ GE_ DE_ GH_ GI_ KY_ GB_ GR_ GL_ GD_
+         GU_ GT_ GN_ GW_ GY_ HT_ HN_ HK_ HU_ IS_ IN_ ID_ IR_ IQ_ IE_ IL_ IT_ CI_ JM_ JP_ 
+         JO_ KZ_ KE_ KI_ KW_ LA_ LV_ LB_ LS_ LR_ LY_ LT_ LU_ MK_ MG_ MW_ MY_ MV_ ML_ CA_MB
+         MH_ MR_ MU_ YT_ MX_ MD_ MC_ MA_ MZ_ MM_ NA_ NP_ AN_ NL_ CA_NB NC_ CA_NF NF_ NI_
+         NE_ NG_ MP_ KP_ CA_NT NO_ CA_NS CA_NU OM_ CA_ON PK_ PA_ PG_ PY_ PE_ PH_ PN_ PL_
+         PT_ CA_PE PR_ QA_ CA_QC RO_ RU_RW_ SH_ KN_ LC_ VC_ WS_ ST_ CA_SK SA_ SN_ RS_ SC_
+         SL_ SG_ SK_ SI_ SB_ SO_ ZA_ KR_ ES_ LK_ SD_ SR_ SZ_ SE_ CH_ SY_ TW_ TJ_ TZ_ TH_
+         TG_ TO_ TT_ TU TN_ TR_ TM_ UG_ UA_ AE_ UN_ UY_  UZ_ VU_ VE_ VN_ VI_ YE_ CA_YT ZM_ ZW_
+         EC_ EG_ FL GA GQ_ HI HR_ IA ID IL IO_ IN KS KH_ KY KM_ LA MA MD ME
+         MI MN MO MS MT NC ND NE NH NJ NM NV NY OH OK OR PA RI SC SV_ SD TD_ TN TX UT VA VT VG_
+         WA WI WV WY"""
+
+_NETWORK_URI = "https://mesonet.agron.iastate.edu/geojson/network/%s.geojson"
+_SERVICE = ("http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?" +
+            "data=all&tz=Etc/UTC&format=comma&latlon=yes&")
+
+
+class IEMTransport(object):
+    """
+    This class downloads the station metadata and observations from the
+    Iowa Mesonet web service for :func:`pydda.constraints.get_iem_obs`.
+    A transport is any object with get_network and get_station methods
+    like this one.
+
+    Parameters
+    ----------
+    retries: int
+        The number of times to try each station download.
+    retry_delay: float
+        The time in seconds to wait before trying a failed station download
+        again.
+    timeout: float
+        The timeout of each download in seconds.
+    """
+    def __init__(self, retries=6, retry_delay=5., timeout=300.):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+
+    def get_network(self, network):
+        """
+        Returns the GeoJSON metadata of the stations in network as a string.
+        """
+        data = urlopen(_NETWORK_URI % (network,), timeout=self.timeout)
+        return data.read().decode("utf-8")
+
+    def get_station(self, station, start_time, end_time):
+        """
+        Returns the comma separated observations at station between the
+        days of start_time and end_time as a string.
+        """
+        uri = _SERVICE
+        uri += start_time.strftime("year1=%Y&month1=%m&day1=%d&")
+        uri += end_time.strftime("year2=%Y&month2=%m&day2=%d&")
+        uri = "%s&station=%s" % (uri, station)
+        logger.info("Downloading: %s", station)
+        return self._download(uri)
+
+    def _download(self, uri):
+        attempt = 0
+        while attempt < self.retries:
+            try:
+                data = urlopen(uri, timeout=self.timeout).read().decode(
+                    "utf-8")
+                if data is not None and not data.startswith("ERROR"):
+                    return data
+            except Exception as exp:
+                logger.warning("download_data(%s) failed with %s", uri, exp)
+                time.sleep(self.retry_delay)
+            attempt += 1
+
+        logger.warning("Exhausted attempts to download, returning empty data")
+        return ""
+
+
+class IEMFileTransport(object):
+    """
+    This class reads the station metadata and observations for
+    :func:`pydda.constraints.get_iem_obs` from a directory instead of the
+    Iowa Mesonet, for testing and for machines without internet access.
+    The directory has the same layout as the cache_dir of get_iem_obs,
+    so a cache made on another machine can be used here.
+
+    Parameters
+    ----------
+    path: str
+        The directory to read from. The metadata of each network is read
+        from networks/(network).geojson and the observations from
+        stations/(station)_(start day)_(end day).csv, with the days in
+        YYYYMMDD format. Networks and stations without a file are skipped.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def get_network(self, network):
+        """
+        Returns the GeoJSON metadata of the stations in network as a string.
+        """
+        return self._read(_get_network_file(network))
+
+    def get_station(self, station, start_time, end_time):
+        """
+        Returns the comma separated observations at station between the
+        days of start_time and end_time as a string.
+        """
+        return self._read(_get_station_file(station, start_time, end_time))
+
+    def _read(self, file_name):
+        file_name = os.path.join(self.path, file_name)
+        if not os.path.isfile(file_name):
+            return ""
+        with open(file_name, 'r') as the_file:
+            return the_file.read()
+
+
+# Where each request is cached, relative to the cache directory
+def _get_network_file(network):
+    return os.path.join("networks", "%s.geojson" % (network,))
+
+
+def _get_station_file(station, start_time, end_time):
+    return os.path.join("stations", "%s_%s_%s.csv" % (
+        station, start_time.strftime("%Y%m%d"),
+        end_time.strftime("%Y%m%d")))
+
+
+# Returns the cached copy of file_name if there is one, and calls fetch
+# and caches what it returns otherwise. Failed requests are not cached.
+def _fetch_cached(cache_dir, file_name, fetch, *args):
+    if cache_dir is None:
+        return fetch(*args)
+
+    file_name = os.path.join(cache_dir, file_name)
+    if os.path.isfile(file_name):
+        with open(file_name, 'r') as the_file:
+            return the_file.read()
+
+    data = fetch(*args)
+    if data:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temp_name = "%s.%d.%d.tmp" % (file_name, os.getpid(),
+                                      threading.get_ident())
+        with open(temp_name, 'w') as the_file:
+            the_file.write(data)
+        os.replace(temp_name, file_name)
+    return data
+
+
+def get_iem_obs(Grid, window=60., transport=None, cache_dir=None,
+                num_workers=8):
     """
     Returns all of the station observations from the Iowa Mesonet for a given Grid in the format
-    needed for PyDDA.
+    needed for PyDDA. The metadata of each network and the observations at
+    each station are downloaded concurrently.
 
     Parameters
     ----------
@@ -25,11 +185,24 @@ def get_iem_obs(Grid, window=60.):
         The Grid to retrieve the station data for.
     window: float
         The window (in minutes) to look for the nearest observation in time.
+    transport: object or None
+        Where to get the station data from. Set to None to download it from
+        the Iowa Mesonet using :class:`pydda.constraints.IEMTransport`. Use
+        :class:`pydda.constraints.IEMFileTransport` to read it from a
+        directory.
+    cache_dir: str or None
+        The directory to cache the network metadata and station observations
+        in. Data that is in the cache is not downloaded again. Observations
+        from days that have not ended yet are not cached. Set to None to
+        not cache anything.
+    num_workers: int
+        The number of downloads to run at the same time.
 
     Returns
     -------
-    station_data: list of dicts
-        A list of dictionaries containing the following entries as keys:
+    station_data: PointObservations
+        The observations. Like a list of dicts, each observation has the
+        following entries as keys:
 
         *lat* - Latitude of the site (float)
 
@@ -45,46 +218,36 @@ def get_iem_obs(Grid, window=60.):
 
         *x*, *y*, *z* - The (x, y, z) coordinates of the site in the Grid. (floats)
     """
+    if transport is None:
+        transport = IEMTransport()
 
     # First query the database for all of the JSON info for every station
     # Only add stations whose lat/lon are within the Grid's boundaries
-    regions = """AF AL_ AI_ AQ_ AG_ AR_ AK AL AM_ AO_ AS_ AR AW_ AU_ AT_ 
-         AZ_ BA_ BE_ BB_ BG_ BO_ BR_ BF_ BT_ BS_ BI_ BM_ BB_ BY_ BZ_ BJ_ BW_ AZ CA CA_AB
-         CA_BC CD_ CK_ CF_ CG_ CL_ CM_ CO CO_ CN_ CR_ CT CU_ CV_ CY_ CZ_ DE DK_ DJ_ DM_ DO_ 
-         DZ EE_ ET_ FK_ FM_ FJ_ FI_ FR_ GF_ PF_ GA_ GM_ GE_ DE_ GH_ GI_ KY_ GB_ GR_ GL_ GD_
-         GU_ GT_ GN_ GW_ GY_ HT_ HN_ HK_ HU_ IS_ IN_ ID_ IR_ IQ_ IE_ IL_ IT_ CI_ JM_ JP_ 
-         JO_ KZ_ KE_ KI_ KW_ LA_ LV_ LB_ LS_ LR_ LY_ LT_ LU_ MK_ MG_ MW_ MY_ MV_ ML_ CA_MB
-         MH_ MR_ MU_ YT_ MX_ MD_ MC_ MA_ MZ_ MM_ NA_ NP_ AN_ NL_ CA_NB NC_ CA_NF NF_ NI_
-         NE_ NG_ MP_ KP_ CA_NT NO_ CA_NS CA_NU OM_ CA_ON PK_ PA_ PG_ PY_ PE_ PH_ PN_ PL_
-         PT_ CA_PE PR_ QA_ CA_QC RO_ RU_RW_ SH_ KN_ LC_ VC_ WS_ ST_ CA_SK SA_ SN_ RS_ SC_
-         SL_ SG_ SK_ SI_ SB_ SO_ ZA_ KR_ ES_ LK_ SD_ SR_ SZ_ SE_ CH_ SY_ TW_ TJ_ TZ_ TH_
-         TG_ TO_ TT_ TU TN_ TR_ TM_ UG_ UA_ AE_ UN_ UY_  UZ_ VU_ VE_ VN_ VI_ YE_ CA_YT ZM_ ZW_
-         EC_ EG_ FL GA GQ_ HI HR_ IA ID IL IO_ IN KS KH_ KY KM_ LA MA MD ME
-         MI MN MO MS MT NC ND NE NH NJ NM NV NY OH OK OR PA RI SC SV_ SD TD_ TN TX UT VA VT VG_
-         WA WI WV WY"""
-
     networks = ["AWOS"]
     grid_lon_min = Grid.point_longitude["data"].min()
     grid_lon_max = Grid.point_longitude["data"].max()
     grid_lat_min = Grid.point_latitude["data"].min()
     grid_lat_max = Grid.point_latitude["data"].max()
-    for region in regions.split():
+    for region in _REGIONS.split():
         networks.append("%s_ASOS" % (region,))
 
-    site_list = []
-    elevations = []
-    for network in networks:
-        # Get metadata
-        uri = ("https://mesonet.agron.iastate.edu/" "geojson/network/%s.geojson"
-              ) % (network,)
-        data = urlopen(uri)
-        jdict = json.load(data)
-        for site in jdict["features"]:
-            lat = site["geometry"]["coordinates"][1]
-            lon = site["geometry"]["coordinates"][0]
-            if lat >= grid_lat_min and lat <= grid_lat_max and lon >= grid_lon_min and lon <= grid_lon_max:
-                site_list.append((site["properties"]["sid"], site["properties"]["elevation"]))
+    def get_network(network):
+        return _fetch_cached(cache_dir, _get_network_file(network),
+                             transport.get_network, network)
 
+    site_list = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # map returns the results in order, so the stations are always in
+        # the same order
+        for data in executor.map(get_network, networks):
+            if not data:
+                continue
+            jdict = json.loads(data)
+            for site in jdict["features"]:
+                lat = site["geometry"]["coordinates"][1]
+                lon = site["geometry"]["coordinates"][0]
+                if lat >= grid_lat_min and lat <= grid_lat_max and lon >= grid_lon_min and lon <= grid_lon_max:
+                    site_list.append((site["properties"]["sid"], site["properties"]["elevation"]))
 
     # Get the timestamp for each request
     grid_time = datetime.strptime(Grid.time["units"],
@@ -92,16 +255,28 @@ def get_iem_obs(Grid, window=60.):
     start_time = grid_time - timedelta(minutes=window / 2.)
     end_time = grid_time + timedelta(minutes=window / 2.)
 
-    SERVICE = "http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?"
-    service = SERVICE + "data=all&tz=Etc/UTC&format=comma&latlon=yes&"
+    # The observations of a day that has not ended yet are still coming
+    # in, so they are not cached
+    station_cache_dir = cache_dir
+    if end_time.date() >= datetime.now(timezone.utc).date():
+        station_cache_dir = None
+
+    def get_station(station):
+        return _fetch_cached(
+            station_cache_dir,
+            _get_station_file(station, start_time, end_time),
+            transport.get_station, station, start_time, end_time)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        station_data = list(executor.map(
+            get_station, [stations for stations, elevations in site_list]))
 
-    service += start_time.strftime("year1=%Y&month1=%m&day1=%d&")
-    service += end_time.strftime("year2=%Y&month2=%m&day2=%d&")
     station_obs = []
-    for stations, elevations in site_list:
-        uri = "%s&station=%s" % (service, stations)
-        print("Downloading: %s" % (stations,))
-        data = _download_data(uri)
+    for (stations, elevations), data in zip(site_list, station_data):
+        if not data:
+            warnings.warn("No data could be downloaded for station %s" %
+                          (stations,))
+            continue
         buf = StringIO()
         buf.write(data)
         buf.seek(0)
@@ -131,19 +306,4 @@ def get_iem_obs(Grid, window=60.):
             station_obs.append(stat_dict)
         buf.close()
 
-    return station_obs
-
-def _download_data(uri):
-    attempt = 0
-    while attempt < 6:
-        try:
-            data = urlopen(uri, timeout=300).read().decode("utf-8")
-            if data is not None and not data.startswith("ERROR"):
-                return data
-        except Exception as exp:
-            print("download_data(%s) failed with %s" % (uri, exp))
-            time.sleep(5)
-        attempt += 1
-
-    print("Exhausted attempts to download, returning empty data")
-    return ""
+    return PointObservations.from_list(station_obs)
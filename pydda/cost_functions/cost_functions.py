@@ -1,6 +1,11 @@
 import numpy as np
 import pyart
 import scipy.ndimage.filters
+import logging
+
+from ..constraints.point_observations import PointObservations
+
+logger = logging.getLogger(__name__)
 
 
 def J_function(winds, parameters):
@@ -65,11 +70,9 @@ def J_function(winds, parameters):
         Jvorticity = 0
 
     if(parameters.Cmod > 0):
-        Jmod = calculate_model_cost(
-            winds[0], winds[1], winds[2],
-            parameters.model_weights, parameters.u_model,
-            parameters.v_model,
-            parameters.w_model, coeff=parameters.Cmod)
+        Jmod = _model_cost(
+            winds[0], winds[1], parameters.model_weights,
+            parameters.u_model, parameters.v_model, parameters.Cmod)
     else:
         Jmod = 0
 
@@ -80,19 +83,24 @@ def J_function(winds, parameters):
     else:
         Jpoint = 0
 
+    J = Jvel + Jmass + Jsmooth + Jbackground + Jvorticity + Jmod + Jpoint
+    parameters.last_costs = {'Jvel': Jvel, 'Jmass': Jmass,
+                             'Jsmooth': Jsmooth, 'Jbg': Jbackground,
+                             'Jvort': Jvorticity, 'Jmodel': Jmod,
+                             'Jpoint': Jpoint, 'J': J}
     if(parameters.print_out is True):
-        print(('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Jmodel  | Jpoint  |' +
-               ' Max w  '))
-        print(('|' + "{:9.4f}".format(Jvel) + '|' +
-               "{:9.4f}".format(Jmass) + '|' +
-               "{:9.4f}".format(Jsmooth) + '|' +
-               "{:9.4f}".format(Jbackground) + '|' +
-               "{:9.4f}".format(Jvorticity) + '|' +
-               "{:9.4f}".format(Jmod) + '|' +
-               "{:9.4f}".format(Jpoint)) + '|' +
-               "{:9.4f}".format(np.ma.max(np.ma.abs(winds[2]))))
+        logger.info(('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Jmodel  | Jpoint  |' +
+                     ' Max w  '))
+        logger.info(('|' + "{:9.4f}".format(Jvel) + '|' +
+                     "{:9.4f}".format(Jmass) + '|' +
+                     "{:9.4f}".format(Jsmooth) + '|' +
+                     "{:9.4f}".format(Jbackground) + '|' +
+                     "{:9.4f}".format(Jvorticity) + '|' +
+                     "{:9.4f}".format(Jmod) + '|' +
+                     "{:9.4f}".format(Jpoint)) + '|' +
+                    "{:9.4f}".format(np.ma.max(np.ma.abs(winds[2]))))
 
-    return Jvel + Jmass + Jsmooth + Jbackground + Jvorticity + Jmod + Jpoint
+    return J
 
 
 def grad_J(winds, parameters):
@@ -148,18 +156,18 @@ def grad_J(winds, parameters):
             parameters.Vt, coeff=parameters.Cv)
 
     if(parameters.Cmod > 0):
-        grad += calculate_model_gradient(
-            winds[0], winds[1], winds[2],
-            parameters.model_weights, parameters.u_model, parameters.v_model,
-            parameters.w_model, coeff=parameters.Cmod)
+        grad += _model_gradient(
+            winds[0], winds[1], parameters.model_weights,
+            parameters.u_model, parameters.v_model, parameters.Cmod)
 
     if parameters.Cpoint > 0:
         grad += calculate_point_gradient(
             winds[0], winds[1], parameters.x, parameters.y, parameters.z,
             parameters.point_list, Cp=parameters.Cpoint, roi=parameters.roi)
 
+    parameters.last_grad_norm = np.linalg.norm(grad, np.inf)
     if(parameters.print_out is True):
-        print('Norm of gradient: ' + str(np.linalg.norm(grad, np.inf)))
+        logger.info('Norm of gradient: %s', parameters.last_grad_norm)
 
     return grad
 
@@ -433,13 +441,15 @@ def calculate_point_cost(u, v, x, y, z, point_list, Cp=1e-3, roi=500.0):
         Y coordinates of grid centers
     z:  Float array
         Z coordinated of grid centers
-    point_list: list of dicts
+    point_list: PointObservations or list of dicts
         List of point constraints.
         Each member is a dict with keys of "u", "v", to correspond
         to each component of the wind field and "x", "y", "z"
         to correspond to the location of the point observation.
 
         In addition, "site_id" gives the METAR code (or name) to the station.
+        Pass a :class:`pydda.constraints.PointObservations` so that the grid
+        points near each observation are only found once.
     Cp: float
         The weighting coefficient of the point cost function.
     roi: float
@@ -451,14 +461,12 @@ def calculate_point_cost(u, v, x, y, z, point_list, Cp=1e-3, roi=500.0):
         The cost function related to the difference between wind field and points.
 
     """
-    J = 0.0
-    for the_point in point_list:
-        # Instead of worrying about whole domain, just find points in radius of influence
-        # Since we know that the weight will be zero outside the sphere of influence anyways
-        the_box = np.where(np.logical_and.reduce(
-            (np.abs(x - the_point["x"]) < roi, np.abs(y - the_point["y"]) < roi,
-                                            np.abs(z - the_point["z"]) < roi)))
-        J += np.sum(((u[the_box] - the_point["u"])**2 + (v[the_box] - the_point["v"])**2))
+    # Instead of worrying about whole domain, just find points in radius of influence
+    # Since we know that the weight will be zero outside the sphere of influence anyways
+    points = PointObservations.from_list(point_list)
+    grid_index, obs_index = points.get_grid_indices(x, y, z, roi)
+    J = np.sum((u.ravel()[grid_index] - points.data["u"][obs_index])**2 +
+               (v.ravel()[grid_index] - points.data["v"][obs_index])**2)
 
     return J * Cp
 
@@ -481,12 +489,14 @@ def calculate_point_gradient(u, v, x, y, z, point_list, Cp=1e-3, roi=500.0):
         Y coordinates of grid centers
     z: Float array
         Z coordinated of grid centers
-    point_list: list of dicts
+    point_list: PointObservations or list of dicts
         List of point constraints. Each member is a dict with keys of "u", "v",
         to correspond to each component of the wind field and "x", "y", "z"
         to correspond to the location of the point observation.
 
         In addition, "site_id" gives the METAR code (or name) to the station.
+        Pass a :class:`pydda.constraints.PointObservations` so that the grid
+        points near each observation are only found once.
     Cp: float
         The weighting coefficient of the point cost function.
     roi: float
@@ -499,17 +509,16 @@ def calculate_point_gradient(u, v, x, y, z, point_list, Cp=1e-3, roi=500.0):
 
     """
 
-    gradJ_u = np.zeros_like(u)
-    gradJ_v = np.zeros_like(v)
+    points = PointObservations.from_list(point_list)
+    grid_index, obs_index = points.get_grid_indices(x, y, z, roi)
+    gradJ_u = np.bincount(
+        grid_index, 2 * (u.ravel()[grid_index] - points.data["u"][obs_index]),
+        minlength=u.size).reshape(u.shape)
+    gradJ_v = np.bincount(
+        grid_index, 2 * (v.ravel()[grid_index] - points.data["v"][obs_index]),
+        minlength=v.size).reshape(v.shape)
     gradJ_w = np.zeros_like(u)
 
-    for the_point in point_list:
-        the_box = np.where(np.logical_and.reduce(
-            (np.abs(x - the_point["x"]) < roi, np.abs(y - the_point["y"]) < roi,
-             np.abs(z - the_point["z"]) < roi)))
-        gradJ_u[the_box] += 2 * (u[the_box] - the_point["u"])
-        gradJ_v[the_box] += 2 * (v[the_box] - the_point["v"])
-
     gradJ = np.stack([gradJ_u, gradJ_v, gradJ_w], axis=0).flatten()
     return gradJ * Cp
 
@@ -926,6 +935,7 @@ def calculate_model_cost(u, v, w, weights, u_model, v_model, w_model,
     between the model wind field and the analysis wind field. Vertical
     velocities are not factored into this cost function as there is typically
     a high amount of uncertainty in model derived vertical velocities.
+    Masked model points are left out.
 
     Parameters
     ----------
@@ -935,14 +945,14 @@ def calculate_model_cost(u, v, w, weights, u_model, v_model, w_model,
         Float array with v component of wind field
     w: 3D array
         Float array with w component of wind field
-    weights: list of 3D arrays
+    weights: 4D array or list of 3D arrays
         Float array showing how much each point from model weighs into
         constraint.
-    u_model: list of 3D arrays
+    u_model: 4D array or list of 3D arrays
         Float array with u component of wind field from model
-    v_model: list of 3D arrays
+    v_model: 4D array or list of 3D arrays
         Float array with v component of wind field from model
-    w_model: list of 3D arrays
+    w_model: 4D array or list of 3D arrays
         Float array with w component of wind field from model
     coeff: float
         Weighting coefficient
@@ -953,11 +963,9 @@ def calculate_model_cost(u, v, w, weights, u_model, v_model, w_model,
         Value of model cost function
     """
 
-    cost = 0
-    for i in range(len(u_model)):
-        cost += (coeff*np.sum(np.square(u-u_model[i])*weights[i] +
-                              np.square(v-v_model[i])*weights[i]))
-    return cost
+    weights, u_model, v_model = _stack_models(
+        u.shape, weights, u_model, v_model)
+    return _model_cost(u, v, weights, u_model, v_model, coeff)
 
 
 def calculate_model_gradient(u, v, w, weights, u_model,
@@ -969,6 +977,7 @@ def calculate_model_gradient(u, v, w, weights, u_model,
     Vertical velocities are not factored into this cost function as there is
     typically a high amount of uncertainty in model derived vertical
     velocities. Therefore, the gradient for all of the w's will be 0.
+    Masked model points are left out, as they are in the cost function.
 
     Parameters
     ----------
@@ -978,13 +987,13 @@ def calculate_model_gradient(u, v, w, weights, u_model,
         Float array with v component of wind field
     w: Float array
         Float array with w component of wind field
-    weights: list of 3D float arrays
+    weights: 4D float array or list of 3D float arrays
         Weights for each point to consider into cost function
-    u_model: list of 3D float arrays
+    u_model: 4D float array or list of 3D float arrays
         Zonal wind field from model
-    v_model: list of 3D float arrays
+    v_model: 4D float array or list of 3D float arrays
         Meridional wind field from model
-    w_model: list of 3D float arrays
+    w_model: 4D float array or list of 3D float arrays
         Vertical wind field from model
     coeff: float
         Weight of background constraint to total cost function
@@ -994,13 +1003,59 @@ def calculate_model_gradient(u, v, w, weights, u_model,
     y: float array
         value of gradient of background cost function
     """
-    the_shape = u.shape
-    u_grad = np.zeros(the_shape)
-    v_grad = np.zeros(the_shape)
-    w_grad = np.zeros(the_shape)
-    for i in range(len(u_model)):
-        u_grad += coeff*2*(u-u_model[i])*weights[i]
-        v_grad += coeff*2*(v-v_model[i])*weights[i]
-
-    y = np.stack([u_grad, v_grad, w_grad], axis=0)
+    weights, u_model, v_model = _stack_models(
+        u.shape, weights, u_model, v_model)
+    return _model_gradient(u, v, weights, u_model, v_model, coeff)
+
+
+# The model cost for weights and model winds that are already stacked by
+# _stack_models. get_dd_wind_field stacks them once before the solver
+# starts, so the cost function calls this directly. The models are done
+# one at a time so that the temporary arrays are the size of one grid.
+def _model_cost(u, v, weights, u_model, v_model, coeff):
+    cost = 0.
+    diff = np.empty(u.shape)
+    square = np.empty(u.shape)
+    for i in range(len(weights)):
+        np.subtract(u, u_model[i], out=diff)
+        np.square(diff, out=square)
+        np.subtract(v, v_model[i], out=diff)
+        square += np.square(diff, out=diff)
+        square *= weights[i]
+        cost += square.sum()
+    return coeff*cost
+
+
+# The model gradient for weights and model winds that are already stacked
+# by _stack_models
+def _model_gradient(u, v, weights, u_model, v_model, coeff):
+    y = np.zeros((3,) + u.shape)
+    diff = np.empty(u.shape)
+    for i in range(len(weights)):
+        for wind, model, grad in ((u, u_model[i], y[0]),
+                                  (v, v_model[i], y[1])):
+            np.subtract(wind, model, out=diff)
+            diff *= weights[i]
+            grad += diff
+    y *= coeff*2
     return y.flatten()
+
+
+# Gets the model weights and winds as arrays with the models stacked along
+# the first axis. Masked model points are given no weight, so they count
+# in neither the cost nor the gradient.
+def _stack_models(the_shape, weights, *model_fields):
+    arrays = []
+    mask = False
+    for field in (weights,) + model_fields:
+        if (np.ma.isMaskedArray(field) or
+                any(np.ma.isMaskedArray(f) for f in field)):
+            mask = mask | np.ma.getmaskarray(np.ma.asarray(field))
+            field = np.ma.filled(np.ma.asarray(field), 0)
+        field = np.asarray(field)
+        if field.shape == the_shape:
+            field = field[np.newaxis]
+        arrays.append(field)
+    if mask is not False:
+        arrays[0] = np.where(np.reshape(mask, arrays[0].shape), 0, arrays[0])
+    return arrays
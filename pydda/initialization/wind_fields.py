@@ -2,7 +2,9 @@ import numpy as np
 import pyart
 import gc
 import os
+import logging
 import tempfile
+import shutil
 
 # We want cfgrib to be an optional dependency to ensure Windows compatibility
 try:
@@ -21,14 +23,20 @@ except:
 
 from netCDF4 import Dataset
 from datetime import datetime, timedelta
-from scipy.interpolate import RegularGridInterpolator, interp1d, griddata
-from scipy.interpolate import NearestNDInterpolator
+from scipy.interpolate import RegularGridInterpolator, interp1d
 from copy import deepcopy
+from ..constraints.interpolation import _nearest_indices
+from ..constraints.model_data import _interpolate_wrf_winds
+from ..constraints.model_data import _read_era_window
+from ..constraints.model_data import _read_hrrr_window
+from ..constraints.model_cache import ERACache, _make_era_request
 
+logger = logging.getLogger(__name__)
 
 
 def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None,
-                                         dest_era_file=None):
+                                         dest_era_file=None,
+                                         era_cache_dir=None):
     """
     This function will read ERA Interim in NetCDF format and add it
     to the Py-ART grid specified by Grid. PyDDA will automatically download
@@ -57,6 +65,11 @@ def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None,
         have Py-DDA attempt to automatically detect it.
     dest_era_file:
         If this is not None, PyDDA will save the interpolated grid into this file.
+    era_cache_dir: str or None
+        The directory of an :class:`pydda.constraints.ERACache` to keep the
+        downloaded ERA Interim data in. Data that is already in the cache,
+        including files downloaded for a longer period or a larger area, is
+        not downloaded again. This is not used if file_name is specified.
     Returns
     -------
     new_Grid: Py-ART Grid
@@ -67,12 +80,13 @@ def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None,
     if vel_field is None:
         vel_field = pyart.config.get_field_name('corrected_velocity')
 
-    if ECMWF_AVAILABLE is False and file_name is None:
-        raise (ModuleNotFoundError,
-               ("The ECMWF API is not installed. Go to" +
-                "https://confluence.ecmwf.int/display/WEBAPI" +
-                "/Access+ECMWF+Public+Datasets" +
-                " in order to use the auto download feature."))
+    if (ECMWF_AVAILABLE is False and file_name is None and
+            era_cache_dir is None):
+        raise ModuleNotFoundError(
+            "The ECMWF API is not installed. Go to" +
+            "https://confluence.ecmwf.int/display/WEBAPI" +
+            "/Access+ECMWF+Public+Datasets" +
+            " in order to use the auto download feature.")
 
     grid_time = datetime.strptime(Grid.time["units"],
                                   "seconds since %Y-%m-%dT%H:%M:%SZ")
@@ -94,85 +108,53 @@ def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None,
             raise FileNotFoundError(file_name + " not found!")
 
     if file_name is None:
-        print("Download ERA Interim data...")
-        # ERA interim data is in pressure coordinates
-        # Retrieve u, v, w, and geopotential
-        # Geopotential is needed to convert into height coordinates
-
-        retrieve_dict = {}
-        retrieve_dict['stream'] = "oper"
-        retrieve_dict['levtype'] = "pl"
-        retrieve_dict['param'] = "131.128/132.128/135.128/129.128"
-        retrieve_dict['dataset'] = "interim"
-        retrieve_dict['levelist'] = ("1/2/3/5/7/10/20/30/50/70/100/125/150/" +
-                                     "175/200/225/250/300/350/400/450/500/" +
-                                     "550/600/650/700/750/775/800/825/850/" +
-                                     "875/900/925/950/975/1000")
-        retrieve_dict['step'] = "%d" % grid_time.hour
-        retrieve_dict['date'] = grid_time.strftime("%Y-%m-%d")
-        retrieve_dict['class'] = "ei"
-        retrieve_dict['grid'] = "0.75/0.75"
-        N = "%4.1f" % Grid.point_latitude["data"].max()
-        S = "%4.1f" % Grid.point_latitude["data"].min()
-        E = "%4.1f" % Grid.point_longitude["data"].max()
-        W = "%4.1f" % Grid.point_longitude["data"].min()
-
-        retrieve_dict['area'] = N + "/" + W + "/" + S + "/" + E
-        retrieve_dict['format'] = "netcdf"
-        if dest_era_file is not None:
-            retrieve_dict['target'] = dest_era_file
-            file_name = dest_era_file
+        retrieve_dict = _make_era_request(
+            Grid, grid_time.strftime("%Y-%m-%d"), step="%d" % grid_time.hour)
+        if era_cache_dir is not None:
+            file_name = ERACache(era_cache_dir).get(retrieve_dict)
+            if dest_era_file is not None:
+                shutil.copyfile(file_name, dest_era_file)
         else:
-            tfile = tempfile.NamedTemporaryFile()
-            retrieve_dict['target'] = tfile.name
-            file_name = tfile.name
-        server = ECMWFDataServer()
-        server.retrieve(retrieve_dict)
+            logger.info("Downloading ERA Interim data")
+            if dest_era_file is not None:
+                retrieve_dict['target'] = dest_era_file
+                file_name = dest_era_file
+            else:
+                tfile = tempfile.NamedTemporaryFile()
+                retrieve_dict['target'] = tfile.name
+                file_name = tfile.name
+            server = ECMWFDataServer()
+            server.retrieve(retrieve_dict)
 
     ERA_grid = Dataset(file_name, mode='r')
-    base_time = datetime.strptime(ERA_grid.variables["time"].units,
-                                  "hours since %Y-%m-%d %H:%M:%S.%f")
-    time_seconds = ERA_grid.variables["time"][:]
-    our_time = np.array([base_time + timedelta(seconds=int(x)) for x in time_seconds])
-    time_step = np.argmin(np.abs(base_time - grid_time))
+    height_ERA, u_ERA, v_ERA, w_ERA, lat_ERA, lon_ERA = _read_era_window(
+        ERA_grid, Grid, grid_time)
 
     analysis_grid_shape = Grid.fields[vel_field]['data'].shape
 
-    height_ERA = ERA_grid.variables["z"][:]
-    u_ERA = ERA_grid.variables["u"][:]
-    v_ERA = ERA_grid.variables["v"][:]
-    w_ERA = ERA_grid.variables["w"][:]
-    lon_ERA = ERA_grid.variables["longitude"][:]
-    lat_ERA = ERA_grid.variables["latitude"][:]
     radar_grid_lat = Grid.point_latitude['data']
     radar_grid_lon = Grid.point_longitude['data']
     radar_grid_alt = Grid.point_z['data']
-    u_flattened = u_ERA[time_step].flatten()
-    v_flattened = v_ERA[time_step].flatten()
-    w_flattened = w_ERA[time_step].flatten()
+    u_flattened = u_ERA.flatten()
+    v_flattened = v_ERA.flatten()
+    w_flattened = w_ERA.flatten()
 
     the_shape = u_ERA.shape
     lon_mgrid, lat_mgrid = np.meshgrid(lon_ERA, lat_ERA)
 
-    lon_mgrid = np.tile(lon_mgrid, (the_shape[1], 1, 1))
-    lat_mgrid = np.tile(lat_mgrid, (the_shape[1], 1, 1))
+    lon_mgrid = np.tile(lon_mgrid, (the_shape[0], 1, 1))
+    lat_mgrid = np.tile(lat_mgrid, (the_shape[0], 1, 1))
     lon_flattened = lon_mgrid.flatten()
     lat_flattened = lat_mgrid.flatten()
-    height_flattened = height_ERA[time_step].flatten()
+    height_flattened = height_ERA.flatten()
     height_flattened -= Grid.radar_altitude["data"]
 
-    u_interp = NearestNDInterpolator(
+    nearest = _nearest_indices(
         (height_flattened, lat_flattened, lon_flattened),
-        u_flattened, rescale=True)
-    v_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        v_flattened, rescale=True)
-    w_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        w_flattened, rescale=True)
-    u_new = u_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    v_new = v_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    w_new = w_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+        (radar_grid_alt, radar_grid_lat, radar_grid_lon))
+    u_new = u_flattened[nearest]
+    v_new = v_flattened[nearest]
+    w_new = w_flattened[nearest]
 
     # Free up memory
     ERA_grid.close()
@@ -339,12 +321,6 @@ def make_background_from_wrf(Grid, file_path, wrf_time,
 
     # Load WRF grid
     wrf_cdf = Dataset(file_path, mode='r')
-    W_wrf = wrf_cdf.variables['W'][:]
-    V_wrf = wrf_cdf.variables['V'][:]
-    U_wrf = wrf_cdf.variables['U'][:]
-    PH_wrf = wrf_cdf.variables['PH'][:]
-    PHB_wrf = wrf_cdf.variables['PHB'][:]
-    alt_wrf = (PH_wrf+PHB_wrf)/9.81
 
     new_grid_x = Grid.point_x['data']
     new_grid_y = Grid.point_y['data']
@@ -363,30 +339,10 @@ def make_background_from_wrf(Grid, file_path, wrf_time,
     if(len(timestep[0]) == 0):
         raise ValueError(("Time " + str(wrf_time) + " not found in WRF file!"))
 
-    x_len = wrf_cdf.__getattribute__('WEST-EAST_GRID_DIMENSION')
-    y_len = wrf_cdf.__getattribute__('SOUTH-NORTH_GRID_DIMENSION')
-    dx = wrf_cdf.DX
-    dy = wrf_cdf.DY
-    x = np.arange(0, x_len)*dx-radar_loc[0]*1e3
-    y = np.arange(0, y_len)*dy-radar_loc[1]*1e3
-    z = np.mean(alt_wrf[timestep[0], :, :, :], axis=(0, 2, 3))
-    x, y, z = np.meshgrid(x, y, z)
-    z = np.squeeze(alt_wrf[timestep[0], :, :, :])
-
-    z_stag = (z[1:, :, :]+z[:-1, :, :])/2.0
-    x_stag = (x[:, :, 1:]+x[:, :, :-1])/2.0
-    y_stag = (y[:, 1:, :]+y[:, :-1, :])/2.0
-
-    W_wrf = np.squeeze(W_wrf[timestep[0], :, :, :])
-    V_wrf = np.squeeze(V_wrf[timestep[0], :, :, :])
-    U_wrf = np.squeeze(U_wrf[timestep[0], :, :, :])
-
-    w = griddata((z_stag, y, x), W_wrf,
-                 (new_grid_z, new_grid_y, new_grid_x), fill_value=0.)
-    v = griddata((z, y_stag, x), V_wrf,
-                 (new_grid_z, new_grid_y, new_grid_x), fill_value=0.)
-    u = griddata((z, y, x_stag), U_wrf,
-                 (new_grid_z, new_grid_y, new_grid_x), fill_value=0.)
+    u, v, w = _interpolate_wrf_winds(
+        wrf_cdf, timestep[0][0], radar_loc,
+        (new_grid_z, new_grid_y, new_grid_x))
+    wrf_cdf.close()
 
     return u, v, w
 
@@ -409,7 +365,13 @@ def make_intialization_from_hrrr(Grid, file_path):
     Grid: Py-ART Grid
         This returns the Py-ART grid with the HRRR u, and v fields added.
         The shape will be the same shape as the fields in Grid and will
-        correspond to the same x, y, and z locations as in Grid.
+        correspond to the same x, y, and z locations as in Grid. The w
+        field is the HRRR vertical velocity. Versions of PyDDA before
+        the interpolation was shared with the HRRR constraint returned
+        the meridional wind as w. The HRRR levels are placed at their
+        geometric height above the radar, found from the geopotential
+        height, where older versions used the geopotential height above
+        sea level.
     """
 
     if(CFGRIB_AVAILABLE is False):
@@ -419,66 +381,21 @@ def make_intialization_from_hrrr(Grid, file_path):
     the_grib = cfgrib.open_file(
         file_path, filter_by_keys={'typeOfLevel': 'isobaricInhPa'})
 
-    # Load the HRR data and tranform longitude coordinates
-    grb_u = the_grib.variables['u']
-    grb_v = the_grib.variables['v']
-    grb_w = the_grib.variables['w']
-    gh = the_grib.variables['gh']
-
-    lat = the_grib.variables['latitude'].data[:, :]
-    lon = the_grib.variables['longitude'].data[:, :]
-    lon[lon > 180] = lon[lon > 180] - 360
-
-    # Convert geometric height to geopotential height
-    EARTH_MEAN_RADIUS = 6.3781e6
-    gh = gh.data[:, :, :]
-    height = (EARTH_MEAN_RADIUS*gh)/(EARTH_MEAN_RADIUS-gh)
-    height = height - Grid.radar_altitude['data']
-
-    radar_grid_lat = Grid.point_latitude['data']
-    radar_grid_lon = Grid.point_longitude['data']
-    radar_grid_alt = Grid.point_z['data']
-    lat_min = radar_grid_lat.min()
-    lat_max = radar_grid_lat.max()
-    lon_min = radar_grid_lon.min()
-    lon_max = radar_grid_lon.max()
-    lon_r = np.tile(lon, (height.shape[0], 1, 1))
-    lat_r = np.tile(lat, (height.shape[0], 1, 1))
-    lon_flattened = lon_r.flatten()
-    lat_flattened = lat_r.flatten()
-    height_flattened = gh.flatten()
-    the_box = np.where(np.logical_and.reduce(
-                       (lon_flattened >= lon_min,
-                        lat_flattened >= lat_min,
-                        lon_flattened <= lon_max,
-                        lat_flattened <= lat_max)))[0]
-
-    lon_flattened = lon_flattened[the_box]
-    lat_flattened = lat_flattened[the_box]
-    height_flattened = height_flattened[the_box]
-
-    u_flattened = grb_u.data[:, :, :].flatten()
-    u_flattened = u_flattened[the_box]
-    u_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        u_flattened, rescale=True)
-    u_new = u_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-
-    v_flattened = grb_v.data[:, :, :].flatten()
-    v_flattened = v_flattened[the_box]
-    v_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        v_flattened, rescale=True)
-    v_new = v_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+    # Only read the HRRR columns around the analysis grid
+    (height_flattened, lat_flattened, lon_flattened,
+     u_flattened, v_flattened, w_flattened) = _read_hrrr_window(
+        the_grib, Grid)
 
-    w_flattened = grb_v.data[:, :, :].flatten()
-    w_flattened = w_flattened[the_box]
-    w_interp = NearestNDInterpolator(
+    # Find the nearest HRRR point to each grid point once and use it
+    # for every variable
+    nearest = _nearest_indices(
         (height_flattened, lat_flattened, lon_flattened),
-        w_flattened, rescale=True)
-    w_new = w_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+        (Grid.point_z['data'], Grid.point_latitude['data'],
+         Grid.point_longitude['data']))
+    u_new = u_flattened[nearest]
+    v_new = v_flattened[nearest]
+    w_new = w_flattened[nearest]
 
-    del grb_u, grb_v, grb_w, lat, lon
     del the_grib
     gc.collect()
 
@@ -19,10 +19,18 @@ how to call these functions.
     get_dd_wind_field_nested
     get_bca
     DDParameters
+    RetrievalResult
+    RetrievalState
+    plan_retrieval
+    RetrievalPlan
 
 """
 
 from .wind_retrieve import get_dd_wind_field
 from .wind_retrieve import get_bca
 from .wind_retrieve import DDParameters
+from .wind_retrieve import RetrievalResult
+from .wind_retrieve import RetrievalState
 from .nesting import get_dd_wind_field_nested
+from .planner import plan_retrieval
+from .planner import RetrievalPlan
@@ -1,148 +1,633 @@
 import numpy as np
 import pyart
-import os
 import gc
-import glob
-
-from distributed import Client, wait
-from scipy.interpolate import griddata
-from copy import deepcopy
-from datetime import datetime
-from .wind_retrieve import get_dd_wind_field
-
-
-# Reduces the resolution of a PyART grid
+import time
+import os
+import logging
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# distributed is only needed when the nests are run on a dask cluster.
+try:
+    from distributed import Client
+    from distributed import as_completed as dask_as_completed
+    DISTRIBUTED_AVAILABLE = True
+except ImportError:
+    DISTRIBUTED_AVAILABLE = False
+
+# threadpoolctl lets us limit the number of threads that NumPy and SciPy's
+# BLAS libraries use on each worker so that the nests do not oversubscribe
+# the available cores.
+try:
+    from threadpoolctl import threadpool_limits
+    THREADPOOLCTL_AVAILABLE = True
+except ImportError:
+    THREADPOOLCTL_AVAILABLE = False
+
+# psutil is used to find the physical memory of the machine, which
+# os.sysconf cannot do on every platform.
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+from .wind_retrieve import get_dd_wind_field, RetrievalResult
+from .wind_retrieve import _make_output_grids, _make_shared_grid
+
+logger = logging.getLogger(__name__)
+
+
+# Averages data over blocks of skip_factor by skip_factor points in the
+# horizontal. Masked and non-finite points are left out of the averages
+# and blocks with no valid points are masked. Fields that are not floats,
+# such as masks and categories, cannot be averaged, so the point nearest
+# the center of each block is taken to match _block_coordinates.
+def _block_average(data, skip_factor):
+    y_starts = np.arange(0, data.shape[1], skip_factor)
+    x_starts = np.arange(0, data.shape[2], skip_factor)
+    if not np.issubdtype(data.dtype, np.floating):
+        center = (skip_factor - 1) // 2
+        y_centers = np.minimum(y_starts + center, data.shape[1] - 1)
+        x_centers = np.minimum(x_starts + center, data.shape[2] - 1)
+        return data[:, y_centers][:, :, x_centers]
+
+    valid = ~np.ma.getmaskarray(data) & np.isfinite(np.ma.getdata(data))
+    sums = np.add.reduceat(np.add.reduceat(
+        np.where(valid, np.ma.getdata(data), 0), y_starts, axis=1),
+        x_starts, axis=2)
+    counts = np.add.reduceat(np.add.reduceat(
+        valid.astype(int), y_starts, axis=1), x_starts, axis=2)
+    means = sums / np.where(counts > 0, counts, 1)
+    if np.ma.isMaskedArray(data) or np.any(counts == 0):
+        means = np.ma.masked_where(counts == 0, means)
+    return means
+
+
+# Gets the coordinates of the centers of blocks of skip_factor points
+# along an axis. The coarse coordinates are kept evenly spaced.
+def _block_coordinates(coords, skip_factor):
+    num_blocks = int(np.ceil(len(coords) / skip_factor))
+    if len(coords) < 2:
+        return coords[:num_blocks].copy()
+    spacing = coords[1] - coords[0]
+    return (coords[0] + spacing * (skip_factor - 1) / 2. +
+            spacing * skip_factor * np.arange(num_blocks)).astype(
+                coords.dtype)
+
+
+# Reduces the resolution of a PyART grid by averaging over blocks of
+# skip_factor by skip_factor points. The new Grid shares the metadata of
+# the original Grid, so nothing is copied besides the coarsened fields.
 def _reduce_pyart_grid_res(Grid, skip_factor):
-    Grid2 = deepcopy(Grid)
     field_dict = {}
-    for field_name in Grid2.fields.keys():
-        field_dict[field_name] = Grid2.fields[field_name].copy()
-        field_dict[field_name]["data"] = Grid2.fields[field_name]["data"][
-            :, ::skip_factor, ::skip_factor]
-
-    x = Grid2.x
-    x["data"] = x["data"][::skip_factor]
-    y = Grid2.y
-    y["data"] = y["data"][::skip_factor]
-    z = Grid2.z
-    z["data"] = z["data"]
-    metadata = Grid2.metadata
-    origin_latitude = Grid2.origin_latitude
-    origin_longitude = Grid2.origin_longitude
-    origin_altitude = Grid2.origin_altitude
-    projection = Grid2.projection
-    radar_latitude = Grid2.radar_latitude
-    radar_longitude = Grid2.radar_longitude
-    radar_altitude = Grid2.radar_altitude
-    radar_time = Grid2.radar_time
-    radar_name = Grid2.radar_name
-    gtime = Grid2.time
-    new_grid = pyart.core.Grid(
-        gtime, field_dict, metadata, origin_latitude, origin_longitude,
-        origin_altitude, x, y, z, projection, radar_latitude, radar_longitude,
-        radar_altitude, radar_time, radar_name)
-    del Grid2
-    return new_grid
-
-
-# Splits a Py-ART Grid
-def _split_pyart_grid(Grid, split_factor, axis=1):
-    grid_splits = []
-    split_field = {}
-    Grid2 = deepcopy(Grid)
-    for field_name in Grid2.fields.keys():
-        if isinstance(Grid2.fields[field_name]["data"], np.ma.MaskedArray):
-            no_mask = Grid2.fields[field_name]["data"].filled(np.nan).copy()
-        else:
-            no_mask = Grid2.fields[field_name]["data"].copy()
-        split_field[field_name] = np.array_split(
-            no_mask, split_factor, axis=axis)
-        if isinstance(Grid2.fields[field_name]["data"], np.ma.MaskedArray):
-            split_field[field_name] = [np.ma.masked_where(
-                np.isnan(arr), arr) for arr in split_field[field_name]]
-    x = Grid2.x
-    y = Grid2.y
-    z = Grid2.z
-    x_split = np.array_split(x["data"], split_factor)
-    y_split = np.array_split(y["data"], split_factor)
-    z_split = np.array_split(z["data"], split_factor)
-    gtime = Grid2.time
-    metadata = Grid2.metadata
-    origin_latitude = Grid2.origin_latitude
-    origin_longitude = Grid2.origin_longitude
-    origin_altitude = Grid2.origin_altitude
-    projection = Grid2.projection
-    radar_latitude = Grid2.radar_latitude
-    radar_longitude = Grid2.radar_longitude
-    radar_altitude = Grid2.radar_altitude
-    radar_time = Grid2.radar_time
-    radar_name = Grid2.radar_name
-    for i in range(split_factor):
-        grid_dic = {}
-
-        for field_name in Grid2.fields.keys():
-            grid_dic[field_name] = Grid2.fields[field_name].copy()
-            grid_dic[field_name]["data"] = split_field[field_name][i]
-        x_dic = x.copy()
-        y_dic = y.copy()
-        z_dic = z.copy()
-        if(axis == 1):
-            y_dic["data"] = y_split[i]
-        elif(axis == 2):
-            x_dic["data"] = x_split[i]
-        elif(axis == 0):
-            z_dic["data"] = z_split[i]
-
-        new_grid = pyart.core.Grid(
-            gtime, grid_dic, metadata, origin_latitude, origin_longitude,
-            origin_altitude, x_dic, y_dic, z_dic, projection, radar_latitude,
-            radar_longitude, radar_altitude, radar_time, radar_name)
-        grid_splits.append(new_grid)
-
-    return grid_splits
-
-
-# Concatenates Py-ART Grids
-def _concatenate_pyart_grids(grid_list, axis=1):
-    new_grid = deepcopy(grid_list[0])
-    for field_name in new_grid.fields.keys():
-        new_grid.fields[field_name]["data"] = np.ma.concatenate(
-            [x.fields[field_name]["data"] for x in grid_list], axis=axis)
-    if(axis == 2):
-        new_grid.x["data"] = np.ma.concatenate(
-            [x.x["data"] for x in grid_list])
-        new_grid.nx = np.sum([x.nx for x in grid_list])
-    elif(axis == 1):
-        new_grid.y["data"] = np.ma.concatenate(
-            [x.y["data"] for x in grid_list])
-        new_grid.ny = np.sum([x.ny for x in grid_list])
-    elif(axis == 0):
-        new_grid.z["data"] = np.ma.concatenate(
-            [x.z["data"] for x in grid_list])
-        new_grid.nz = np.sum([x.nz for x in grid_list])
-    return new_grid
+    for field_name in Grid.fields.keys():
+        field_dict[field_name] = Grid.fields[field_name].copy()
+        field_dict[field_name]["data"] = _block_average(
+            Grid.fields[field_name]["data"], skip_factor)
+
+    x = Grid.x.copy()
+    x["data"] = _block_coordinates(Grid.x["data"], skip_factor)
+    y = Grid.y.copy()
+    y["data"] = _block_coordinates(Grid.y["data"], skip_factor)
+    return pyart.core.Grid(
+        Grid.time, field_dict, Grid.metadata, Grid.origin_latitude,
+        Grid.origin_longitude, Grid.origin_altitude, x, y, Grid.z,
+        Grid.projection, Grid.radar_latitude, Grid.radar_longitude,
+        Grid.radar_altitude, Grid.radar_time, Grid.radar_name)
+
+
+# Linearly interpolates data along one axis from the coordinates in
+# coarse to the coordinates in fine. Points outside of coarse are given
+# the value at the nearest edge.
+def _interp_axis(data, coarse, fine, axis):
+    if len(coarse) == 1:
+        return np.repeat(data, len(fine), axis=axis)
+    index = np.interp(fine, coarse, np.arange(len(coarse)))
+    lower = np.clip(np.floor(index).astype(int), 0, len(coarse) - 2)
+    frac = index - lower
+    shape = [1, 1, 1]
+    shape[axis] = len(fine)
+    frac = np.reshape(frac, shape)
+    return (np.take(data, lower, axis=axis) * (1 - frac) +
+            np.take(data, lower + 1, axis=axis) * frac)
+
+
+# Trilinearly interpolates a field on a coarse Py-ART Grid onto a finer one.
+# Both grids are regular, so this is done one axis at a time.
+def _prolongate_field(data, coarse_grid, fine_grid):
+    data = np.ma.getdata(data)
+    for axis, coord in enumerate(['z', 'y', 'x']):
+        data = _interp_axis(data, getattr(coarse_grid, coord)["data"],
+                            getattr(fine_grid, coord)["data"], axis)
+    return data
+
+
+# Makes a Py-ART Grid with only the given fields
+def _subset_pyart_grid(Grid, field_names):
+    fields = dict([(field_name, Grid.fields[field_name])
+                   for field_name in field_names
+                   if field_name in Grid.fields])
+    return _make_shared_grid(Grid, fields)
+
+
+# Gets the names of the fields that get_dd_wind_field uses
+def _get_needed_fields(kwargs):
+    vel_name = kwargs.get('vel_name', None)
+    refl_field = kwargs.get('refl_field', None)
+    if vel_name is None:
+        vel_name = pyart.config.get_field_name('corrected_velocity')
+    if refl_field is None:
+        refl_field = pyart.config.get_field_name('reflectivity')
+
+    needed_fields = [vel_name, refl_field]
+    model_fields = kwargs.get('model_fields', None)
+    if model_fields is not None:
+        for the_field in model_fields:
+            needed_fields += ["U_" + the_field, "V_" + the_field,
+                              "W_" + the_field]
+    return needed_fields
+
+
+# Does the retrieval on one nest. If fixed_columns is given, the winds in
+# the columns where it is True are held at their initial values.
+# tile_budget is the time in seconds that the nest has, which the worker
+# counts on its own clock since it may not agree with the client's.
+def _retrieve_tile(tile_grids, winds, tile_budget, kwargs, blas_threads=None,
+                   fixed_columns=None):
+    fixed_points = None
+    if fixed_columns is not None:
+        fixed_points = np.broadcast_to(fixed_columns, winds[0].shape)
+    if blas_threads is not None and THREADPOOLCTL_AVAILABLE:
+        with threadpool_limits(limits=blas_threads, user_api='blas'):
+            new_result = get_dd_wind_field(
+                tile_grids, winds[0], winds[1], winds[2],
+                time_budget=tile_budget, return_result=True,
+                output_mode='wind', fixed_points=fixed_points, **kwargs)
+    else:
+        new_result = get_dd_wind_field(
+            tile_grids, winds[0], winds[1], winds[2], time_budget=tile_budget,
+            return_result=True, output_mode='wind',
+            fixed_points=fixed_points, **kwargs)
+    gc.collect()
+    return new_result
+
+
+# Estimates the peak memory in bytes that get_dd_wind_field needs for a grid
+# of grid_shape. Per grid point, each radar has about 9 arrays (the input
+# fields, azimuth, elevation, fall speed and weights), and the retrieval
+# itself needs about 132 arrays, which is mostly the L-BFGS-B work arrays
+# and the temporary arrays in the cost functions.
+def _estimate_retrieval_memory(grid_shape, num_radars):
+    num_points = np.prod(grid_shape, dtype=float)
+    return 8 * num_points * (132 + 9 * num_radars)
+
+
+# Gets the physical memory of this machine in bytes, or np.inf if it
+# cannot be found
+def _get_total_memory():
+    if PSUTIL_AVAILABLE:
+        return float(psutil.virtual_memory().total)
+    try:
+        return float(os.sysconf('SC_PAGE_SIZE') *
+                     os.sysconf('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        logger.warning("Cannot find the physical memory of this machine, " +
+                       "so the memory per worker is not limited.")
+        return np.inf
+
+
+# Gets the memory in bytes available to each worker of executor
+def _get_worker_memory(executor, num_workers=None):
+    if _is_dask_client(executor):
+        limits = [worker['memory_limit'] for worker in
+                  executor.scheduler_info()['workers'].values()]
+        limits = [limit for limit in limits if limit]
+        if len(limits) > 0:
+            return min(limits)
+    return _get_total_memory() / _get_num_workers(executor, num_workers)
+
+
+# Chooses the number of levels and the number of splits on the finest level
+# so that each nest and the retrieval on the coarsest level fit in
+# max_memory, with at least one nest for each worker on the finest level
+def _plan_levels(grid_shape, num_radars, num_workers, max_memory,
+                 reduction_factor=2, halo=0):
+    nz, ny, nx = grid_shape
+    num_splits = max(int(np.ceil(np.sqrt(num_workers))), 1)
+    while num_splits < min(ny, nx) // 4 and _estimate_retrieval_memory(
+            (nz, ny // num_splits + 2 * halo, nx // num_splits + 2 * halo),
+            num_radars) > max_memory:
+        num_splits += 1
+
+    num_levels = 2
+    coarse_shape = (nz, ny // reduction_factor, nx // reduction_factor)
+    while (min(coarse_shape[1:]) >= 4 * reduction_factor and
+           _estimate_retrieval_memory(coarse_shape, num_radars) > max_memory):
+        num_levels += 1
+        coarse_shape = (nz, coarse_shape[1] // reduction_factor,
+                        coarse_shape[2] // reduction_factor)
+    return num_levels, num_splits
+
+
+# Chooses the reduction factor out of reduction_factors that gives the
+# fastest estimated nested retrieval that fits in max_memory, or the one
+# that needs the least memory if none of them fit
+def _choose_reduction_factor(grid_shape, num_radars, num_workers, max_memory,
+                             halo, kwargs, reduction_factors=(2, 3, 4)):
+    # The planner imports this module, so it is imported here
+    from .planner import _plan_nested
+    num_iterations = (kwargs.get('max_iterations', 200) +
+                      10 * kwargs.get('filt_iterations', 2))
+    plans = [_plan_nested(grid_shape, num_radars, num_workers, max_memory,
+                          num_iterations, reduction_factor, halo)
+             for reduction_factor in reduction_factors]
+    feasible_plans = [plan for plan in plans if plan.feasible]
+    if len(feasible_plans) == 0:
+        return min(plans, key=lambda plan: plan.estimated_memory
+                   ).reduction_factor
+    return min(feasible_plans, key=lambda plan: plan.estimated_time
+               ).reduction_factor
+
+
+# Checks whether executor is a dask distributed Client
+def _is_dask_client(executor):
+    return DISTRIBUTED_AVAILABLE and isinstance(executor, Client)
+
+
+# Gets the number of nests that executor will run at the same time. The
+# standard library executors keep their number of workers in _max_workers.
+# Other executors are taken to have one worker per core unless num_workers
+# is given.
+def _get_num_workers(executor, num_workers=None):
+    if num_workers is not None:
+        return max(int(num_workers), 1)
+    if executor is None:
+        return 1
+    if _is_dask_client(executor):
+        return max(sum(executor.nthreads().values()), 1)
+    max_workers = getattr(executor, '_max_workers', None)
+    if max_workers is not None:
+        return max(int(max_workers), 1)
+    logger.warning("Cannot find the number of workers of %s, so it is " +
+                   "taken to be the number of cores. Pass num_workers " +
+                   "to set it.", type(executor).__name__)
+    return os.cpu_count() or 1
+
+
+# Gets the number of BLAS threads to give to each nest. On a dask cluster,
+# the cores of each host are divided among the threads of the workers on
+# that host, and the smallest share over the hosts is used.
+def _get_blas_threads(blas_threads, executor, num_workers=None):
+    if blas_threads != 'auto':
+        return blas_threads
+    if executor is None:
+        return None
+    if _is_dask_client(executor):
+        workers = executor.scheduler_info()['workers']
+        cpu_counts = executor.run(os.cpu_count)
+        host_threads = {}
+        host_cores = {}
+        for address, worker in workers.items():
+            host = worker['host']
+            host_threads[host] = host_threads.get(host, 0) + \
+                worker['nthreads']
+            host_cores[host] = cpu_counts.get(address) or 1
+        if len(host_threads) == 0:
+            return None
+        return max(min([host_cores[host] // max(host_threads[host], 1)
+                        for host in host_threads]), 1)
+    return max((os.cpu_count() or 1) //
+               _get_num_workers(executor, num_workers), 1)
+
+
+# Runs the retrieval on each nest with executor and yields the index of
+# each nest in tile_args along with its result as the nests finish.
+# tile_args is a list of (tile_grids, winds, fixed_columns) tuples.
+# threadpool_limits changes the BLAS threads of the whole process, so it is
+# only done inside each nest when the nests run in their own processes.
+# Otherwise the nests share this process and the limit is set once around
+# the whole run so that the nests do not race to set and restore it.
+def _run_tiles(executor, tile_args, deadline, kwargs, blas_threads,
+               num_workers=1):
+    if (blas_threads is None or not THREADPOOLCTL_AVAILABLE or
+            _is_dask_client(executor) or
+            isinstance(executor, ProcessPoolExecutor)):
+        yield from _submit_tiles(executor, tile_args, deadline, kwargs,
+                                 blas_threads, num_workers)
+        return
+    with threadpool_limits(limits=blas_threads, user_api='blas'):
+        yield from _submit_tiles(executor, tile_args, deadline, kwargs,
+                                 None, num_workers)
+
+
+# Gets the time in seconds that the nest started index-th out of
+# num_tiles can use. The nests run in waves of num_workers, so the time left
+# before deadline on this machine's clock is shared equally between this
+# nest's wave and the waves after it.
+def _get_tile_budget(deadline, index, num_tiles, num_workers):
+    if deadline is None:
+        return None
+    num_workers = max(num_workers, 1)
+    waves_left = (int(np.ceil(num_tiles / float(num_workers))) -
+                  index // num_workers)
+    return max(deadline - time.time(), 0.) / max(waves_left, 1)
+
+
+# Submits the nests to executor for _run_tiles. Only num_workers nests are
+# submitted at a time and the next one is submitted as each one finishes,
+# so each nest's share of the time left before the deadline is worked out
+# when it starts rather than when it was queued.
+def _submit_tiles(executor, tile_args, deadline, kwargs, blas_threads,
+                  num_workers):
+    if executor is None:
+        for i, (tgrids, winds, fixed) in enumerate(tile_args):
+            yield i, _retrieve_tile(
+                tgrids, winds,
+                _get_tile_budget(deadline, i, len(tile_args), 1), kwargs,
+                blas_threads, fixed)
+        return
+
+    is_dask = _is_dask_client(executor)
+
+    def submit(i):
+        tgrids, winds, fixed = tile_args[i]
+        if is_dask:
+            # Ship each nest to the cluster's memory instead of through
+            # temporary files. Each scatter is of a single list so each
+            # nest is one future.
+            tgrids = executor.scatter([tgrids])[0]
+            winds = executor.scatter([winds])[0]
+        return executor.submit(
+            _retrieve_tile, tgrids, winds,
+            _get_tile_budget(deadline, i, len(tile_args), num_workers),
+            kwargs, blas_threads, fixed)
+
+    logger.info("Waiting for nested grid to be retrieved...")
+    next_tile = min(max(num_workers, 1), len(tile_args))
+    futures_array = [submit(i) for i in range(next_tile)]
+    if is_dask:
+        index = dict([(future.key, i)
+                      for i, future in enumerate(futures_array)])
+        finished = dask_as_completed(futures_array, with_results=True)
+        for future, result in finished:
+            i = index.pop(future.key)
+            future.release()
+            if next_tile < len(tile_args):
+                new_future = submit(next_tile)
+                index[new_future.key] = next_tile
+                finished.add(new_future)
+                next_tile += 1
+            yield i, result
+        return
+
+    index = dict([(future, i) for i, future in enumerate(futures_array)])
+    pending = set(futures_array)
+    del futures_array
+    while len(pending) > 0:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            i = index.pop(future)
+            if next_tile < len(tile_args):
+                new_future = submit(next_tile)
+                index[new_future] = next_tile
+                pending.add(new_future)
+                next_tile += 1
+            yield i, future.result()
+
+
+# Makes a Py-ART Grid of the region given by the (y, x) slices in
+# tile_slices. The fields are views into the fields of Grid.
+def _extract_pyart_grid(Grid, tile_slices):
+    y_slice, x_slice = tile_slices
+    fields = {}
+    for field_name in Grid.fields.keys():
+        fields[field_name] = Grid.fields[field_name].copy()
+        fields[field_name]["data"] = Grid.fields[field_name]["data"][
+            :, y_slice, x_slice]
+    x = Grid.x.copy()
+    x["data"] = Grid.x["data"][x_slice]
+    y = Grid.y.copy()
+    y["data"] = Grid.y["data"][y_slice]
+    return pyart.core.Grid(
+        Grid.time, fields, Grid.metadata, Grid.origin_latitude,
+        Grid.origin_longitude, Grid.origin_altitude, x, y, Grid.z,
+        Grid.projection, Grid.radar_latitude, Grid.radar_longitude,
+        Grid.radar_altitude, Grid.radar_time, Grid.radar_name)
+
+
+# Gets the start and end index of each split along an axis of length n
+def _split_edges(n, num_splits):
+    sizes = [len(a) for a in np.array_split(np.arange(n), num_splits)]
+    return np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+
+
+# Gets the start and end index of each split along an axis so that each
+# split has about the same total work. Each split is at least min_width
+# points wide when the axis is long enough.
+def _balanced_edges(work, num_splits, min_width=4):
+    n = len(work)
+    min_width = max(min(min_width, n // num_splits), 1)
+    cumulative_work = np.cumsum(work, dtype=float)
+    targets = cumulative_work[-1] * np.arange(1, num_splits) / num_splits
+    edges = np.concatenate(
+        [[0], np.searchsorted(cumulative_work, targets) + 1, [n]])
+    for k in range(1, num_splits):
+        edges[k] = max(edges[k], edges[k-1] + min_width)
+    for k in range(num_splits - 1, 0, -1):
+        edges[k] = min(edges[k], edges[k+1] - min_width)
+    return edges.astype(int)
+
+
+# Gets the amount of work in each column of the analysis grid, which is
+# one for each grid point plus the number of radar observations.
+def _get_column_work(grid_list, vel_name):
+    work = np.full((grid_list[0].ny, grid_list[0].nx),
+                   grid_list[0].nz, dtype=float)
+    for G in grid_list:
+        work += np.sum(~np.ma.getmaskarray(G.fields[vel_name]["data"]),
+                       axis=0)
+    return work
+
+
+# Gets the (y, x) slices of each nest without (inner) and with (outer)
+# a halo of halo points. The nests are ordered along y first, then x.
+# If the work in each column is given, the x splits are chosen so that each
+# strip has the same work, and then the y splits within each strip.
+def _get_tiles(ny, nx, num_splits, halo=0, work=None):
+    if work is None:
+        x_edges = _split_edges(nx, num_splits)
+        y_edges = [_split_edges(ny, num_splits)] * num_splits
+    else:
+        x_edges = _balanced_edges(work.sum(axis=0), num_splits)
+        y_edges = [_balanced_edges(
+            work[:, x_edges[i]:x_edges[i+1]].sum(axis=1), num_splits)
+            for i in range(num_splits)]
+    tiles = []
+    for i in range(num_splits):
+        for j in range(num_splits):
+            inner = (slice(y_edges[i][j], y_edges[i][j+1]),
+                     slice(x_edges[i], x_edges[i+1]))
+            outer = (slice(max(y_edges[i][j] - halo, 0),
+                           min(y_edges[i][j+1] + halo, ny)),
+                     slice(max(x_edges[i] - halo, 0),
+                           min(x_edges[i+1] + halo, nx)))
+            tiles.append((outer, inner))
+    return tiles
+
+
+# Gets the blending weights of a nest along one axis. The weights are 1
+# inside of the nest and taper linearly to 0 across the halo.
+def _taper_weights(outer, inner):
+    n = outer.stop - outer.start
+    weights = np.ones(n)
+    left = inner.start - outer.start
+    right = outer.stop - inner.stop
+    if left > 0:
+        weights[:left] = np.arange(1, left + 1) / (left + 1.)
+    if right > 0:
+        weights[n - right:] = np.arange(right, 0, -1) / (right + 1.)
+    return weights
+
+
+class _TileStitcher(object):
+    """
+    Stitches the wind fields retrieved on each nest into output arrays that
+    are allocated once, as each nest finishes. Without a halo, each nest is
+    copied into place. With a halo, the nests are blended together using a
+    weighted average where they overlap.
+    """
+    def __init__(self, grid_shape, blend=False):
+        self.blend = blend
+        self.field_dicts = {}
+        self.data = {}
+        self.weight_sums = {}
+        for field_name in ['u', 'v', 'w']:
+            self.data[field_name] = np.zeros(grid_shape)
+            if blend:
+                self.weight_sums[field_name] = np.zeros(
+                    grid_shape, dtype=np.float32)
+            else:
+                self.weight_sums[field_name] = np.zeros(
+                    grid_shape, dtype=bool)
+
+    def add(self, outer, inner, wind_grid):
+        """ Adds the wind fields retrieved on one nest. """
+        if self.blend:
+            weights = (_taper_weights(outer[0], inner[0])[:, np.newaxis] *
+                       _taper_weights(outer[1], inner[1])[np.newaxis, :])
+        # The interior of the nest relative to the nest's own grid
+        interior = (slice(None),
+                    slice(inner[0].start - outer[0].start,
+                          inner[0].stop - outer[0].start),
+                    slice(inner[1].start - outer[1].start,
+                          inner[1].stop - outer[1].start))
+        for field_name in ['u', 'v', 'w']:
+            field = wind_grid.fields[field_name]
+            if field_name not in self.field_dicts:
+                self.field_dicts[field_name] = field.copy()
+            if self.blend:
+                valid = ~np.ma.getmaskarray(field["data"])
+                tile_weights = np.where(valid, weights, 0)
+                self.data[field_name][:, outer[0], outer[1]] += \
+                    tile_weights * np.ma.getdata(field["data"])
+                self.weight_sums[field_name][:, outer[0], outer[1]] += \
+                    tile_weights
+            else:
+                self.data[field_name][:, inner[0], inner[1]] = \
+                    np.ma.getdata(field["data"])[interior]
+                self.weight_sums[field_name][:, inner[0], inner[1]] = \
+                    ~np.ma.getmaskarray(field["data"])[interior]
+
+    def finish(self):
+        """ Returns the stitched u, v and w field dictionaries. """
+        fields = {}
+        for field_name in ['u', 'v', 'w']:
+            data = self.data.pop(field_name)
+            weight_sum = self.weight_sums.pop(field_name)
+            if self.blend:
+                np.divide(data, weight_sum, out=data, where=weight_sum > 0)
+            fields[field_name] = self.field_dicts[field_name]
+            fields[field_name]["data"] = np.ma.masked_where(
+                weight_sum == 0, data, copy=False)
+            del weight_sum
+        return fields
+
+
+# Does the retrieval on every nest with the given initial winds and
+# stitches the nests together. If pin_halo is True, the winds in the halo
+# of each nest are held at their initial values and only the interior of
+# each nest is kept, otherwise the nests are blended where they overlap.
+def _retrieve_tiles(tiles, subset_grids, winds, executor, deadline, kwargs,
+                    blas_threads, halo, pin_halo=False, num_workers=1):
+    tile_args = []
+    for outer, inner in tiles:
+        fixed = None
+        if pin_halo:
+            fixed = np.ones((outer[0].stop - outer[0].start,
+                             outer[1].stop - outer[1].start), dtype=bool)
+            fixed[inner[0].start - outer[0].start:
+                  inner[0].stop - outer[0].start,
+                  inner[1].start - outer[1].start:
+                  inner[1].stop - outer[1].start] = False
+        tile_args.append(
+            ([_extract_pyart_grid(G, outer) for G in subset_grids],
+             tuple([init[:, outer[0], outer[1]] for init in winds]), fixed))
+
+    # Copy each nest into the output as soon as it is finished so that the
+    # stitching overlaps with the nests that are still running.
+    stitcher = _TileStitcher(winds[0].shape,
+                             blend=(halo > 0 and not pin_halo))
+    tile_results = [None] * len(tiles)
+    for i, tile_result in _run_tiles(executor, tile_args, deadline, kwargs,
+                                     blas_threads, num_workers):
+        stitcher.add(tiles[i][0], tiles[i][1], tile_result.grids[0])
+        tile_result.grids = None
+        tile_results[i] = tile_result
+    del tile_args
+    return stitcher.finish(), tile_results
+
+
+# Gets the root mean square difference between two sets of winds in the
+# columns where the nests overlap
+def _get_overlap_mismatch(tiles, old_winds, new_winds):
+    count = np.zeros(old_winds[0].shape[1:], dtype=int)
+    for outer, inner in tiles:
+        count[outer] += 1
+    overlap = count > 1
+    if not np.any(overlap):
+        return 0.
+    squared_diff = [np.mean((np.ma.getdata(new)[:, overlap] -
+                             np.ma.getdata(old)[:, overlap])**2)
+                    for old, new in zip(old_winds, new_winds)]
+    return np.sqrt(np.mean(squared_diff))
 
 
 # Procedure: 1. Do first pass of retrieval on reduced resolution grid
 # 2. Then, we use the reduced resolution retrieval as an input to the
 # high resolution retrieval in each region
 # Finally, we check for continuity at the boundaries
-def get_dd_wind_field_nested(grid_list, u_init, v_init, w_init, client,
-                             reduction_factor=2, num_splits=2, **kwargs):
+def get_dd_wind_field_nested(grid_list, u_init, v_init, w_init, client=None,
+                             reduction_factor=2, num_splits=2, halo=0,
+                             time_budget=None, executor=None,
+                             blas_threads='auto', tile_balance='area',
+                             schwarz_iterations=0, schwarz_tol=0.1,
+                             num_levels=2, max_memory=None,
+                             num_workers=None, **kwargs):
     """
     This function performs a wind retrieval using a nested domain.
     This is useful for grids that are larger than about 500 by 500
     by 40 points, since the use of larger grids on a single machine
     will exceed memory limitations.
 
-    This procedure relies on a dask distributed cluster to be set up.
-    The retrieval is first performed at a resolution that is coarser
-    than the analysis grid by reduction_factor. This provides the
-    initial state for the nested loop.
+    The nests can be run on a dask distributed cluster, on any
+    concurrent.futures Executor, or one at a time. The retrieval is first
+    performed at a resolution that is coarser than the analysis grid by
+    reduction_factor. This provides the initial state for the nested loop.
 
     The domain is split into num_splits**2 sub-domains for the nested
-    retrieval step, and each nested retrieval is mapped onto a distributed
-    worker for parallel processing. If NumPy and SciPy are already set up to
+    retrieval step, and each nested retrieval is mapped onto a worker
+    for parallel processing. If NumPy and SciPy are already set up to
     use parallel numerical analysis libraries, it is recommended that a single
     machine be dedicated to each nest rather than a single core
     for best performance.
@@ -160,136 +645,269 @@ def get_dd_wind_field_nested(grid_list, u_init, v_init, w_init, client,
     w_init: 3D NumPy array
        The initial guess of the vertical wind field. This has to be in the same
        shape as the analysis grid.
-    client: dask distributed Client
+    client: dask distributed Client or None
        The distributed Client that is linked to a distributed cluster. The
        :cluster must be running before get_dd_wind_field_nested is called.
        The retrieval on each nest will be mapped onto each worker. Since
        the optimization loop already takes advantage of parallelism, it's
-       best to allow at least 16 cores per one worker.
-    reduction_factor: int
+       best to allow at least 16 cores per one worker. This is the same
+       as passing the Client as executor.
+    reduction_factor: int or 'auto'
        How much to reduce the factor of the analysis grid by when doing the
-       initial retrieval on the entire grid.
+       initial retrieval on the entire grid. The same factor is used between
+       every pair of levels. Set to 'auto' along with num_levels to choose
+       the factor out of 2, 3 and 4 that gives the fastest estimated
+       retrieval that fits in max_memory.
     num_splits: int
        The number of splits to make through each axis when doing the nesting.
+    halo: int
+       The number of grid points that each nest is extended by into its
+       neighbors. The overlapping regions are blended together with weights
+       that taper off across the halo, which removes the seams that appear
+       at the nest boundaries since the derivatives in the cost functions
+       are truncated there. This allows for more splits to be used.
+    time_budget: float or None
+       The wall clock time in seconds that the nested retrieval has to finish
+       in. The budget is shared between the coarse retrieval and the nests
+       in proportion to their number of grid points and the number of waves
+       of nests that the workers have to run. Each nest is given an equal
+       share of the time left before the deadline between its wave and the
+       waves after it, which the worker counts on its own clock. See
+       get_dd_wind_field for how the solver behaves under a time budget.
+       Set to None to disable.
+    executor: dask distributed Client, concurrent.futures.Executor or None
+       What to run the nests on. This can be a dask distributed Client,
+       any concurrent.futures Executor such as a ProcessPoolExecutor for
+       single node jobs, or None to retrieve the nests one at a time.
+       Executors are not shut down by PyDDA.
+    blas_threads: int, 'auto' or None
+       The number of threads that the BLAS library may use when retrieving
+       each nest. 'auto' divides the cores on the machine by the number of
+       nests that the executor runs at the same time, or on a dask cluster,
+       the cores of each host by the threads of the workers on that host.
+       Set to None to leave the thread count alone. This requires
+       threadpoolctl to be installed.
+    tile_balance: str
+       How to choose the boundaries of the nests. 'area' splits each axis
+       into num_splits pieces of equal length. 'coverage' chooses the
+       boundaries so that each nest has about the same number of grid
+       points plus radar observations, so that nests over the storm do not
+       take much longer than nests over clear air. In either case the nests
+       with the most work are started first.
+    schwarz_iterations: int
+       The maximum number of additive Schwarz iterations to do after the
+       nests are first retrieved. Each iteration retrieves every nest again
+       in parallel, starting from the stitched winds and with the winds in
+       its halo held at the values retrieved by its neighbors, so that
+       information is exchanged across the nest boundaries. This requires
+       halo to be greater than 0.
+    schwarz_tol: float
+       The Schwarz iterations stop once the root mean square change of the
+       winds where the nests overlap is less than this value in m/s.
+    num_levels: int or 'auto'
+       The number of levels of resolution to use. With 2 levels, the
+       retrieval on the grid coarsened by reduction_factor seeds the nests on
+       the analysis grid. With more levels, the coarse retrieval is itself
+       done as a nested retrieval on a grid that is reduction_factor times
+       coarser again, and so on, with about the same nest size on each
+       level. Set to 'auto' to choose the number of levels and num_splits
+       so that each nest and the coarsest retrieval fit in max_memory and
+       every worker has at least one nest. The reduction factor is also
+       chosen if reduction_factor is 'auto'.
+    max_memory: float or None
+       The memory in bytes that each worker can use when num_levels is
+       'auto'. Set to None to use the memory limit of the dask workers,
+       or the physical memory divided by the number of workers otherwise.
+    num_workers: int or None
+       The number of nests that executor runs at the same time. Only this
+       many nests are submitted at once. This is also used to choose the
+       number of splits when num_levels is 'auto' and the number of BLAS
+       threads when blas_threads is 'auto'. Set to None to use the number
+       of threads of the dask workers or the max_workers of a standard
+       library executor. Other executors need this to be given, or they
+       are taken to have one worker per core.
 
     **kwargs: dict
         This function will take the same keyword arguments as
         get_dd_wind_field, as these arguments are passed into each call of
         get_dd_wind_field. See get_dd_wind_field for more information on the
+        keyword arguments. If return_result is True, a RetrievalResult
+        summarizing the coarse retrieval and all of the nests is returned.
     """
+    bt = time.time()
+    if client is not None:
+        if executor is not None:
+            raise ValueError("Only one of client and executor can be given!")
+        executor = client
+    if executor is not None and not isinstance(executor, Executor) and \
+            not _is_dask_client(executor):
+        raise TypeError(("executor must be a dask distributed Client, a " +
+                         "concurrent.futures.Executor or None!"))
+    if schwarz_iterations > 0 and halo < 1:
+        raise ValueError("halo must be at least 1 for Schwarz iterations!")
+    if tile_balance not in ['area', 'coverage']:
+        raise ValueError("tile_balance must be 'area' or 'coverage'!")
+    if reduction_factor == 'auto' and num_levels != 'auto':
+        raise ValueError("reduction_factor can only be 'auto' when " +
+                         "num_levels is 'auto'!")
+    if num_levels == 'auto':
+        if max_memory is None:
+            max_memory = _get_worker_memory(executor, num_workers)
+        if reduction_factor == 'auto':
+            reduction_factor = _choose_reduction_factor(
+                u_init.shape, len(grid_list),
+                _get_num_workers(executor, num_workers), max_memory, halo,
+                kwargs)
+        num_levels, num_splits = _plan_levels(
+            u_init.shape, len(grid_list),
+            _get_num_workers(executor, num_workers),
+            max_memory, reduction_factor, halo)
+        logger.info(("Using %d levels with a reduction factor of %d and " +
+                     "%d splits on the finest level"),
+                    num_levels, reduction_factor, num_splits)
+    elif num_levels < 2:
+        raise ValueError("num_levels must be at least 2 or 'auto'!")
+    blas_threads = _get_blas_threads(blas_threads, executor, num_workers)
+    if blas_threads is not None and not THREADPOOLCTL_AVAILABLE:
+        logger.warning("threadpoolctl is not installed, so the number of " +
+                       "BLAS threads per nest cannot be limited.")
+        blas_threads = None
+
+    return_result = kwargs.pop('return_result', False)
+    output_mode = kwargs.pop('output_mode', 'copy')
+    deadline = None
+    coarse_budget = None
+    if time_budget is not None:
+        deadline = bt + time_budget
+        # The nests run in waves of as many nests as there are workers
+        num_waves = np.ceil(num_splits**2 / float(
+            _get_num_workers(executor, num_workers)))
+        coarse_fraction = (1. / reduction_factor**2) / (
+            1. / reduction_factor**2 + num_waves / num_splits**2)
+        coarse_budget = coarse_fraction * time_budget
+
     # First, we do retrieval on whole grid with fraction of resolution
     grid_lo_res_list = [_reduce_pyart_grid_res(G, reduction_factor)
                         for G in grid_list]
 
-    first_pass = get_dd_wind_field(
-        grid_lo_res_list, u_init[::, ::reduction_factor, ::reduction_factor],
-        v_init[::, ::reduction_factor, ::reduction_factor],
-        w_init[::, ::reduction_factor, ::reduction_factor], **kwargs)
+    if num_levels > 2:
+        # The coarse retrieval is itself nested, with nests that are about
+        # the same size as the ones on this level
+        first_result = get_dd_wind_field_nested(
+            grid_lo_res_list,
+            _block_average(u_init, reduction_factor),
+            _block_average(v_init, reduction_factor),
+            _block_average(w_init, reduction_factor),
+            reduction_factor=reduction_factor,
+            num_splits=int(np.ceil(num_splits / reduction_factor)),
+            halo=halo, time_budget=coarse_budget, executor=executor,
+            blas_threads=blas_threads, tile_balance=tile_balance,
+            schwarz_iterations=schwarz_iterations, schwarz_tol=schwarz_tol,
+            num_levels=num_levels - 1, num_workers=num_workers,
+            return_result=True, output_mode='wind', **kwargs)
+    else:
+        first_result = get_dd_wind_field(
+            grid_lo_res_list,
+            _block_average(u_init, reduction_factor),
+            _block_average(v_init, reduction_factor),
+            _block_average(w_init, reduction_factor),
+            time_budget=coarse_budget, return_result=True,
+            output_mode='wind', **kwargs)
+    first_pass = first_result.grids
+    coarse_time = time.time() - bt
 
     # Take the first pass field and regrid to analysis field
-    reduced_x = first_pass[0].point_x["data"].flatten()
-    reduced_y = first_pass[0].point_y["data"].flatten()
-    reduced_z = first_pass[0].point_z["data"].flatten()
-    x = grid_list[0].point_x["data"].flatten()
-    y = grid_list[0].point_y["data"].flatten()
-    z = grid_list[0].point_z["data"].flatten()
-    u_init_new = griddata((reduced_z, reduced_y, reduced_x),
-                          first_pass[0].fields["u"]["data"].flatten(),
-                          (z, y, x), method='nearest')
-    v_init_new = griddata((reduced_z, reduced_y, reduced_x),
-                          first_pass[0].fields["v"]["data"].flatten(),
-                          (z, y, x), method='nearest')
-    w_init_new = griddata((reduced_z, reduced_y, reduced_x),
-                          first_pass[0].fields["w"]["data"].flatten(),
-                          (z, y, x), method='nearest')
-    u_init_new = np.reshape(u_init_new, u_init.shape)
-    v_init_new = np.reshape(v_init_new, v_init.shape)
-    w_init_new = np.reshape(w_init_new, w_init.shape)
-
-    # Finally, split the analysis into num_splits**2 pieces and save
-    # as temporary files
-    tempfile_name_base = datetime.now().strftime('%y%m%d.%H%M%S')
-    tiny_grids = []
-    k = 0
-    for G in grid_list:
-        cur_list = []
-        split_grids_x = _split_pyart_grid(G, num_splits, axis=2)
-        i = 0
-        for sgrid in split_grids_x:
-            g_list = _split_pyart_grid(sgrid, num_splits)
-            grid_fns = []
-            j = 0
-            for g in g_list:
-                fn = (tempfile_name_base + str(k) + '.' +
-                      str(i) + '.' + str(j) + '.nc')
-                pyart.io.write_grid((tempfile_name_base + str(k) +
-                                     '.' + str(i) + '.' + str(j) + '.nc'), g)
-                j = j + 1
-                grid_fns.append(fn)
-            cur_list.append(grid_fns)
-            i = i + 1
-        del split_grids_x, g_list
-
-        k = k + 1
-        tiny_grids.append(cur_list)
-
-    # Temporarily save the tiny grids and free up memory...we want to
-    # load these when we are running it on the cluster
-
-    u_init_split_x = np.array_split(u_init_new, num_splits, axis=2)
-    u_init_split = [np.array_split(ux, num_splits, axis=1)
-                    for ux in u_init_split_x]
-    w_init_split_x = np.array_split(w_init_new, num_splits, axis=2)
-    w_init_split = [np.array_split(wx, num_splits, axis=1)
-                    for wx in w_init_split_x]
-    v_init_split_x = np.array_split(v_init_new, num_splits, axis=2)
-    v_init_split = [np.array_split(vx, num_splits, axis=1)
-                    for vx in v_init_split_x]
+    u_init_new, v_init_new, w_init_new = [
+        _prolongate_field(first_pass[0].fields[field_name]["data"],
+                          first_pass[0], grid_list[0])
+        for field_name in ['u', 'v', 'w']]
+
+    # Finally, split the analysis into num_splits**2 pieces. Only the
+    # fields that the retrieval needs are sent to the workers.
+    needed_fields = _get_needed_fields(kwargs)
+    subset_grids = [_subset_pyart_grid(G, needed_fields) for G in grid_list]
+    if tile_balance == 'coverage':
+        vel_name = kwargs.get('vel_name', None)
+        if vel_name is None:
+            vel_name = pyart.config.get_field_name('corrected_velocity')
+        work = _get_column_work(grid_list, vel_name)
+    else:
+        work = np.ones((grid_list[0].ny, grid_list[0].nx))
+    tiles = _get_tiles(grid_list[0].ny, grid_list[0].nx, num_splits, halo,
+                       work if tile_balance == 'coverage' else None)
+
+    # Start the nests with the most work first so that the executor is not
+    # left waiting on one large nest at the end.
+    tiles = sorted(tiles, key=lambda tile: -work[tile[0]].sum())
+    del work
 
     # Clear out unneeded variables (do not need lo-res grids in memory anymore)
-    del u_init_split_x, w_init_split_x, v_init_split_x
-    del first_pass, reduced_x, reduced_y, reduced_z, x, y, z, grid_lo_res_list
+    del first_pass, grid_lo_res_list
     gc.collect()
 
-    # Serial just for testing, need to use dask in future
-    tiny_retrieval = []
+    wind_fields, tile_results = _retrieve_tiles(
+        tiles, subset_grids, (u_init_new, v_init_new, w_init_new), executor,
+        deadline, kwargs, blas_threads, halo,
+        num_workers=_get_num_workers(executor, num_workers))
+    del u_init_new, v_init_new, w_init_new
+
+    # Exchange the winds in the halos between neighboring nests until
+    # the nests agree where they overlap
+    mismatch = []
+    for k in range(schwarz_iterations):
+        if deadline is not None and time.time() >= deadline:
+            logger.warning("No time left for more Schwarz iterations")
+            break
+        old_winds = [wind_fields[field_name]["data"]
+                     for field_name in ['u', 'v', 'w']]
+        wind_fields, sweep_results = _retrieve_tiles(
+            tiles, subset_grids, [np.ma.getdata(wind) for wind in old_winds],
+            executor, deadline, kwargs, blas_threads, halo, pin_halo=True,
+            num_workers=_get_num_workers(executor, num_workers))
+        tile_results += sweep_results
+        mismatch.append(_get_overlap_mismatch(
+            tiles, old_winds, [wind_fields[field_name]["data"]
+                               for field_name in ['u', 'v', 'w']]))
+        del old_winds
+        logger.info("Schwarz iteration %d: mismatch = %3.4f m/s",
+                    k + 1, mismatch[-1])
+        if mismatch[-1] < schwarz_tol:
+            break
+    del subset_grids
+
+    new_grid_list = _make_output_grids(
+        grid_list, wind_fields['u'], wind_fields['v'], wind_fields['w'],
+        output_mode)
+
+    if return_result is True:
+        result = _combine_results(new_grid_list, first_result, tile_results,
+                                  coarse_time, time.time() - bt)
+        result.schwarz_mismatch = mismatch
+        return result
 
-    def do_tiny_retrieval(i, j):
-        tgrids = [pyart.io.read_grid(tiny_grids[k][i][j])
-                  for k in range(len(grid_list))]
-        new_grids = get_dd_wind_field(
-            tgrids, u_init_split[i][j], v_init_split[i][j],
-            w_init_split[i][j], **kwargs)
-        del tgrids
-        gc.collect()
-        return new_grids
-
-    futures_array = []
-    for i in range(num_splits):
-        for j in range(num_splits):
-            futures_array.append(client.submit(do_tiny_retrieval, i, j))
-
-    print("Waiting for nested grid to be retrieved...")
-    wait(futures_array)
-    tiny_retrieval2 = client.gather(futures_array)
-    tiny_retrieval = []
-
-    for i in range(num_splits):
-        new_grid_list = []
-
-        for j in range(len(grid_list)):
-            new_grid_list.append(_concatenate_pyart_grids(
-                [tiny_retrieval2[k+i*num_splits][j]
-                 for k in range(0, num_splits)], axis=1))
-        tiny_retrieval.append(new_grid_list)
-
-    new_grid_list = []
-    for i in range(len(grid_list)):
-        new_grid_list.append(_concatenate_pyart_grids(
-            [tiny_retrieval[k][i] for k in range(num_splits)], axis=2))
+    return new_grid_list
 
-    tempfile_list = glob.glob(tempfile_name_base + "*")
-    for fn in tempfile_list:
-        os.remove(fn)
 
-    return new_grid_list
+def _combine_results(new_grid_list, first_result, tile_results, coarse_time,
+                     total_time):
+    """
+    Summarizes the coarse retrieval and the retrievals on each nest
+    into one RetrievalResult.
+    """
+    all_results = [first_result] + list(tile_results)
+    result = RetrievalResult()
+    result.grids = new_grid_list
+    result.iterations = sum([r.iterations for r in all_results])
+    result.function_evaluations = sum(
+        [r.function_evaluations for r in all_results])
+    result.converged = all([r.converged for r in all_results])
+    result.deadline_reached = any([r.deadline_reached for r in all_results])
+    reasons = [r.convergence_reason for r in all_results]
+    for reason in ['time_budget', 'max_iterations', 'w_tolerance']:
+        if reason in reasons:
+            result.convergence_reason = reason
+            break
+    result.timings['coarse'] = coarse_time
+    result.timings['nested'] = total_time - coarse_time
+    result.timings['total'] = total_time
+    return result
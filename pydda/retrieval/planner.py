@@ -0,0 +1,217 @@
+import numpy as np
+import logging
+
+from .wind_retrieve import get_dd_wind_field
+from .nesting import get_dd_wind_field_nested
+from .nesting import _estimate_retrieval_memory, _plan_levels
+from .nesting import _get_worker_memory, _get_num_workers
+
+logger = logging.getLogger(__name__)
+
+# The rough wall clock time in seconds of one solver iteration per grid
+# point with two radars, measured on a single core
+_SECONDS_PER_POINT_ITERATION = 1.2e-6
+
+
+# Estimates the wall clock time in seconds of get_dd_wind_field for a grid
+# of grid_shape
+def _estimate_retrieval_time(grid_shape, num_radars, num_iterations):
+    num_points = np.prod(grid_shape, dtype=float)
+    return (_SECONDS_PER_POINT_ITERATION * (2. + num_radars) / 4. *
+            num_points * num_iterations)
+
+
+class RetrievalPlan(object):
+    """
+    This class describes how to run a wind retrieval so that it fits in
+    memory. It is returned by :func:`pydda.retrieval.plan_retrieval`.
+
+    Attributes
+    ----------
+    method: str
+        'direct' to call :func:`pydda.retrieval.get_dd_wind_field` on the
+        whole grid, or 'nested' to call
+        :func:`pydda.retrieval.get_dd_wind_field_nested`.
+    reduction_factor: int or None
+        The reduction_factor to use for a nested retrieval.
+    num_splits: int or None
+        The num_splits to use for a nested retrieval.
+    num_levels: int or None
+        The num_levels to use for a nested retrieval.
+    halo: int
+        The halo to use for a nested retrieval.
+    estimated_memory: float
+        The estimated peak memory in bytes that each worker needs.
+    estimated_time: float
+        The estimated wall clock time of the retrieval in seconds.
+    max_memory: float
+        The memory in bytes that each worker has.
+    feasible: bool
+        True if the retrieval is estimated to fit in max_memory.
+    """
+    def __init__(self, method='direct', reduction_factor=None,
+                 num_splits=None, num_levels=None, halo=0,
+                 estimated_memory=0., estimated_time=0., max_memory=np.inf):
+        self.method = method
+        self.reduction_factor = reduction_factor
+        self.num_splits = num_splits
+        self.num_levels = num_levels
+        self.halo = halo
+        self.estimated_memory = estimated_memory
+        self.estimated_time = estimated_time
+        self.max_memory = max_memory
+        self.feasible = estimated_memory <= max_memory
+
+    def __repr__(self):
+        if self.method == 'direct':
+            options = ''
+        else:
+            options = (', reduction_factor=%d, num_splits=%d, num_levels=%d'
+                       % (self.reduction_factor, self.num_splits,
+                          self.num_levels))
+        return ('RetrievalPlan(method=%r%s, estimated_memory=%.3g GB, ' +
+                'estimated_time=%.3g s)') % (
+                    self.method, options, self.estimated_memory / 1e9,
+                    self.estimated_time)
+
+    def execute(self, Grids, u_init, v_init, w_init, executor=None,
+                **kwargs):
+        """
+        Runs the retrieval according to this plan.
+
+        Parameters
+        ----------
+        Grids: list of Py-ART Grids
+            The Grids to retrieve the winds from.
+        u_init, v_init, w_init: 3D NumPy arrays
+            The initial guess of the wind field.
+        executor: dask distributed Client, concurrent.futures.Executor or None
+            What to run the nests of a nested retrieval on. See
+            :func:`pydda.retrieval.get_dd_wind_field_nested`.
+        **kwargs: dict
+            The keyword arguments to pass to
+            :func:`pydda.retrieval.get_dd_wind_field`.
+
+        Returns
+        -------
+        new_grid_list: list or RetrievalResult
+            The output of get_dd_wind_field or get_dd_wind_field_nested.
+        """
+        if not self.feasible:
+            logger.warning(("The retrieval needs about %.3g GB per worker, " +
+                            "which is more than the %.3g GB available"),
+                           self.estimated_memory / 1e9, self.max_memory / 1e9)
+        if self.method == 'direct':
+            return get_dd_wind_field(Grids, u_init, v_init, w_init, **kwargs)
+
+        return get_dd_wind_field_nested(
+            Grids, u_init, v_init, w_init, executor=executor,
+            reduction_factor=self.reduction_factor,
+            num_splits=self.num_splits, num_levels=self.num_levels,
+            halo=self.halo, **kwargs)
+
+
+def _plan_nested(grid_shape, num_radars, num_workers, max_memory,
+                 num_iterations, reduction_factor, halo):
+    """
+    Plans a nested retrieval with the given reduction factor and estimates
+    its peak memory per worker and its wall clock time.
+    """
+    num_levels, num_splits = _plan_levels(
+        grid_shape, num_radars, num_workers, max_memory, reduction_factor,
+        halo)
+    nz, ny, nx = grid_shape
+    memory = 0.
+    time = 0.
+    splits = num_splits
+    for level in range(num_levels):
+        if level == num_levels - 1:
+            # The coarsest level is retrieved directly
+            tile_shape = (nz, ny, nx)
+            num_waves = 1
+        else:
+            tile_shape = (nz, int(np.ceil(ny / splits)) + 2 * halo,
+                          int(np.ceil(nx / splits)) + 2 * halo)
+            num_waves = int(np.ceil(splits**2 / float(num_workers)))
+        memory = max(memory, _estimate_retrieval_memory(
+            tile_shape, num_radars))
+        time += num_waves * _estimate_retrieval_time(
+            tile_shape, num_radars, num_iterations)
+        ny = int(np.ceil(ny / reduction_factor))
+        nx = int(np.ceil(nx / reduction_factor))
+        splits = int(np.ceil(splits / reduction_factor))
+
+    return RetrievalPlan('nested', reduction_factor, num_splits, num_levels,
+                         halo, memory, time, max_memory)
+
+
+def plan_retrieval(Grids, max_memory=None, executor=None, num_workers=None,
+                   halo=0, reduction_factors=(2, 3, 4), **kwargs):
+    """
+    Chooses the fastest way to run a wind retrieval on Grids that fits in
+    memory. The peak memory and the wall clock time of a direct retrieval
+    using :func:`pydda.retrieval.get_dd_wind_field` and of nested
+    retrievals using :func:`pydda.retrieval.get_dd_wind_field_nested` are
+    estimated from the size of the grid, and the fastest plan that fits
+    in memory is returned. The estimates are rough, so leave some room
+    in max_memory.
+
+    Parameters
+    ==========
+    Grids: list of Py-ART Grids
+        The Grids to retrieve the winds from.
+    max_memory: float or None
+        The memory in bytes that each worker can use. Set to None to use
+        the memory limit of the dask workers, or the physical memory divided
+        by the number of workers otherwise.
+    executor: dask distributed Client, concurrent.futures.Executor or None
+        What the nests would be run on. This is used to find the number of
+        workers and the memory that each one has.
+    num_workers: int or None
+        The number of nests that can be retrieved at the same time. Set to
+        None to get this from executor.
+    halo: int
+        The halo to use for nested retrievals.
+    reduction_factors: tuple of ints
+        The reduction factors to consider for nested retrievals.
+    **kwargs: dict
+        The keyword arguments that will be passed to get_dd_wind_field.
+        max_iterations and filt_iterations are used to estimate the time.
+
+    Returns
+    =======
+    plan: RetrievalPlan
+        The plan for the retrieval. Use plan.execute to run it. If no plan
+        fits in memory, the plan that needs the least memory is returned
+        with plan.feasible set to False.
+    """
+    if num_workers is None:
+        num_workers = _get_num_workers(executor)
+    if max_memory is None:
+        max_memory = _get_worker_memory(executor, num_workers)
+
+    grid_shape = (Grids[0].nz, Grids[0].ny, Grids[0].nx)
+    num_radars = len(Grids)
+    num_iterations = (kwargs.get('max_iterations', 200) +
+                      10 * kwargs.get('filt_iterations', 2))
+
+    plans = [RetrievalPlan(
+        'direct', estimated_memory=_estimate_retrieval_memory(
+            grid_shape, num_radars),
+        estimated_time=_estimate_retrieval_time(
+            grid_shape, num_radars, num_iterations),
+        max_memory=max_memory)]
+    for reduction_factor in reduction_factors:
+        plans.append(_plan_nested(
+            grid_shape, num_radars, num_workers, max_memory, num_iterations,
+            reduction_factor, halo))
+
+    feasible_plans = [plan for plan in plans if plan.feasible]
+    if len(feasible_plans) == 0:
+        plan = min(plans, key=lambda plan: plan.estimated_memory)
+        logger.warning("No retrieval plan fits in %.3g GB per worker",
+                       max_memory / 1e9)
+    else:
+        plan = min(feasible_plans, key=lambda plan: plan.estimated_time)
+    logger.info("Chose %s", plan)
+    return plan
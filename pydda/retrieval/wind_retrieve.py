@@ -9,6 +9,8 @@ import numpy as np
 import time
 import cartopy.crs as ccrs
 import math
+import os
+import logging
 
 from .. import cost_functions
 from ..cost_functions import J_function, grad_J
@@ -17,7 +19,12 @@ from scipy.interpolate import interp1d
 from scipy.signal import savgol_filter
 from matplotlib import pyplot as plt
 from copy import deepcopy
+from concurrent.futures import Executor, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from .angles import add_azimuth_as_field, add_elevation_as_field
+from ..constraints.point_observations import PointObservations
+
+logger = logging.getLogger(__name__)
 
 
 class DDParameters(object):
@@ -43,12 +50,17 @@ class DDParameters(object):
         Background u wind
     v_back: 1D float array (number of vertical levels)
         Background u wind
-    u_model: list of 3D float arrays
-        U from each model integrated into the retrieval
-    v_model: list of 3D float arrays
-        V from each model integrated into the retrieval
-    w_model:
-        W from each model integrated into the retrieval
+    model_winds: n_models by 3 by z_bins by y_bins by x_bins float32 array
+        The u, v and w from each model integrated into the retrieval.
+    u_model: n_models by z_bins by y_bins by x_bins float32 array
+        U from each model integrated into the retrieval. This is a view
+        of model_winds.
+    v_model: n_models by z_bins by y_bins by x_bins float32 array
+        V from each model integrated into the retrieval. This is a view
+        of model_winds.
+    w_model: n_models by z_bins by y_bins by x_bins float32 array
+        W from each model integrated into the retrieval. This is a view
+        of model_winds.
     Co: float
         Weighting coefficient for data constraint.
     Cm: float
@@ -92,10 +104,9 @@ class DDParameters(object):
         Data weights for each pair of radars
     bg_weights: z_bins by y_bins x x_bins float array
         Data weights for sounding constraint
-    model_weights: n_models by z_bins by y_bins by x_bins float array
+    model_weights: n_models by z_bins by y_bins by x_bins float32 array
         Data weights for each model.
-    point_list: list or None
-        point_list: list of dicts
+    point_list: PointObservations or None
         List of point constraints. Each member is a dict with keys of "u", "v",
         to correspond to each component of the wind field and "x", "y", "z"
         to correspond to the location of the point observation in the Grid's
@@ -105,6 +116,15 @@ class DDParameters(object):
     upper_bc: bool
         True to enforce w=0 at top of domain (impermeability condition),
         False to not enforce impermeability at top of domain
+    print_out: bool
+        True to log the value of each cost function and the norm of the
+        gradient on every evaluation.
+    last_costs: dict
+        The value of each term of the cost function from the most recent
+        call to :func:`pydda.cost_functions.J_function`.
+    last_grad_norm: float
+        The infinity norm of the gradient from the most recent call to
+        :func:`pydda.cost_functions.grad_J`.
     """
     def __init__(self):
         self.Ut = np.nan
@@ -122,6 +142,7 @@ class DDParameters(object):
         self.weights = []
         self.bg_weights = []
         self.model_weights = []
+        self.model_winds = []
         self.u_model = []
         self.v_model = []
         self.w_model = []
@@ -146,6 +167,193 @@ class DDParameters(object):
         self.roi = 1000.0
         self.frz = 4500.0
         self.point_list = []
+        self.print_out = False
+        self.last_costs = {}
+        self.last_grad_norm = np.nan
+
+
+class RetrievalResult(object):
+    """
+    This class holds the output of :func:`pydda.retrieval.get_dd_wind_field`
+    together with diagnostics from the optimization loop. It is returned by
+    get_dd_wind_field when return_result is set to True and is also passed
+    to the progress_callback while the retrieval is running.
+
+    Attributes
+    ----------
+    grids: list of Py-ART Grids
+        The Py-ART Grids containing the retrieved wind fields. This is None
+        until the retrieval is finished.
+    cost_history: list of dicts
+        The value of each term of the cost function ("Jvel", "Jmass",
+        "Jsmooth", "Jbg", "Jvort", "Jmodel", "Jpoint") and the total cost
+        "J" after each iteration of the solver.
+    grad_norm_history: list of floats
+        The infinity norm of the gradient after each iteration of the solver.
+    timings: dict
+        The wall clock time in seconds spent in the "preprocessing", "solver",
+        "filter" and "output" stages of the retrieval, and in "total".
+    iterations: int
+        The number of iterations done by the solver, including the
+        iterations done after the low pass filter.
+    function_evaluations: int
+        The number of evaluations of the cost function and its gradient.
+    convergence_reason: str
+        Why the solver stopped. This is "max_iterations" when max_iterations
+        was reached, "w_tolerance" when the maximum vertical velocity
+        changed by less than 0.02 m/s over 10 iterations and "time_budget"
+        when the solver was stopped to stay within the time budget.
+    converged: bool
+        True if the solver stopped because the wind field converged.
+    deadline_reached: bool
+        True if the time budget cut the retrieval short, either by stopping
+        the solver or by shortening or skipping the iterations after the
+        low pass filter.
+    schwarz_mismatch: list of floats
+        For :func:`pydda.retrieval.get_dd_wind_field_nested`, the root mean
+        square change in m/s of the winds where the nests overlap after
+        each Schwarz iteration. This is empty otherwise.
+    """
+    def __init__(self):
+        self.grids = None
+        self.cost_history = []
+        self.grad_norm_history = []
+        self.timings = {}
+        self.iterations = 0
+        self.function_evaluations = 0
+        self.convergence_reason = None
+        self.converged = False
+        self.deadline_reached = False
+        self.schwarz_mismatch = []
+
+
+class RetrievalState(object):
+    """
+    This class holds the intermediate state of the retrieval that is passed
+    to the on_iteration hook of :func:`pydda.retrieval.get_dd_wind_field`.
+
+    The wind fields are views into the solver's control vector, so no copy
+    of the wind field is made. The solver keeps updating this array after
+    the hook returns, so make a copy of the winds (for example with
+    np.array(state.u)) if they need to be kept after the hook returns.
+
+    Attributes
+    ----------
+    iteration: int
+        The number of solver iterations done so far.
+    stage: str
+        "first_pass" before the low pass filter is applied, "filtered"
+        during the iterations after the low pass filter.
+    winds: 4D float array
+        The (3, nz, ny, nx) wind field.
+    u: 3D float array
+        The current zonal wind field.
+    v: 3D float array
+        The current meridional wind field.
+    w: 3D float array
+        The current vertical wind field.
+    costs: dict
+        The value of each term of the cost function at this iteration.
+    grad_norm: float
+        The infinity norm of the gradient at this iteration.
+    elapsed: float
+        Time in seconds since the retrieval started.
+    """
+    def __init__(self, iteration, stage, winds, costs, grad_norm, elapsed):
+        self.iteration = iteration
+        self.stage = stage
+        self.winds = winds
+        self.u = winds[0]
+        self.v = winds[1]
+        self.w = winds[2]
+        self.costs = costs
+        self.grad_norm = grad_norm
+        self.elapsed = elapsed
+
+
+class _DeadlineReached(Exception):
+    """ Raised by _SolverMonitor to stop the solver at the time budget. """
+    pass
+
+
+class _SolverMonitor(object):
+    """
+    Callback for the solver that records the cost function and gradient
+    norm of each iteration into a RetrievalResult. These are the values from
+    the solver's last evaluation, so no extra evaluations are needed.
+    Every iteration_interval iterations, the on_iteration hook is called
+    with a RetrievalState.
+
+    When a deadline is given, the iterate with the lowest cost in the
+    current stage is kept and _DeadlineReached is raised when there is not
+    enough time left for another iteration.
+    """
+    def __init__(self, parameters, result, on_iteration=None,
+                 iteration_interval=1, start_time=None, deadline=None):
+        self.parameters = parameters
+        self.result = result
+        self.on_iteration = on_iteration
+        self.iteration_interval = iteration_interval
+        self.start_time = start_time
+        self.deadline = deadline
+        self.iteration_time = 0.0
+        self.start_stage('first_pass')
+
+    def start_stage(self, stage):
+        self.stage = stage
+        self.best_x = None
+        self.best_cost = np.inf
+        self.last_time = time.time()
+
+    def cost(self, winds, parameters):
+        self.result.function_evaluations += 1
+        return J_function(winds, parameters)
+
+    def out_of_time(self, num_iterations=1):
+        if self.deadline is None:
+            return False
+        return (time.time() + num_iterations*self.iteration_time >
+                self.deadline)
+
+    def __call__(self, xk):
+        now = time.time()
+        self.iteration_time = max(self.iteration_time, now - self.last_time)
+        self.last_time = now
+        self.result.iterations += 1
+        self.result.cost_history.append(dict(self.parameters.last_costs))
+        self.result.grad_norm_history.append(self.parameters.last_grad_norm)
+        if (self.on_iteration is not None and
+                self.result.iterations % self.iteration_interval == 0):
+            winds = np.reshape(xk, (3,) + tuple(self.parameters.grid_shape))
+            state = RetrievalState(
+                self.result.iterations, self.stage, winds,
+                self.result.cost_history[-1],
+                self.result.grad_norm_history[-1],
+                time.time() - self.start_time)
+            self.on_iteration(state)
+
+        if self.deadline is not None:
+            if self.parameters.last_costs['J'] < self.best_cost:
+                self.best_cost = self.parameters.last_costs['J']
+                self.best_x = np.copy(xk)
+            if self.out_of_time():
+                raise _DeadlineReached()
+
+
+def _minimize(winds, parameters, bounds, monitor):
+    """
+    Runs 10 iterations of the solver. This returns the new wind field and
+    whether the solver was stopped by the time budget, in which case the
+    best iterate of the current stage is returned.
+    """
+    try:
+        winds = fmin_l_bfgs_b(monitor.cost, winds, args=(parameters,),
+                              maxiter=10, pgtol=1e-3, bounds=bounds,
+                              fprime=grad_J, disp=0, iprint=-1,
+                              callback=monitor)
+        return winds[0], False
+    except _DeadlineReached:
+        return monitor.best_x, True
 
 
 def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
@@ -158,7 +366,11 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
                       max_iterations=200, mask_w_outside_opt=True,
                       filter_window=9, filter_order=3, min_bca=30.0,
                       max_bca=150.0, upper_bc=True, model_fields=None,
-                      output_cost_functions=True, roi=1000.0):
+                      output_cost_functions=True, roi=1000.0,
+                      preprocess_executor='threads', output_mode='copy',
+                      progress_callback=None, return_result=False,
+                      on_iteration=None, iteration_interval=1,
+                      time_budget=None, fixed_points=None):
     """
     This function takes in a list of Py-ART Grid objects and derives a
     wind field. Every Py-ART Grid in Grids must have the same grid
@@ -190,9 +402,10 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
     w_init: 3D ndarray
         The intial guess for the vertical wind field, input as a 3D array
         with the same shape as the fields in Grids.
-    points: None or list of dicts
+    points: None, PointObservations or list of dicts
         Point observations as returned by :func:`pydda.constraints.get_iem_obs`. Set
-        to None to disable.
+        to None to disable. A list of dicts is converted to a
+        :class:`pydda.constraints.PointObservations`.
     vel_name: string
         Name of radial velocity field. Setting to None will have PyDDA attempt
         to automatically detect the velocity field name.
@@ -281,17 +494,64 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
         example, if you have U_hrrr, V_hrrr, and W_hrrr, then specify ["hrrr"]
         into model_fields.
     output_cost_functions: bool
-        Set to True to output the value of each cost function every
-        10 iterations.
+        Set to True to log the value of each cost function every
+        10 iterations. The logged values are the ones recorded by the
+        solver, so this does not add any evaluations of the cost function.
     roi: float
         Radius of influence for the point observations. The point observation will
         not hold any weight outside this radius.
+    preprocess_executor: str, concurrent.futures.Executor or None
+        How to run the per-radar preprocessing (fall speed, azimuth,
+        elevation and beam crossing angle calculations), which is independent
+        for each radar. Set to 'threads' to prepare all radars concurrently
+        in a thread pool, 'processes' to use a process pool, or None to
+        prepare the radars one at a time. An existing Executor may also be
+        passed in, in which case it will not be shut down by PyDDA.
+    output_mode: str
+        How to build the output grids. 'copy' returns a deep copy of each
+        grid in Grids with the wind fields added. 'shared' returns a
+        lightweight Grid for each radar that shares its coordinates,
+        metadata and fields with the input Grid, so only the wind fields
+        take up new memory. Do not modify the shared arrays in place if
+        the input Grids are still in use. 'wind' returns a list with a
+        single Grid that only contains the u, v, and w fields.
+    progress_callback: function or None
+        A function that is called with the
+        :py:class:`pydda.retrieval.RetrievalResult` recorded so far after
+        every 10 iterations of the solver and after every iteration after
+        the low pass filter. Progress is also reported through the
+        pydda.retrieval.wind_retrieve logger.
+    return_result: bool
+        Set to True to return a :py:class:`pydda.retrieval.RetrievalResult`
+        containing the output grids and diagnostics from the retrieval
+        instead of just the list of output grids.
+    on_iteration: function or None
+        A function that is called with a
+        :py:class:`pydda.retrieval.RetrievalState` every iteration_interval
+        iterations of the solver. The state contains the current u, v, and w
+        as views of the solver's control vector, so intermediate wind fields
+        can be used while the solver keeps refining them.
+    iteration_interval: int
+        The number of solver iterations between calls to on_iteration.
+    time_budget: float or None
+        The wall clock time in seconds that the retrieval has to finish in.
+        When set, the solver stops before the deadline and returns the
+        iterate with the lowest cost, and the iterations after the low pass
+        filter are shortened or skipped if there is not enough time left
+        for them. Use return_result=True to see whether the retrieval
+        converged or was stopped by the deadline. Set to None to disable.
+    fixed_points: 3D bool array or None
+        A mask in the shape of the analysis grid that is True where u, v
+        and w are to be held at their initial values. This is used to
+        impose boundary conditions, such as the winds retrieved on
+        neighboring nests. Set to None to let every point vary.
 
     Returns
     =======
-    new_grid_list: list
+    new_grid_list: list or RetrievalResult
         A list of Py-ART grids containing the derived wind fields. These fields
-        are displayable by the visualization module.
+        are displayable by the visualization module. If return_result is True,
+        a RetrievalResult with this list in its grids attribute is returned.
     """
 
     # We have to have a prescribed storm motion for vorticity constraint
@@ -303,6 +563,14 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
     if not isinstance(Grids, list):
         raise ValueError('Grids has to be a list!')
 
+    if iteration_interval < 1:
+        raise ValueError('iteration_interval must be at least 1!')
+
+    if output_mode not in ['copy', 'shared', 'wind']:
+        raise ValueError("output_mode must be 'copy', 'shared' or 'wind'!")
+
+    bt = time.time()
+    result = RetrievalResult()
     parameters = DDParameters()
     parameters.Ut = Ut
     parameters.Vt = Vt
@@ -333,17 +601,14 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
         parameters.v_back = np.zeros(v_init.shape[0])
     else:
         # Interpolate sounding to radar grid
-        print('Interpolating sounding to radar grid')
+        logger.info('Interpolating sounding to radar grid')
         u_interp = interp1d(z_back, u_back, bounds_error=False)
         v_interp = interp1d(z_back, v_back, bounds_error=False)
         parameters.u_back = u_interp(Grids[0].z['data'])
         parameters.v_back = v_interp(Grids[0].z['data'])
-        print('Interpolated U field:')
-        print(parameters["u_back"])
-        print('Interpolated V field:')
-        print(parameters["v_back"])
-        print('Grid levels:')
-        print(Grids[0].z['data'])
+        logger.debug('Interpolated U field: %s', parameters.u_back)
+        logger.debug('Interpolated V field: %s', parameters.v_back)
+        logger.debug('Grid levels: %s', Grids[0].z['data'])
 
     # Parse names of velocity field
     if refl_field is None:
@@ -363,10 +628,11 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
     if(model_fields is not None):
         parameters.model_weights = np.ones(
             (len(model_fields), u_init.shape[0], u_init.shape[1],
-             u_init.shape[2]))
+             u_init.shape[2]), dtype=np.float32)
     else:
         parameters.model_weights = np.zeros(
-            (1, u_init.shape[0], u_init.shape[1], u_init.shape[2]))
+            (1, u_init.shape[0], u_init.shape[1], u_init.shape[2]),
+            dtype=np.float32)
 
     if(model_fields is None):
         if(Cmod != 0.0):
@@ -377,28 +643,44 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
         (len(Grids), len(Grids), u_init.shape[1], u_init.shape[2]))
     sum_Vr = np.zeros(len(Grids))
 
+    executor, owns_executor = _get_preprocess_executor(
+        preprocess_executor, len(Grids))
+    try:
+        preprocessed = _map_on_executor(
+            executor, _preprocess_radar,
+            [(G, refl_field, frz) for G in Grids])
+        pairs = [(i, j) for i in range(len(Grids))
+                 for j in range(i+1, len(Grids))]
+        pair_bcas = _map_on_executor(
+            executor, get_bca,
+            [(Grids[i].radar_longitude['data'],
+              Grids[i].radar_latitude['data'],
+              Grids[j].radar_longitude['data'],
+              Grids[j].radar_latitude['data'],
+              Grids[i].point_x['data'][0],
+              Grids[i].point_y['data'][0],
+              Grids[i].get_projparams()) for i, j in pairs])
+    finally:
+        if owns_executor:
+            executor.shutdown()
+
     for i in range(len(Grids)):
-        parameters.wts.append(cost_functions.calculate_fall_speed(Grids[i],
-                                                       refl_field=refl_field, frz=frz))
-        add_azimuth_as_field(Grids[i], dz_name=refl_field)
-        add_elevation_as_field(Grids[i], dz_name=refl_field)
+        wts, az_field, el_field = preprocessed[i]
+        Grids[i].add_field('AZ', az_field, replace_existing=True)
+        Grids[i].add_field('EL', el_field, replace_existing=True)
+        parameters.wts.append(wts)
         parameters.vrs.append(Grids[i].fields[vel_name]['data'])
         parameters.azs.append(Grids[i].fields['AZ']['data']*np.pi/180)
         parameters.els.append(Grids[i].fields['EL']['data']*np.pi/180)
 
+    for (i, j), pair_bca in zip(pairs, pair_bcas):
+        bca[i, j] = pair_bca
+
     if(len(Grids) > 1):
         for i in range(len(Grids)):
             for j in range(i+1, len(Grids)):
-                print(("Calculating weights for radars " + str(i) +
-                       " and " + str(j)))
-                bca[i, j] = get_bca(Grids[i].radar_longitude['data'],
-                                    Grids[i].radar_latitude['data'],
-                                    Grids[j].radar_longitude['data'],
-                                    Grids[j].radar_latitude['data'],
-                                    Grids[i].point_x['data'][0],
-                                    Grids[i].point_y['data'][0],
-                                    Grids[i].get_projparams())
-
+                logger.info("Calculating weights for radars %d and %d",
+                            i, j)
                 for k in range(parameters.vrs[i].shape[0]):
                     if(weights_obs is None):
                         cur_array = parameters.weights[i, k]
@@ -432,7 +714,7 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
                     else:
                         parameters.bg_weights[i] = weights_bg[i]
 
-        print("Calculating weights for models...")
+        logger.info("Calculating weights for models...")
         coverage_grade = parameters.weights.sum(axis=0)
         coverage_grade = coverage_grade/coverage_grade.max()
 
@@ -469,31 +751,40 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
 
     winds = winds.flatten()
 
-    print("Starting solver ")
+    logger.info("Starting solver")
     parameters.dx = np.diff(Grids[0].x['data'], axis=0)[0]
     parameters.dy = np.diff(Grids[0].y['data'], axis=0)[0]
     parameters.dz = np.diff(Grids[0].z['data'], axis=0)[0]
-    print('rmsVR = ' + str(parameters.rmsVr))
-    print('Total points: %d' % parameters.weights.sum())
+    logger.info('rmsVR = %s', parameters.rmsVr)
+    logger.info('Total points: %d', parameters.weights.sum())
     parameters.z = Grids[0].point_z['data']
     parameters.x = Grids[0].point_x['data']
     parameters.y = Grids[0].point_y['data']
-    bt = time.time()
 
     # First pass - no filter
     wprevmax = 99
     wcurrmax = w_init.max()
     iterations = 0
-    bounds = [(-x, x) for x in 100*np.ones(winds.shape)]
+    bounds = np.tile([-100., 100.], (winds.size, 1))
+    if fixed_points is not None:
+        fixed = np.tile(np.asarray(fixed_points, dtype=bool).flatten(), 3)
+        bounds[fixed, 0] = winds[fixed]
+        bounds[fixed, 1] = winds[fixed]
 
     if(model_fields is not None):
-        for the_field in model_fields:
-            u_field = ("U_" + the_field)
-            v_field = ("V_" + the_field)
-            w_field = ("W_" + the_field)
-            parameters.u_model.append(Grids[0].fields[u_field]["data"])
-            parameters.v_model.append(Grids[0].fields[v_field]["data"])
-            parameters.w_model.append(Grids[0].fields[w_field]["data"])
+        # Stack the models so that the model constraint is evaluated for
+        # all of them at once. Masked points get no weight.
+        parameters.model_winds = np.zeros(
+            (len(model_fields), 3) + u_init.shape, dtype=np.float32)
+        for i, the_field in enumerate(model_fields):
+            for j, component in enumerate(["U_", "V_", "W_"]):
+                model_data = Grids[0].fields[component + the_field]["data"]
+                parameters.model_winds[i, j] = np.ma.filled(model_data, 0)
+                parameters.model_weights[i][
+                    np.ma.getmaskarray(model_data)] = 0
+        parameters.u_model = parameters.model_winds[:, 0]
+        parameters.v_model = parameters.model_winds[:, 1]
+        parameters.w_model = parameters.model_winds[:, 2]
 
     parameters.Co = Co
     parameters.Cm = Cm
@@ -506,30 +797,66 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
     parameters.Cpoint = Cpoint
     parameters.roi = roi
     parameters.upper_bc = upper_bc
+    if points is not None:
+        points = PointObservations.from_list(points)
     parameters.points = points
     parameters.point_list = points
 
+    deadline = None
+    if time_budget is not None:
+        deadline = bt + time_budget
+    monitor = _SolverMonitor(parameters, result, on_iteration,
+                             iteration_interval, bt, deadline)
+    parameters.print_out = False
+    st = time.time()
+    result.timings['preprocessing'] = st - bt
     while(iterations < max_iterations and
           (abs(wprevmax-wcurrmax) > 0.02)):
         wprevmax = wcurrmax
-        parameters.print_out = False
-        winds = fmin_l_bfgs_b(J_function, winds, args=(parameters,),
-                              maxiter=10, pgtol=1e-3, bounds=bounds,
-                              fprime=grad_J, disp=0, iprint=-1)
-        parameters.print_out = True
-        if output_cost_functions is True:
-            J_function(winds[0], parameters)
-            grad_J(winds[0], parameters)
+        if monitor.out_of_time():
+            result.deadline_reached = True
+            break
+        winds, result.deadline_reached = _minimize(
+            winds, parameters, bounds, monitor)
         winds = np.reshape(
-            winds[0], (3, parameters.grid_shape[0], parameters.grid_shape[1], parameters.grid_shape[2]))
+            winds, (3, parameters.grid_shape[0], parameters.grid_shape[1], parameters.grid_shape[2]))
         iterations = iterations+10
-        print('Iterations before filter: ' + str(iterations))
+        logger.info('Iterations before filter: %d', iterations)
         wcurrmax = winds[2].max()
+        if output_cost_functions is True:
+            _log_costs(result, np.abs(winds[2]).max())
         winds = np.stack([winds[0], winds[1], winds[2]])
         winds = winds.flatten()
+        if progress_callback is not None:
+            progress_callback(result)
+        if result.deadline_reached:
+            break
+
+    if result.deadline_reached:
+        result.convergence_reason = 'time_budget'
+    elif iterations >= max_iterations:
+        result.convergence_reason = 'max_iterations'
+    else:
+        result.convergence_reason = 'w_tolerance'
+        result.converged = True
+    ft = time.time()
+    result.timings['solver'] = ft - st
+
+    if filt_iterations > 0 and deadline is not None:
+        # Only do as many iterations after the filter as there is time for
+        fit_iterations = filt_iterations
+        while (fit_iterations > 0 and
+               monitor.out_of_time(10*fit_iterations)):
+            fit_iterations = fit_iterations - 1
+        if fit_iterations < filt_iterations:
+            logger.warning(('Only %d of %d iterations after the filter fit ' +
+                            'in the time budget'), fit_iterations,
+                           filt_iterations)
+            result.deadline_reached = True
+            filt_iterations = fit_iterations
 
     if filt_iterations > 0:
-        print('Applying low pass filter to wind field...')
+        logger.info('Applying low pass filter to wind field...')
         winds = np.reshape(winds, (3, parameters.grid_shape[0], parameters.grid_shape[1],
                                    parameters.grid_shape[2]))
         winds[0] = savgol_filter(winds[0], filter_window, filter_order, axis=0)
@@ -544,22 +871,27 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
         winds = np.stack([winds[0], winds[1], winds[2]])
         winds = winds.flatten()
         iterations = 0
+        monitor.start_stage('filtered')
         while(iterations < filt_iterations):
-            winds = fmin_l_bfgs_b(
-                J_function, winds, args=(parameters,),
-                maxiter=10, pgtol=1e-3, bounds=bounds,
-                fprime=grad_J, disp=0, iprint=-1)
-            parameters.print_out = False
+            winds, stopped = _minimize(winds, parameters, bounds, monitor)
             winds = np.reshape(
-                winds[0], (3, parameters.grid_shape[0], parameters.grid_shape[1], parameters.grid_shape[2]))
+                winds, (3, parameters.grid_shape[0], parameters.grid_shape[1], parameters.grid_shape[2]))
             iterations = iterations+1
-            print('Iterations after filter: ' + str(iterations))
+            logger.info('Iterations after filter: %d', iterations)
+            if output_cost_functions is True:
+                _log_costs(result, np.abs(winds[2]).max())
             winds = np.stack([winds[0], winds[1], winds[2]])
             winds = winds.flatten()
+            if progress_callback is not None:
+                progress_callback(result)
+            if stopped:
+                result.deadline_reached = True
+                break
 
-    print("Done! Time = " + "{:2.1f}".format(time.time() - bt))
+    result.timings['filter'] = time.time() - ft
+    logger.info("Done! Time = %2.1f", time.time() - bt)
 
-    # First pass - no filter
+    ot = time.time()
     the_winds = np.reshape(
         winds, (3, parameters.grid_shape[0], parameters.grid_shape[1], parameters.grid_shape[2]))
     u = the_winds[0]
@@ -580,37 +912,156 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, points=None, vel_name=None,
     if mask_w_outside_opt is True:
         w = np.ma.masked_where(where_mask < 1, w)
 
-    u_field = deepcopy(Grids[0].fields[vel_name])
-    u_field['data'] = u
-    u_field['standard_name'] = 'u_wind'
-    u_field['long_name'] = 'meridional component of wind velocity'
-    u_field['min_bca'] = min_bca
-    u_field['max_bca'] = max_bca
-    v_field = deepcopy(Grids[0].fields[vel_name])
-    v_field['data'] = v
-    v_field['standard_name'] = 'v_wind'
-    v_field['long_name'] = 'zonal component of wind velocity'
-    v_field['min_bca'] = min_bca
-    v_field['max_bca'] = max_bca
-    w_field = deepcopy(Grids[0].fields[vel_name])
-    w_field['data'] = w
-    w_field['standard_name'] = 'w_wind'
-    w_field['long_name'] = 'vertical component of wind velocity'
-    w_field['min_bca'] = min_bca
-    w_field['max_bca'] = max_bca
+    vel_field = Grids[0].fields[vel_name]
+    u_field = _make_wind_field_dict(
+        vel_field, u, 'u_wind', 'meridional component of wind velocity',
+        min_bca, max_bca)
+    v_field = _make_wind_field_dict(
+        vel_field, v, 'v_wind', 'zonal component of wind velocity',
+        min_bca, max_bca)
+    w_field = _make_wind_field_dict(
+        vel_field, w, 'w_wind', 'vertical component of wind velocity',
+        min_bca, max_bca)
 
-    new_grid_list = []
+    new_grid_list = _make_output_grids(
+        Grids, u_field, v_field, w_field, output_mode)
+
+    result.timings['output'] = time.time() - ot
+    result.timings['total'] = time.time() - bt
+    result.grids = new_grid_list
+    if return_result is True:
+        return result
+
+    return new_grid_list
+
+
+def _log_costs(result, max_w):
+    """
+    Logs the cost function terms and gradient norm from the last iteration
+    recorded in result.
+    """
+    if len(result.cost_history) == 0:
+        return
+
+    costs = result.cost_history[-1]
+    logger.info('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Jmodel  '
+                '| Jpoint  | Max w  ')
+    logger.info('|' + '|'.join(["{:9.4f}".format(costs[term]) for term in
+                                ["Jvel", "Jmass", "Jsmooth", "Jbg", "Jvort",
+                                 "Jmodel", "Jpoint"]]) +
+                '|' + "{:9.4f}".format(max_w))
+    logger.info('Norm of gradient: %s', result.grad_norm_history[-1])
+
+
+def _make_wind_field_dict(vel_field, data, standard_name, long_name,
+                          min_bca, max_bca):
+    """
+    Makes a wind field dictionary with the metadata of the velocity field
+    without copying the velocity data.
+    """
+    field = deepcopy({key: value for key, value in vel_field.items()
+                      if key != 'data'})
+    field['data'] = data
+    field['standard_name'] = standard_name
+    field['long_name'] = long_name
+    field['min_bca'] = min_bca
+    field['max_bca'] = max_bca
+    return field
+
+
+def _make_shared_grid(Grid, fields):
+    """
+    Makes a Py-ART Grid with the given fields that shares its coordinates
+    and metadata with Grid instead of copying them.
+    """
+    new_grid = pyart.core.Grid(
+        Grid.time, fields, Grid.metadata, Grid.origin_latitude,
+        Grid.origin_longitude, Grid.origin_altitude, Grid.x, Grid.y, Grid.z,
+        Grid.projection, Grid.radar_latitude, Grid.radar_longitude,
+        Grid.radar_altitude, Grid.radar_time, Grid.radar_name)
+
+    # The point coordinates are only calculated once per input Grid
+    new_grid.point_x = Grid.point_x
+    new_grid.point_y = Grid.point_y
+    new_grid.point_z = Grid.point_z
+    new_grid.point_latitude = Grid.point_latitude
+    new_grid.point_longitude = Grid.point_longitude
+    new_grid.point_altitude = Grid.point_altitude
+    return new_grid
 
+
+def _make_output_grids(Grids, u_field, v_field, w_field, output_mode='copy'):
+    """
+    Adds the wind fields to the input Grids according to output_mode.
+    See :py:func:`pydda.retrieval.get_dd_wind_field` for the output modes.
+    """
+    wind_fields = {'u': u_field, 'v': v_field, 'w': w_field}
+    if output_mode == 'wind':
+        return [_make_shared_grid(Grids[0], wind_fields)]
+
+    new_grid_list = []
     for grid in Grids:
-        temp_grid = deepcopy(grid)
-        temp_grid.add_field('u', u_field, replace_existing=True)
-        temp_grid.add_field('v', v_field, replace_existing=True)
-        temp_grid.add_field('w', w_field, replace_existing=True)
+        if output_mode == 'shared':
+            fields = dict(grid.fields)
+            fields.update(wind_fields)
+            temp_grid = _make_shared_grid(grid, fields)
+        else:
+            temp_grid = deepcopy(grid)
+            temp_grid.add_field('u', u_field, replace_existing=True)
+            temp_grid.add_field('v', v_field, replace_existing=True)
+            temp_grid.add_field('w', w_field, replace_existing=True)
         new_grid_list.append(temp_grid)
 
     return new_grid_list
 
 
+def _get_preprocess_executor(preprocess_executor, num_radars):
+    """
+    Returns the executor to use for the per-radar preprocessing and whether
+    get_dd_wind_field is responsible for shutting it down.
+    """
+    if isinstance(preprocess_executor, Executor):
+        return preprocess_executor, False
+
+    if preprocess_executor is None or num_radars < 2:
+        return None, False
+
+    max_workers = min(num_radars, os.cpu_count() or 1)
+    if preprocess_executor == 'threads':
+        return ThreadPoolExecutor(max_workers=max_workers), True
+    elif preprocess_executor == 'processes':
+        return ProcessPoolExecutor(max_workers=max_workers), True
+
+    raise ValueError(("preprocess_executor must be 'threads', 'processes', " +
+                      "None or a concurrent.futures.Executor!"))
+
+
+def _map_on_executor(executor, func, arg_list):
+    """
+    Calls func on each tuple of arguments in arg_list using executor and
+    returns the results in order. A None executor runs each call serially.
+    """
+    if executor is None:
+        return [func(*args) for args in arg_list]
+
+    futures = [executor.submit(func, *args) for args in arg_list]
+    return [future.result() for future in futures]
+
+
+def _preprocess_radar(Grid, refl_field, frz):
+    """
+    Calculates the fall speed, azimuth and elevation for a single radar.
+    The azimuth and elevation field dictionaries are returned so that they
+    can be added back into the caller's Grid when this is run in another
+    process.
+    """
+    wts = cost_functions.calculate_fall_speed(
+        Grid, refl_field=refl_field, frz=frz)
+    add_azimuth_as_field(Grid, dz_name=refl_field)
+    add_elevation_as_field(Grid, dz_name=refl_field)
+    return wts, Grid.fields['AZ'], Grid.fields['EL']
+
+
 def get_bca(rad1_lon, rad1_lat, rad2_lon, rad2_lat, x, y, projparams):
     """
     This function gets the beam crossing angle between two lat/lon pairs.
@@ -196,6 +196,70 @@ def test_point_cost():
     assert np.all(grad == 0)
 
 
+def test_point_cost_many_points():
+    """ The point cost for all observations at once should match summing
+        over the observations one at a time """
+    rng = np.random.RandomState(0)
+    z, y, x = np.meshgrid(np.linspace(0, 10, 6), np.linspace(-10, 10, 11),
+                          np.linspace(-10, 10, 9), indexing='ij')
+    u = rng.randn(*x.shape)
+    v = rng.randn(*x.shape)
+    point_list = [{'x': px, 'y': py, 'z': pz, 'u': pu, 'v': pv}
+                  for px, py, pz, pu, pv in rng.uniform(-10, 10, (50, 5))]
+    points = pydda.constraints.PointObservations.from_list(point_list)
+
+    expected_cost = 0.
+    expected_grad_u = np.zeros_like(u)
+    for the_point in point_list:
+        the_box = np.where(np.logical_and.reduce(
+            (np.abs(x - the_point["x"]) < 3., np.abs(y - the_point["y"]) < 3.,
+             np.abs(z - the_point["z"]) < 3.)))
+        expected_cost += np.sum((u[the_box] - the_point["u"])**2 +
+                                (v[the_box] - the_point["v"])**2)
+        expected_grad_u[the_box] += 2 * (u[the_box] - the_point["u"])
+
+    for x_grid in [x, x + 1e-3 * y]:
+        cost = pydda.cost_functions.calculate_point_cost(
+            u, v, x_grid, y, z, points, Cp=1., roi=3.)
+        grad = pydda.cost_functions.calculate_point_gradient(
+            u, v, x_grid, y, z, points, Cp=1., roi=3.)
+        np.testing.assert_allclose(cost, expected_cost)
+        np.testing.assert_allclose(grad[:u.size].reshape(u.shape),
+                                   expected_grad_u)
+        assert np.all(grad[2 * u.size:] == 0)
+
+
+def test_point_observations(tmpdir):
+    point_list = [{'x': 1., 'y': 2., 'z': 3., 'u': 4., 'v': 5.,
+                   'site_id': 'ABC'},
+                  {'x': 6., 'y': 7., 'z': 8., 'u': 9., 'v': 10., 'w': 1.,
+                   'site_id': 'DEF'}]
+    points = pydda.constraints.PointObservations.from_list(point_list)
+    assert len(points) == 2
+    assert [the_point['site_id'] for the_point in points] == ['ABC', 'DEF']
+    assert points[0]['w'] == 0.
+    assert points[1]['v'] == 10.
+    assert len(points[1:]) == 1
+
+    # An empty list of points gives no cost
+    empty = pydda.constraints.PointObservations.from_list([])
+    assert len(empty) == 0
+    u = np.ones((4, 5, 6))
+    z, y, x = np.meshgrid(np.arange(4.), np.arange(5.), np.arange(6.),
+                          indexing='ij')
+    assert pydda.cost_functions.calculate_point_cost(
+        u, u, x, y, z, [], roi=2.0) == 0
+    assert np.all(pydda.cost_functions.calculate_point_gradient(
+        u, u, x, y, z, [], roi=2.0) == 0)
+
+    file_name = str(tmpdir.join('points.csv'))
+    points.to_csv(file_name)
+    read_points = pydda.constraints.PointObservations.from_csv(file_name)
+    for name in ['x', 'y', 'z', 'u', 'v', 'w', 'site_id']:
+        np.testing.assert_array_equal(read_points.data[name],
+                                      points.data[name])
+
+
 def test_model_cost():
     u = 10*np.ones((10, 10, 10))
     v = 10*np.ones((10, 10, 10))
@@ -217,3 +281,52 @@ def test_model_cost():
     cost2 = pydda.cost_functions.calculate_model_cost(
         u, v, w, weights, u - 1, v - 1, w)
     assert cost2 > cost1
+
+
+def test_stacked_model_cost():
+    """ All models at once should give the sum of the costs and gradients
+        of each model """
+    rng = np.random.RandomState(0)
+    u, v, w = rng.randn(3, 4, 5, 6)
+    model_winds = rng.randn(3, 3, 4, 5, 6).astype(np.float32)
+    weights = rng.rand(3, 4, 5, 6).astype(np.float32)
+    cost = pydda.cost_functions.calculate_model_cost(
+        u, v, w, weights, model_winds[:, 0], model_winds[:, 1],
+        model_winds[:, 2], coeff=2.)
+    grad = pydda.cost_functions.calculate_model_gradient(
+        u, v, w, weights, model_winds[:, 0], model_winds[:, 1],
+        model_winds[:, 2], coeff=2.)
+
+    u_model, v_model = model_winds[:, 0], model_winds[:, 1]
+    expected_cost = np.sum(2. * weights * ((u - u_model)**2 +
+                                           (v - v_model)**2))
+    expected_grad = np.stack([
+        np.sum(2. * 2. * weights * (u - u_model), axis=0),
+        np.sum(2. * 2. * weights * (v - v_model), axis=0),
+        np.zeros_like(w)])
+    np.testing.assert_allclose(cost, expected_cost, rtol=1e-5)
+    np.testing.assert_allclose(grad, expected_grad.flatten(), rtol=1e-5,
+                               atol=1e-6)
+
+    # Masked model points do not count
+    u_model = np.ma.masked_where(u > 0, model_winds[0, 0])
+    cost = pydda.cost_functions.calculate_model_cost(
+        u, v, w, [weights[0]], [u_model], [model_winds[0, 1]],
+        [model_winds[0, 2]])
+    expected_cost = np.sum(np.where(
+        u > 0, 0, weights[0] * ((u - model_winds[0, 0])**2 +
+                                (v - model_winds[0, 1])**2)))
+    np.testing.assert_allclose(cost, expected_cost, rtol=1e-6)
+
+    # The gradient leaves out the masked points too, so it agrees with the
+    # cost. Before stacking, the gradient treated them as a model wind of 0.
+    grad = pydda.cost_functions.calculate_model_gradient(
+        u, v, w, [weights[0]], [u_model], [model_winds[0, 1]],
+        [model_winds[0, 2]]).reshape((3, 4, 5, 6))
+    np.testing.assert_allclose(grad[0], np.where(
+        u > 0, 0, 2 * weights[0] * (u - model_winds[0, 0])),
+        rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(grad[1], np.where(
+        u > 0, 0, 2 * weights[0] * (v - model_winds[0, 1])),
+        rtol=1e-5, atol=1e-6)
+    np.testing.assert_array_equal(grad[2], 0)
@@ -4,7 +4,7 @@ import numpy as np
 
 from netCDF4 import Dataset
 from scipy.interpolate import interp1d
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 def test_add_era_interim_field():
@@ -22,7 +22,9 @@ def test_add_era_interim_field():
     lon = era_dataset.variables["longitude"][:]
     base_time = datetime.strptime(era_dataset.variables["time"].units,
                                   "hours since %Y-%m-%d %H:%M:%S.%f")
-    time_step = np.argmin(np.abs(base_time - grid_time))
+    era_times = np.array([base_time + timedelta(hours=float(x))
+                          for x in era_dataset.variables["time"][:]])
+    time_step = np.argmin(np.abs(era_times - grid_time))
     lat_inds = np.where(np.logical_and(
         lat >= Grid0.point_latitude["data"].min(),
         lat <= Grid0.point_latitude["data"].max()))
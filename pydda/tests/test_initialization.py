@@ -9,7 +9,10 @@ Created on Tue Jul 24 14:50:58 2018
 import pydda
 import pyart
 import numpy as np
-from datetime import datetime
+import pytest
+import json
+import os
+from datetime import datetime, timezone
 
 
 def test_make_const_wind_field():
@@ -54,6 +57,67 @@ def test_make_wind_field_from_profile():
     assert np.all(w == 0.0)
 
 
+def _make_hrrr_grib(w=0.25):
+    """ Makes a stand-in for a cfgrib HRRR file where u is the height
+        of each pressure level in km, v is -u and w is constant """
+    from collections import namedtuple
+    Variable = namedtuple('Variable', ['data'])
+    Grib = namedtuple('Grib', ['variables'])
+    lon, lat = np.meshgrid(np.linspace(255., 265., 41),
+                           np.linspace(34., 40., 25))
+    gh = np.broadcast_to(
+        np.arange(0., 12001., 100.)[:, np.newaxis, np.newaxis],
+        (121,) + lat.shape)
+    u = gh / 1000.
+    return Grib({'latitude': Variable(lat), 'longitude': Variable(lon),
+                 'gh': Variable(gh), 'u': Variable(u), 'v': Variable(-u),
+                 'w': Variable(np.full(gh.shape, w))})
+
+
+def _use_hrrr_grib(monkeypatch, module, grib):
+    """ Makes module read grib in place of any HRRR file """
+    from types import SimpleNamespace
+    monkeypatch.setattr(module, 'CFGRIB_AVAILABLE', True)
+    monkeypatch.setattr(module, 'cfgrib', SimpleNamespace(
+        open_file=lambda file_path, **kwargs: grib), raising=False)
+
+
+def test_hrrr_initialization_w(monkeypatch):
+    """ w should come from the HRRR vertical velocity. It used to be
+        read from the meridional wind. """
+    from pydda.initialization import wind_fields
+    _use_hrrr_grib(monkeypatch, wind_fields, _make_hrrr_grib())
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    u, v, w = wind_fields.make_intialization_from_hrrr(
+        Grid, 'hrrr.grib2')
+    np.testing.assert_allclose(v, -u)
+    np.testing.assert_allclose(w, 0.25)
+
+
+def test_hrrr_height(monkeypatch):
+    """ The HRRR levels should be placed at their heights above the radar,
+        as found from the geopotential height. They used to be placed at
+        the geopotential height above sea level. """
+    from pydda.initialization import wind_fields
+    from pydda.constraints import model_data
+    grib = _make_hrrr_grib()
+    _use_hrrr_grib(monkeypatch, wind_fields, grib)
+    _use_hrrr_grib(monkeypatch, model_data, grib)
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    Grid.radar_altitude['data'] = np.array([300.])
+    # u is the height above sea level of the nearest level in km
+    expected = (Grid.point_z['data'] + 300.) / 1000.
+
+    u, v, w = wind_fields.make_intialization_from_hrrr(Grid, 'hrrr.grib2')
+    np.testing.assert_allclose(u, expected, atol=0.07)
+
+    Grid = pydda.constraints.add_hrrr_constraint_to_grid(Grid, 'hrrr.grib2')
+    np.testing.assert_allclose(Grid.fields['U_hrrr']['data'], expected,
+                               atol=0.07)
+
+
 def test_get_iem_data():
     Grid = pyart.testing.make_empty_grid(
         (20, 20, 20), ((0, 100000.), (-100000., 100000.), (-100000., 100000.)))
@@ -61,3 +125,102 @@ def test_get_iem_data():
     names = [x['site_id'] for x in station_obs]
     assert names == ['P28', 'WLD', 'WDG', 'SWO', 'END']
 
+
+
+def _write_iem_files(path):
+    """ Writes the metadata of two networks and the observations at three
+        stations in the layout of IEMFileTransport """
+    os.makedirs(os.path.join(path, 'networks'))
+    os.makedirs(os.path.join(path, 'stations'))
+    networks = {'AWOS': [('AAA', 36.9, -98.2, 400.), ('FAR', 40., -90., 0.)],
+                'OK_ASOS': [('BBB', 36.5, -97.9, 350.),
+                            ('CCC', 36.6, -98.0, 300.)]}
+    for network, sites in networks.items():
+        features = [{'geometry': {'coordinates': [lon, lat]},
+                     'properties': {'sid': sid, 'elevation': elevation}}
+                    for sid, lat, lon, elevation in sites]
+        with open(os.path.join(path, 'networks', network + '.geojson'),
+                  'w') as the_file:
+            json.dump({'features': features}, the_file)
+
+    header = ''.join(['#DEBUG: line\n'] * 5)
+    header += 'station,valid,lon,lat,drct,sknt\n'
+    for sid, lat, lon, drct in [('AAA', 36.9, -98.2, 270.),
+                                ('CCC', 36.6, -98.0, 180.)]:
+        with open(os.path.join(path, 'stations',
+                               sid + '_19991231_20000101.csv'),
+                  'w') as the_file:
+            the_file.write(header + '%s,2000-01-01 00:00,%f,%f,%f,10.\n' % (
+                sid, lon, lat, drct))
+
+
+class _EmptyTransport(object):
+    def __init__(self):
+        self.requested = []
+
+    def get_network(self, network):
+        self.requested.append(network)
+        return ""
+
+    def get_station(self, station, start_time, end_time):
+        self.requested.append(station)
+        return ""
+
+
+def test_get_iem_data_offline(tmpdir):
+    """ Station data should be read through the transport and then from
+        the cache """
+    _write_iem_files(str(tmpdir.join('iem')))
+    Grid = pyart.testing.make_empty_grid(
+        (20, 20, 20), ((0, 100000.), (-100000., 100000.), (-100000., 100000.)))
+    transport = pydda.constraints.IEMFileTransport(str(tmpdir.join('iem')))
+    cache_dir = str(tmpdir.join('cache'))
+    with pytest.warns(UserWarning, match='BBB'):
+        station_obs = pydda.constraints.get_iem_obs(
+            Grid, transport=transport, cache_dir=cache_dir, num_workers=4)
+    assert [x['site_id'] for x in station_obs] == ['AAA', 'CCC']
+    np.testing.assert_allclose(station_obs[0]['u'], 10. * 0.514444)
+    np.testing.assert_allclose(station_obs[0]['v'], 0., atol=1e-6)
+    np.testing.assert_allclose(station_obs[1]['v'], 10. * 0.514444)
+    assert station_obs[1]['z'] == 0.
+
+    transport = _EmptyTransport()
+    with pytest.warns(UserWarning, match='BBB'):
+        cached_obs = pydda.constraints.get_iem_obs(
+            Grid, transport=transport, cache_dir=cache_dir)
+    assert [x['site_id'] for x in cached_obs] == ['AAA', 'CCC']
+    for name in ['AWOS', 'OK_ASOS', 'AAA', 'CCC']:
+        assert name not in transport.requested
+    assert 'BBB' in transport.requested
+
+
+def test_get_iem_data_today(tmpdir):
+    """ Observations from a day that has not ended should not be cached """
+    _write_iem_files(str(tmpdir.join('iem')))
+    today = datetime.now(timezone.utc)
+    for sid in ['AAA', 'CCC']:
+        os.rename(str(tmpdir.join('iem', 'stations',
+                                  sid + '_19991231_20000101.csv')),
+                  str(tmpdir.join('iem', 'stations', '%s_%s_%s.csv' % (
+                      sid, today.strftime('%Y%m%d'),
+                      today.strftime('%Y%m%d')))))
+    Grid = pyart.testing.make_empty_grid(
+        (20, 20, 20), ((0, 100000.), (-100000., 100000.), (-100000., 100000.)))
+    Grid.time['units'] = today.strftime('seconds since %Y-%m-%dT12:00:00Z')
+    transport = pydda.constraints.IEMFileTransport(str(tmpdir.join('iem')))
+    cache_dir = str(tmpdir.join('cache'))
+    with pytest.warns(UserWarning, match='BBB'):
+        station_obs = pydda.constraints.get_iem_obs(
+            Grid, transport=transport, cache_dir=cache_dir)
+    assert [x['site_id'] for x in station_obs] == ['AAA', 'CCC']
+    assert os.path.isdir(os.path.join(cache_dir, 'networks'))
+    assert not os.path.exists(os.path.join(cache_dir, 'stations'))
+
+
+def test_get_iem_data_no_stations(tmpdir):
+    """ A grid without any stations should give no observations """
+    Grid = pyart.testing.make_empty_grid(
+        (20, 20, 20), ((0, 100000.), (-100000., 100000.), (-100000., 100000.)))
+    transport = pydda.constraints.IEMFileTransport(str(tmpdir))
+    station_obs = pydda.constraints.get_iem_obs(Grid, transport=transport)
+    assert len(station_obs) == 0
@@ -0,0 +1,439 @@
+import pydda
+import pyart
+import numpy as np
+
+from scipy.interpolate import NearestNDInterpolator, griddata
+from pydda.constraints.interpolation import _nearest_indices
+
+
+def test_nearest_indices():
+    """ One KD-tree query should match NearestNDInterpolator for
+        every variable """
+    rng = np.random.RandomState(0)
+    height = rng.uniform(0, 15000, 2000)
+    lat = rng.uniform(35, 37, 2000)
+    lon = rng.uniform(-99, -97, 2000)
+    grid_alt, grid_lat, grid_lon = np.meshgrid(
+        np.linspace(0, 10000, 5), np.linspace(35.5, 36.5, 6),
+        np.linspace(-98.5, -97.5, 7), indexing='ij')
+
+    nearest = _nearest_indices((height, lat, lon),
+                               (grid_alt, grid_lat, grid_lon))
+    assert nearest.shape == grid_alt.shape
+    for var in [rng.randn(2000), rng.randn(2000)]:
+        interp = NearestNDInterpolator((height, lat, lon), var,
+                                       rescale=True)
+        np.testing.assert_array_equal(
+            var[nearest], interp(grid_alt, grid_lat, grid_lon))
+
+
+def _make_points(rng, num_points=2000):
+    height = rng.uniform(0, 15000, num_points)
+    lat = rng.uniform(35, 37, num_points)
+    lon = rng.uniform(-99, -97, num_points)
+    grid_points = np.meshgrid(
+        np.linspace(1000, 10000, 5), np.linspace(35.5, 36.5, 6),
+        np.linspace(-98.5, -97.5, 7), indexing='ij')
+    return (height, lat, lon), tuple(grid_points)
+
+
+def test_interpolation_weights():
+    """ The sparse weights should match NearestNDInterpolator and
+        griddata """
+    rng = np.random.RandomState(1)
+    source, target = _make_points(rng)
+    var = rng.randn(2000)
+
+    weights = pydda.constraints.get_interpolation_weights(
+        source, target, 'nearest')
+    interp = NearestNDInterpolator(source, var, rescale=True)
+    np.testing.assert_allclose(weights(var), interp(*target))
+
+    weights = pydda.constraints.get_interpolation_weights(
+        source, target, 'linear')
+    np.testing.assert_allclose(
+        weights(var), griddata(source, var, target, fill_value=0.))
+
+
+def test_interpolation_weight_cache(tmpdir):
+    """ The weights should be reused from memory and from disk, and model
+        heights within the tolerance should reuse the same weights """
+    from pydda.constraints import interpolation
+    rng = np.random.RandomState(2)
+    source, target = _make_points(rng, 500)
+    weights = pydda.constraints.get_interpolation_weights(
+        source, target, 'linear', cache_dir=str(tmpdir))
+    assert pydda.constraints.get_interpolation_weights(
+        source, target, 'linear') is weights
+    assert len(tmpdir.listdir()) == 1
+
+    interpolation._WEIGHT_CACHE.clear()
+    loaded = pydda.constraints.get_interpolation_weights(
+        source, target, 'linear', cache_dir=str(tmpdir))
+    assert loaded is not weights
+    assert (loaded.matrix != weights.matrix).nnz == 0
+    assert loaded.target_shape == weights.target_shape
+
+    rounded = (np.round(source[0], -3) + 100.,) + source[1:]
+    moved = (rounded[0] + 2.0,) + source[1:]
+    a = pydda.constraints.get_interpolation_weights(
+        rounded, target, height_tolerance=1000.)
+    b = pydda.constraints.get_interpolation_weights(
+        moved, target, height_tolerance=1000.)
+    c = pydda.constraints.get_interpolation_weights(moved, target)
+    assert a is b
+    assert c is not a
+
+
+def test_interpolation_weight_cache_threads(tmpdir):
+    """ Weights should be cached and evicted safely from many threads """
+    from concurrent.futures import ThreadPoolExecutor
+    from pydda.constraints import interpolation
+    rng = np.random.RandomState(3)
+    sources = []
+    for i in range(2 * interpolation._MAX_CACHED_WEIGHTS):
+        source, target = _make_points(rng, 200)
+        sources.append(source)
+
+    def get_weights(i):
+        return pydda.constraints.get_interpolation_weights(
+            sources[i % len(sources)], target, 'nearest',
+            cache_dir=str(tmpdir))
+
+    with ThreadPoolExecutor(8) as executor:
+        all_weights = list(executor.map(get_weights, range(200)))
+    assert len(interpolation._WEIGHT_CACHE) <= \
+        interpolation._MAX_CACHED_WEIGHTS
+    assert len(tmpdir.listdir()) == len(sources)
+    for i, weights in enumerate(all_weights):
+        assert weights.key == all_weights[i % len(sources)].key
+
+
+def _write_wrf_file(file_name, nz=10, ny=12, nx=14, dx=2000.):
+    """ Writes a small WRF file with winds that are linear in x, y
+        and height over uneven terrain """
+    from netCDF4 import Dataset
+    wrf = Dataset(file_name, 'w')
+    for name, size in [('Time', 1), ('DateStrLen', 19),
+                       ('bottom_top', nz), ('bottom_top_stag', nz + 1),
+                       ('south_north', ny), ('south_north_stag', ny + 1),
+                       ('west_east', nx), ('west_east_stag', nx + 1)]:
+        wrf.createDimension(name, size)
+    wrf.setncattr('WEST-EAST_GRID_DIMENSION', nx + 1)
+    wrf.setncattr('SOUTH-NORTH_GRID_DIMENSION', ny + 1)
+    wrf.DX = dx
+    wrf.DY = dx
+    times = wrf.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+    times[0] = np.array(list('2019-05-20_12:00:00'), dtype='S1')
+
+    x = np.arange(nx) * dx
+    y = np.arange(ny) * dx
+    terrain = 100. * np.sin(x[np.newaxis, :] / 5000.) + 0. * y[:, np.newaxis]
+    eta = np.linspace(0, 10000., nz + 1)
+    z_w = eta[:, np.newaxis, np.newaxis] + terrain[np.newaxis]
+    dims = ('Time', 'bottom_top_stag', 'south_north', 'west_east')
+    wrf.createVariable('PHB', 'f8', dims)[0] = 0.
+    wrf.createVariable('PH', 'f8', dims)[0] = z_w * 9.81
+    z_mass = (z_w[1:] + z_w[:-1]) / 2.
+
+    def field(x, y, z):
+        return 1. + 1e-3 * x + 2e-3 * y + 1e-3 * z
+    x_u = np.arange(nx + 1) * dx - dx / 2.
+    z_pad = np.concatenate([z_mass[:, :, :1], z_mass, z_mass[:, :, -1:]], 2)
+    z_u = (z_pad[:, :, 1:] + z_pad[:, :, :-1]) / 2.
+    wrf.createVariable(
+        'U', 'f8', ('Time', 'bottom_top', 'south_north', 'west_east_stag'))[
+            0] = field(x_u[np.newaxis, np.newaxis, :],
+                       y[np.newaxis, :, np.newaxis], z_u)
+    y_v = np.arange(ny + 1) * dx - dx / 2.
+    z_pad = np.concatenate([z_mass[:, :1], z_mass, z_mass[:, -1:]], 1)
+    z_v = (z_pad[:, 1:] + z_pad[:, :-1]) / 2.
+    wrf.createVariable(
+        'V', 'f8', ('Time', 'bottom_top', 'south_north_stag', 'west_east'))[
+            0] = field(x[np.newaxis, np.newaxis, :],
+                       y_v[np.newaxis, :, np.newaxis], z_v)
+    wrf.createVariable('W', 'f8', dims)[0] = field(
+        x[np.newaxis, np.newaxis, :], y[np.newaxis, :, np.newaxis], z_w)
+    wrf.close()
+    return field
+
+
+def test_wrf_constraint(tmpdir):
+    """ The structured WRF interpolation should reproduce winds that are
+        linear in x, y and height """
+    from datetime import datetime
+    file_name = str(tmpdir.join('wrfout.nc'))
+    field = _write_wrf_file(file_name)
+    Grid = pyart.testing.make_empty_grid(
+        (5, 6, 7), ((1000., 8000.), (-8000., 8000.), (-10000., 10000.)))
+    Grid.add_field('corrected_velocity', {'data': np.zeros((5, 6, 7))})
+    Grid = pydda.constraints.make_constraint_from_wrf(
+        Grid, file_name, datetime(2019, 5, 20, 12), (12., 11.))
+    expected = field(Grid.point_x['data'] + 12000.,
+                     Grid.point_y['data'] + 11000., Grid.point_z['data'])
+    for name in ['U_wrf', 'V_wrf', 'W_wrf']:
+        np.testing.assert_allclose(Grid.fields[name]['data'], expected)
+
+    u, v, w = pydda.initialization.make_background_from_wrf(
+        Grid, file_name, datetime(2019, 5, 20, 12), (12., 11.))
+    np.testing.assert_allclose(u, expected)
+
+    # Points outside of the WRF domain are set to 0
+    Grid = pyart.testing.make_empty_grid(
+        (2, 2, 2), ((500., 8000.), (-8000., 8000.), (50000., 60000.)))
+    Grid.add_field('corrected_velocity', {'data': np.zeros((2, 2, 2))})
+    Grid = pydda.constraints.make_constraint_from_wrf(
+        Grid, file_name, datetime(2019, 5, 20, 12), (12., 11.))
+    assert np.all(Grid.fields['U_wrf']['data'] == 0)
+
+
+def _write_era_file(file_name, lon_offset=0.):
+    """ Writes a small ERA Interim file with three times, where u is the
+        latitude plus 10 m/s for each time step and w is the longitude.
+        lon_offset is added to the longitudes in the file. """
+    from datetime import datetime
+    from netCDF4 import Dataset
+    era = Dataset(file_name, 'w')
+    lat = np.arange(40., 33., -0.5)
+    lon = np.arange(-102., -94., 0.5)
+    levels = np.array([1, 2, 3, 5, 7, 10, 20, 30, 50, 70, 100, 125, 150, 175,
+                       200, 225, 250, 300, 350, 400, 450, 500, 550, 600, 650,
+                       700, 750, 775, 800, 825, 850, 875, 900, 925, 950, 975,
+                       1000], dtype=float)
+    for name, size in [('time', 3), ('level', len(levels)),
+                       ('latitude', len(lat)), ('longitude', len(lon))]:
+        era.createDimension(name, size)
+    times = era.createVariable('time', 'f8', ('time',))
+    times.units = "hours since 1900-01-01 00:00:00.0"
+    grid_hours = (datetime(2000, 1, 1) -
+                  datetime(1900, 1, 1)).total_seconds() / 3600.
+    times[:] = grid_hours + np.array([-6., 0., 6.])
+    era.createVariable('level', 'f8', ('level',))[:] = levels
+    era.createVariable('latitude', 'f8', ('latitude',))[:] = lat
+    era.createVariable('longitude', 'f8', ('longitude',))[:] = \
+        lon + lon_offset
+    dims = ('time', 'level', 'latitude', 'longitude')
+    shape = (3, len(levels), len(lat), len(lon))
+    era.createVariable('z', 'f8', dims)[:] = np.broadcast_to(
+        np.linspace(30000., 0., len(levels))[
+            np.newaxis, :, np.newaxis, np.newaxis], shape)
+    u = np.broadcast_to(
+        10. * np.arange(3)[:, np.newaxis, np.newaxis, np.newaxis] +
+        lat[np.newaxis, np.newaxis, :, np.newaxis], shape)
+    era.createVariable('u', 'f8', dims)[:] = u
+    era.createVariable('v', 'f8', dims)[:] = -u
+    era.createVariable('w', 'f8', dims)[:] = np.broadcast_to(lon, shape)
+    era.close()
+
+
+def test_era_constraint(tmpdir):
+    """ Only the ERA time closest to the grid time should be used, and the
+        window of the file that is read should cover the grid """
+    file_name = str(tmpdir.join('era.nc'))
+    _write_era_file(file_name)
+
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    Grid.add_field('corrected_velocity', {'data': np.zeros((3, 4, 5))})
+    Grid = pydda.constraints.make_constraint_from_era_interim(
+        Grid, file_name)
+    u_era = Grid.fields['U_erainterim']['data']
+    np.testing.assert_allclose(
+        u_era, 10. + Grid.point_latitude['data'], atol=0.25)
+    np.testing.assert_allclose(Grid.fields['V_erainterim']['data'], -u_era)
+    np.testing.assert_allclose(Grid.fields['W_erainterim']['data'],
+                               Grid.point_longitude['data'], atol=0.25)
+
+
+def test_era_constraint_360(tmpdir):
+    """ ERA files with longitudes from 0 to 360 degrees should give the
+        same winds over a grid west of Greenwich """
+    file_name = str(tmpdir.join('era.nc'))
+    _write_era_file(file_name, lon_offset=360.)
+
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    Grid.add_field('corrected_velocity', {'data': np.zeros((3, 4, 5))})
+    Grid = pydda.constraints.make_constraint_from_era_interim(
+        Grid, file_name)
+    np.testing.assert_allclose(
+        Grid.fields['U_erainterim']['data'],
+        10. + Grid.point_latitude['data'], atol=0.25)
+    np.testing.assert_allclose(Grid.fields['W_erainterim']['data'],
+                               Grid.point_longitude['data'], atol=0.25)
+
+
+def test_hrrr_window():
+    """ Only the HRRR columns around the grid should be read, and they
+        should hold the same points as subsetting the full field """
+    from collections import namedtuple
+    from pydda.constraints.model_data import _read_hrrr_window
+    Variable = namedtuple('Variable', ['data'])
+    Grib = namedtuple('Grib', ['variables'])
+    lon, lat = np.meshgrid(np.linspace(250., 270., 81),
+                           np.linspace(30., 45., 61))
+    gh = np.broadcast_to(
+        np.linspace(500., 12000., 6)[:, np.newaxis, np.newaxis],
+        (6,) + lat.shape)
+    u = gh / 1000. + lat[np.newaxis]
+    grib = Grib({'latitude': Variable(lat), 'longitude': Variable(lon),
+                 'gh': Variable(gh), 'u': Variable(u), 'v': Variable(-u),
+                 'w': Variable(0. * u)})
+
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    height, lat_w, lon_w, u_w, v_w, w_w = _read_hrrr_window(grib, Grid)
+    assert u_w.size < u.size / 50
+    assert lat_w.min() <= Grid.point_latitude['data'].min()
+    assert lat_w.max() >= Grid.point_latitude['data'].max()
+    assert lon_w.min() <= Grid.point_longitude['data'].min()
+    assert lon_w.max() >= Grid.point_longitude['data'].max()
+    np.testing.assert_allclose(u_w, -v_w)
+    np.testing.assert_allclose(
+        (u_w - lat_w).reshape((6, -1)),
+        np.broadcast_to(gh[:, :1, 0] / 1000., (6, u_w.size // 6)))
+    assert np.all(np.diff(height.reshape((6, -1)), axis=0) > 0)
+
+
+def test_add_model_constraint(tmpdir):
+    """ Winds from a lazily loaded xarray Dataset should be interpolated
+        at the closest time, for both 1D and 2D latitudes and longitudes """
+    import xarray as xr
+    lat = np.arange(40., 33., -0.25)
+    lon = np.arange(258., 266., 0.25)
+    times = np.array(['1999-12-31T18:00', '2000-01-01T00:00',
+                      '2000-01-01T06:00'], dtype='datetime64[ns]')
+    height = np.broadcast_to(
+        np.linspace(0., 12000., 5)[np.newaxis, :, np.newaxis, np.newaxis],
+        (3, 5, len(lat), len(lon)))
+    u = np.broadcast_to(
+        10. * np.arange(3)[:, np.newaxis, np.newaxis, np.newaxis] +
+        lat[np.newaxis, np.newaxis, :, np.newaxis], height.shape)
+    dims = ('time', 'level', 'latitude', 'longitude')
+    dataset = xr.Dataset(
+        {'u': (dims, u), 'v': (dims, -u), 'w': (dims, 0. * u),
+         'z': (dims, height)},
+        coords={'time': times, 'latitude': lat, 'longitude': lon})
+    file_name = str(tmpdir.join('model.nc'))
+    dataset.to_netcdf(file_name)
+
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    expected = 10. + Grid.point_latitude['data']
+    Grid1 = pydda.constraints.add_model_constraint(
+        Grid, file_name, 'reanalysis')
+    np.testing.assert_allclose(Grid1.fields['U_reanalysis']['data'],
+                               expected, atol=0.13)
+    np.testing.assert_allclose(Grid1.fields['V_reanalysis']['data'],
+                               -Grid1.fields['U_reanalysis']['data'])
+
+    # A curvilinear model with one time and other variable names
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    dims = ('level', 'y', 'x')
+    dataset = xr.Dataset(
+        {'U': (dims, u[1]), 'V': (dims, -u[1]), 'W': (dims, 0. * u[1]),
+         'gh': (dims, height[1])},
+        coords={'lat': (('y', 'x'), lat2d), 'lon': (('y', 'x'), lon2d)})
+    Grid2 = pydda.constraints.add_model_constraint(
+        Grid, dataset.chunk({'y': 8, 'x': 8}), 'rap', u_name='U',
+        v_name='V', w_name='W', height_name='gh', lat_name='lat',
+        lon_name='lon', method='linear')
+    np.testing.assert_allclose(Grid2.fields['U_rap']['data'], expected,
+                               rtol=1e-6)
+
+
+def test_era_cache(tmpdir):
+    """ ERA requests should be served from cached files that cover them,
+        and concurrent identical requests should download once """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from pydda.constraints.model_cache import _make_era_request
+    downloads = []
+
+    def download(retrieve_dict, file_name):
+        downloads.append(retrieve_dict['date'])
+        time.sleep(0.2)
+        _write_era_file(file_name)
+
+    cache_dir = str(tmpdir.join('era_cache'))
+    cache = pydda.constraints.ERACache(cache_dir, download=download,
+                                       poll_interval=0.05)
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    Grid.add_field('corrected_velocity', {'data': np.zeros((3, 4, 5))})
+    event_grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-90000., 90000.), (-90000., 90000.)))
+    event_request = _make_era_request(
+        event_grid, '1999-12-31/to/2000-01-01', '00/06/12/18')
+    with ThreadPoolExecutor(4) as executor:
+        file_names = list(executor.map(
+            lambda i: cache.get(event_request), range(4)))
+    assert downloads == ['1999-12-31/to/2000-01-01']
+    assert len(set(file_names)) == 1
+
+    # A smaller area and a single time are served from the event's file
+    Grid = pydda.constraints.make_constraint_from_era_interim(
+        Grid, era_cache_dir=cache_dir)
+    assert len(downloads) == 1
+    np.testing.assert_allclose(
+        Grid.fields['U_erainterim']['data'],
+        10. + Grid.point_latitude['data'], atol=0.25)
+    other_request = _make_era_request(Grid, '2000-01-02', '00')
+    assert cache.find(other_request) is None
+
+    # A cache can be filled with files that were downloaded elsewhere
+    file_name = str(tmpdir.join('era.nc'))
+    _write_era_file(file_name)
+    other_cache = pydda.constraints.ERACache(str(tmpdir.join('offline')))
+    cached_file = other_cache.add(file_name)
+    assert other_cache.find(
+        _make_era_request(Grid, '2000-01-01', '00')) == cached_file
+
+
+def test_era_cache_lock(tmpdir):
+    """ A download that takes longer than the lock timeout should not be
+        started twice, and locks of dead processes should be taken over """
+    import json
+    import os
+    import socket
+    import subprocess
+    import sys
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from pydda.constraints.model_cache import _make_era_request
+    downloads = []
+
+    def download(retrieve_dict, file_name):
+        downloads.append(retrieve_dict['date'])
+        time.sleep(0.6)
+        _write_era_file(file_name)
+
+    cache = pydda.constraints.ERACache(
+        str(tmpdir.join('era_cache')), download=download, lock_timeout=0.2,
+        poll_interval=0.05)
+    Grid = pyart.testing.make_empty_grid(
+        (3, 4, 5), ((1000., 8000.), (-20000., 20000.), (-20000., 20000.)))
+    request = _make_era_request(Grid, '2000-01-01', '00')
+    with ThreadPoolExecutor(2) as executor:
+        file_names = list(executor.map(lambda i: cache.get(request),
+                                       range(2)))
+    assert len(downloads) == 1
+    assert len(set(file_names)) == 1
+
+    # A lock left by a process on this host that has exited is stale even
+    # though it was just touched, while a fresh lock from another host is not
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    lock_name = str(tmpdir.join('test.lock'))
+    cache = pydda.constraints.ERACache(str(tmpdir.join('other_cache')),
+                                       lock_timeout=3600.)
+    with open(lock_name, 'w') as the_file:
+        json.dump({'host': socket.gethostname(), 'pid': process.pid},
+                  the_file)
+    assert cache._is_stale(lock_name)
+    with open(lock_name, 'w') as the_file:
+        json.dump({'host': 'elsewhere', 'pid': process.pid}, the_file)
+    assert not cache._is_stale(lock_name)
+    old_time = time.time() - 7200.
+    os.utime(lock_name, (old_time, old_time))
+    assert cache._is_stale(lock_name)
@@ -9,11 +9,40 @@ Created on Thu Jul 26 11:35:43 2018
 import pydda
 import pyart
 import numpy as np
+import pytest
 
 from distributed import Client, LocalCluster
 from copy import deepcopy
 
 
+def _make_two_radar_grids(grid_shape=(10, 20, 20), u=10.0, v=5.0):
+    """ Makes two radar grids observing a uniform wind field """
+    grid_limits = ((0, 5000), (-20000, 20000), (-20000, 20000))
+    radar_locs = [(36.74, -98.3), (36.74, -97.9)]
+    Grids = []
+    for lat, lon in radar_locs:
+        Grid = pyart.testing.make_empty_grid(grid_shape, grid_limits)
+        Grid.radar_latitude['data'] = np.array([lat])
+        Grid.radar_longitude['data'] = np.array([lon])
+        Grid.add_field('reflectivity', {'data': np.ma.zeros(grid_shape),
+                                        '_FillValue': -9999.0})
+        pydda.retrieval.angles.add_azimuth_as_field(
+            Grid, dz_name='reflectivity')
+        pydda.retrieval.angles.add_elevation_as_field(
+            Grid, dz_name='reflectivity')
+        az = np.deg2rad(Grid.fields['AZ']['data'])
+        el = np.deg2rad(Grid.fields['EL']['data'])
+        wt = pydda.cost_functions.calculate_fall_speed(
+            Grid, refl_field='reflectivity')
+        vr = (u*np.sin(az)*np.cos(el) + v*np.cos(az)*np.cos(el) +
+              wt*np.sin(el))
+        Grid.add_field('velocity', {'data': np.ma.array(vr),
+                                    '_FillValue': -9999.0,
+                                    'units': 'm/s'})
+        Grids.append(Grid)
+    return Grids
+
+
 def test_make_updraft_from_convergence_field():
     """ Do we have an updraft in a region of convergence and divergence? """
 
@@ -171,3 +200,486 @@ def test_model_constraint():
     np.testing.assert_allclose(new_grids[0].fields["w"]["data"],
                                Grid0.fields["W_fakemodel"]["data"],
                                atol=1e-2)
+
+
+def test_preprocess_executor():
+    """ Concurrent preprocessing should give the same answer as serial """
+    Grids = _make_two_radar_grids()
+    u_init = np.zeros(Grids[0].fields['velocity']['data'].shape)
+    results = []
+    for executor in [None, 'threads', 'processes']:
+        new_grids = pydda.retrieval.get_dd_wind_field(
+            Grids, u_init, u_init, u_init, Co=1.0, Cm=0.0,
+            vel_name='velocity', refl_field='reflectivity',
+            filt_iterations=0, max_iterations=10,
+            preprocess_executor=executor)
+        results.append(new_grids[0].fields['u']['data'])
+        assert 'AZ' in Grids[1].fields
+        assert 'EL' in Grids[1].fields
+
+    np.testing.assert_allclose(results[0], results[1])
+    np.testing.assert_allclose(results[0], results[2])
+    assert np.mean(results[0]) > 5
+
+
+def test_output_mode():
+    """ The shared and wind only outputs should not copy the input Grids """
+    Grids = _make_two_radar_grids()
+    u_init = np.zeros(Grids[0].fields['velocity']['data'].shape)
+    kwargs = dict(Co=1.0, Cm=0.0, vel_name='velocity',
+                  refl_field='reflectivity', filt_iterations=0,
+                  max_iterations=10)
+    copied = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, output_mode='copy', **kwargs)
+    shared = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, output_mode='shared', **kwargs)
+    wind = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, output_mode='wind', **kwargs)
+
+    assert len(shared) == 2
+    assert len(wind) == 1
+    assert sorted(wind[0].fields.keys()) == ['u', 'v', 'w']
+    for i in range(2):
+        assert shared[i].x is Grids[i].x
+        assert (shared[i].fields['velocity']['data'] is
+                Grids[i].fields['velocity']['data'])
+        assert 'u' not in Grids[i].fields
+        np.testing.assert_allclose(shared[i].fields['u']['data'],
+                                   copied[i].fields['u']['data'])
+    np.testing.assert_allclose(wind[0].fields['w']['data'],
+                               copied[0].fields['w']['data'])
+    np.testing.assert_allclose(wind[0].point_z['data'],
+                               copied[0].point_z['data'])
+
+
+def test_retrieval_result(monkeypatch):
+    """ The diagnostics should not need any extra cost function calls """
+    Grids = _make_two_radar_grids()
+    u_init = np.zeros(Grids[0].fields['velocity']['data'].shape)
+    num_calls = [0]
+    J_function = pydda.retrieval.wind_retrieve.J_function
+
+    def counting_J_function(winds, parameters):
+        num_calls[0] += 1
+        return J_function(winds, parameters)
+
+    monkeypatch.setattr(pydda.retrieval.wind_retrieve, 'J_function',
+                        counting_J_function)
+    progress = []
+    result = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, Co=1.0, Cm=1500.0,
+        vel_name='velocity', refl_field='reflectivity', filt_iterations=1,
+        max_iterations=20, output_cost_functions=True, return_result=True,
+        progress_callback=lambda r: progress.append(r.iterations))
+
+    assert isinstance(result, pydda.retrieval.RetrievalResult)
+    assert len(result.grids) == 2
+    assert 'u' in result.grids[0].fields
+    assert result.function_evaluations == num_calls[0]
+    assert result.iterations > 0
+    assert len(result.cost_history) == result.iterations
+    assert len(result.grad_norm_history) == result.iterations
+    assert result.cost_history[-1]['J'] < result.cost_history[0]['J']
+    assert result.convergence_reason in ['max_iterations', 'w_tolerance']
+    for stage in ['preprocessing', 'solver', 'filter', 'output', 'total']:
+        assert result.timings[stage] >= 0
+    assert progress[-1] == result.iterations
+
+
+def test_on_iteration():
+    """ The intermediate wind fields should be views of one array """
+    Grids = _make_two_radar_grids()
+    u_init = np.zeros(Grids[0].fields['velocity']['data'].shape)
+    states = []
+
+    def on_iteration(state):
+        assert state.u.shape == u_init.shape
+        assert state.u.base is state.w.base
+        states.append((state.iteration, state.stage, np.array(state.u)))
+
+    result = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, Co=1.0, Cm=0.0,
+        vel_name='velocity', refl_field='reflectivity', filt_iterations=1,
+        max_iterations=20, return_result=True, on_iteration=on_iteration,
+        iteration_interval=2)
+
+    assert len(states) == result.iterations // 2
+    assert all([it % 2 == 0 for it, stage, u in states])
+    assert states[0][1] == 'first_pass'
+    assert states[-1][1] == 'filtered'
+    assert np.mean(states[-1][2]) > np.mean(states[0][2])
+
+
+def test_time_budget():
+    """ A retrieval under a time budget should be cut short and say so """
+    Grids = _make_two_radar_grids(grid_shape=(20, 40, 40))
+    u_init = np.random.RandomState(0).random_sample((20, 40, 40))
+    v_init = np.zeros((20, 40, 40))
+    kwargs = dict(Co=1.0, Cm=1500.0, Cx=1e-3, Cy=1e-3, vel_name='velocity',
+                  refl_field='reflectivity', filt_iterations=0,
+                  max_iterations=30, return_result=True)
+    unbudgeted = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, v_init, v_init, **kwargs)
+    result = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, v_init, v_init, time_budget=0.05, **kwargs)
+
+    assert not unbudgeted.deadline_reached
+    assert result.deadline_reached
+    assert not result.converged
+    assert result.convergence_reason == 'time_budget'
+    assert result.iterations < unbudgeted.iterations
+    assert np.all(np.isfinite(result.grids[0].fields['u']['data']))
+
+    result = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, v_init, v_init, Co=1.0, Cm=0.0,
+        vel_name='velocity', refl_field='reflectivity', filt_iterations=0,
+        max_iterations=10000, return_result=True, time_budget=1000.0)
+    assert not result.deadline_reached
+
+
+def test_nested_time_budget(monkeypatch):
+    """ Nests run one at a time should share the time budget so that
+        every nest gets to iterate """
+    from pydda.retrieval import nesting
+    retrieve_tile = nesting._retrieve_tile
+    tile_results = []
+
+    def recording_retrieve_tile(*args, **kwargs):
+        tile_result = retrieve_tile(*args, **kwargs)
+        tile_results.append(tile_result)
+        return tile_result
+
+    monkeypatch.setattr(nesting, '_retrieve_tile', recording_retrieve_tile)
+    Grids = _make_two_radar_grids(grid_shape=(20, 40, 40))
+    u_init = np.random.RandomState(0).random_sample((20, 40, 40))
+    v_init = np.zeros((20, 40, 40))
+    result = pydda.retrieval.get_dd_wind_field_nested(
+        Grids, u_init, v_init, v_init, num_splits=2, time_budget=4.0,
+        Co=1.0, Cm=1500.0, Cx=1e-3, Cy=1e-3, vel_name='velocity',
+        refl_field='reflectivity', filt_iterations=0, max_iterations=10000,
+        return_result=True)
+
+    assert result.deadline_reached
+    assert len(tile_results) == 4
+    assert all([r.iterations > 0 for r in tile_results])
+
+
+def test_nested_retrieval(tmpdir):
+    """ The nested retrieval should agree with the direct retrieval
+        without writing any temporary files """
+    Grids = _make_two_radar_grids(grid_shape=(10, 40, 40))
+    u_init = np.zeros((10, 40, 40))
+    kwargs = dict(Co=1.0, Cm=0.0, vel_name='velocity',
+                  refl_field='reflectivity', filt_iterations=0,
+                  max_iterations=50)
+    direct = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, **kwargs)
+
+    cluster = LocalCluster(n_workers=2, processes=True)
+    client = Client(cluster)
+    with tmpdir.as_cwd():
+        nested = pydda.retrieval.get_dd_wind_field_nested(
+            Grids, u_init, u_init, u_init, client, halo=2, **kwargs)
+        assert len(tmpdir.listdir()) == 0
+    client.close()
+    cluster.close()
+
+    assert nested[0].fields['u']['data'].shape == (10, 40, 40)
+    assert 'velocity' in nested[1].fields
+    assert np.corrcoef(nested[0].fields["u"]["data"].flatten(),
+                       direct[0].fields["u"]["data"].flatten())[0, 1] > 0.9
+
+
+def test_nested_tiles():
+    """ The nests should cover the grid exactly once and their halos
+        should blend back into the original field """
+    from pydda.retrieval.nesting import _get_tiles, _TileStitcher
+    Grids = _make_two_radar_grids(grid_shape=(2, 11, 13))
+    for halo in [0, 2]:
+        tiles = _get_tiles(11, 13, 3, halo)
+        count = np.zeros((11, 13))
+        for outer, inner in tiles:
+            count[inner] += 1
+            assert outer[0].start == max(inner[0].start - halo, 0)
+            assert outer[1].stop == min(inner[1].stop + halo, 13)
+        assert np.all(count == 1)
+
+        field = np.random.rand(2, 11, 13)
+        stitcher = _TileStitcher(field.shape, blend=(halo > 0))
+        for outer, inner in tiles[::-1]:
+            wind_grid = pydda.retrieval.nesting._extract_pyart_grid(
+                Grids[0], outer)
+            for name in ['u', 'v', 'w']:
+                wind_grid.add_field(name, {
+                    'data': field[:, outer[0], outer[1]]},
+                    replace_existing=True)
+            stitcher.add(outer, inner, wind_grid)
+        stitched = stitcher.finish()
+        assert not np.any(np.ma.getmaskarray(stitched['u']['data']))
+        np.testing.assert_allclose(stitched['u']['data'], field)
+
+
+def test_prolongate_field():
+    """ Upsampling the coarse pass should reproduce a linear field and
+        agree with the original grid at the coarse points """
+    from pydda.retrieval.nesting import (_prolongate_field,
+                                         _reduce_pyart_grid_res,
+                                         _block_average)
+    Grid = _make_two_radar_grids(grid_shape=(4, 21, 20))[0]
+    coarse_grid = _reduce_pyart_grid_res(Grid, 3)
+    x = Grid.point_x["data"]
+    y = Grid.point_y["data"]
+    field = 2.0 * x + y
+    fine = _prolongate_field(_block_average(field, 3), coarse_grid, Grid)
+    assert fine.shape == field.shape
+    # Within the centers of the full blocks the linear field is reproduced
+    np.testing.assert_allclose(fine[:, 1:20, 1:17], field[:, 1:20, 1:17])
+
+
+def test_nested_retrieval_executors():
+    """ The nests should give the same answer when run one at a time or
+        on a process pool without dask """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    Grids = _make_two_radar_grids(grid_shape=(10, 40, 40))
+    u_init = np.zeros((10, 40, 40))
+    kwargs = dict(Co=1.0, Cm=0.0, vel_name='velocity',
+                  refl_field='reflectivity', filt_iterations=0,
+                  max_iterations=50, output_mode='wind',
+                  tile_balance='coverage')
+    serial = pydda.retrieval.get_dd_wind_field_nested(
+        Grids, u_init, u_init, u_init, **kwargs)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        pooled = pydda.retrieval.get_dd_wind_field_nested(
+            Grids, u_init, u_init, u_init, executor=executor,
+            blas_threads=1, **kwargs)
+    np.testing.assert_allclose(serial[0].fields['u']['data'],
+                               pooled[0].fields['u']['data'], atol=1e-6)
+
+    # The nests share this process on a thread pool, so the BLAS thread
+    # limit is set once around the whole run
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        threaded = pydda.retrieval.get_dd_wind_field_nested(
+            Grids, u_init, u_init, u_init, executor=executor,
+            blas_threads='auto', num_workers=2, **kwargs)
+    np.testing.assert_allclose(serial[0].fields['u']['data'],
+                               threaded[0].fields['u']['data'], atol=1e-6)
+
+    with pytest.raises(TypeError):
+        pydda.retrieval.get_dd_wind_field_nested(
+            Grids, u_init, u_init, u_init, executor='threads', **kwargs)
+
+
+def test_executor_sizing(caplog):
+    """ The number of workers, the memory per worker and the BLAS threads
+        should follow the size of the executor """
+    import os
+    from concurrent.futures import Executor, ThreadPoolExecutor
+    from pydda.retrieval.nesting import (_get_num_workers,
+                                         _get_worker_memory,
+                                         _get_blas_threads)
+    cpu_count = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert _get_num_workers(executor) == 2
+        assert _get_num_workers(executor, num_workers=3) == 3
+        assert _get_worker_memory(executor) > 0
+        assert _get_blas_threads('auto', executor) == max(cpu_count // 2, 1)
+    assert _get_num_workers(None) == 1
+    assert _get_blas_threads('auto', None) is None
+    assert _get_blas_threads(3, None) == 3
+
+    # Executors that do not say how many workers they have need num_workers
+    assert _get_num_workers(Executor(), num_workers=4) == 4
+    assert 'num_workers' not in caplog.text
+    assert _get_num_workers(Executor()) == cpu_count
+    assert 'num_workers' in caplog.text
+
+
+def test_tile_time_budget(monkeypatch):
+    """ Each nest should be given its share of the seconds left when it
+        starts, and only as many nests as there are workers should be
+        submitted at once """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from pydda.retrieval import nesting
+    budgets = []
+
+    def fake_retrieve_tile(tile_grids, winds, tile_budget, kwargs,
+                           blas_threads=None, fixed_columns=None):
+        budgets.append(tile_budget)
+        time.sleep(0.2)
+        return tile_grids
+
+    monkeypatch.setattr(nesting, '_retrieve_tile', fake_retrieve_tile)
+    tile_args = [(i, None, None) for i in range(3)]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        results = dict(nesting._run_tiles(
+            executor, tile_args, time.time() + 10., {}, None, 1))
+    assert results == {0: 0, 1: 1, 2: 2}
+    # The first nest gets a third of the time, the second half of what is
+    # left after the first, and the last all of what is left
+    for i, budget in enumerate(budgets):
+        share = (10. - 0.2 * i) / (3 - i)
+        assert 0.5 * share < budget <= share + 1e-3
+
+    # With two workers, the first two nests share the first wave
+    assert nesting._get_tile_budget(None, 0, 4, 2) is None
+    deadline = time.time() + 100.
+    assert 49. < nesting._get_tile_budget(deadline, 0, 4, 2) <= 50.
+    assert 49. < nesting._get_tile_budget(deadline, 1, 4, 2) <= 50.
+    assert 99. < nesting._get_tile_budget(deadline, 2, 4, 2) <= 100.
+
+
+def test_coverage_tile_balance():
+    """ Balancing by coverage should give smaller nests where there are
+        more observations while still covering the grid once """
+    from pydda.retrieval.nesting import _get_tiles, _get_column_work
+    Grids = _make_two_radar_grids(grid_shape=(10, 40, 40))
+    for G in Grids:
+        G.fields['velocity']['data'] = np.ma.masked_all((10, 40, 40))
+        G.fields['velocity']['data'][:, :10, :10] = 1.0
+    work = _get_column_work(Grids, 'velocity')
+    assert work[0, 0] == 30
+    assert work[-1, -1] == 10
+
+    area_tiles = _get_tiles(40, 40, 2)
+    tiles = _get_tiles(40, 40, 2, work=work)
+    count = np.zeros((40, 40))
+    for outer, inner in tiles:
+        count[inner] += 1
+    assert np.all(count == 1)
+    area_work = [work[inner].sum() for outer, inner in area_tiles]
+    tile_work = [work[inner].sum() for outer, inner in tiles]
+    assert np.ptp(tile_work) < np.ptp(area_work)
+
+    with pytest.raises(ValueError):
+        pydda.retrieval.get_dd_wind_field_nested(
+            Grids, work, work, work, tile_balance='points')
+
+
+def test_schwarz_iterations():
+    """ The Schwarz iterations should reduce the disagreement between
+        the nests and stay close to the direct retrieval """
+    Grids = _make_two_radar_grids(grid_shape=(10, 40, 40))
+    u_init = np.zeros((10, 40, 40))
+    kwargs = dict(Co=1.0, Cm=1.0, vel_name='velocity',
+                  refl_field='reflectivity', filt_iterations=0,
+                  max_iterations=50, output_mode='wind')
+    direct = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, **kwargs)
+    result = pydda.retrieval.get_dd_wind_field_nested(
+        Grids, u_init, u_init, u_init, halo=3, num_splits=3,
+        schwarz_iterations=3, schwarz_tol=1e-3, return_result=True,
+        **kwargs)
+    assert 1 <= len(result.schwarz_mismatch) <= 3
+    assert result.schwarz_mismatch[-1] <= result.schwarz_mismatch[0]
+    assert np.corrcoef(result.grids[0].fields["u"]["data"].flatten(),
+                       direct[0].fields["u"]["data"].flatten())[0, 1] > 0.9
+
+    with pytest.raises(ValueError):
+        pydda.retrieval.get_dd_wind_field_nested(
+            Grids, u_init, u_init, u_init, halo=0, schwarz_iterations=2,
+            **kwargs)
+
+
+def test_multilevel_nesting():
+    """ Nesting with three levels should agree with the direct retrieval,
+        and the level planner should add levels as memory shrinks """
+    from pydda.retrieval.nesting import (_plan_levels,
+                                         _estimate_retrieval_memory,
+                                         _choose_reduction_factor)
+    Grids = _make_two_radar_grids(grid_shape=(10, 40, 40))
+    u_init = np.zeros((10, 40, 40))
+    kwargs = dict(Co=1.0, Cm=1.0, vel_name='velocity',
+                  refl_field='reflectivity', filt_iterations=0,
+                  max_iterations=50, output_mode='wind')
+    direct = pydda.retrieval.get_dd_wind_field(
+        Grids, u_init, u_init, u_init, **kwargs)
+    nested = pydda.retrieval.get_dd_wind_field_nested(
+        Grids, u_init, u_init, u_init, num_levels=3, num_splits=4,
+        halo=2, **kwargs)
+    assert nested[0].fields['u']['data'].shape == (10, 40, 40)
+    assert (np.abs(nested[0].fields["u"]["data"] - 10.0).mean() <
+            np.abs(direct[0].fields["u"]["data"] - 10.0).mean())
+
+    grid_shape = (40, 2000, 2000)
+    memory = _estimate_retrieval_memory((40, 250, 250), 2)
+    assert _plan_levels(grid_shape, 2, 4, memory * 100) == (2, 2)
+    num_levels, num_splits = _plan_levels(grid_shape, 2, 4, memory)
+    assert num_levels == 4
+    assert num_splits == 8
+
+    # The reduction factor can be chosen along with the levels
+    assert _choose_reduction_factor(grid_shape, 2, 4, memory, 0, {}) in \
+        (2, 3, 4)
+    assert _choose_reduction_factor(grid_shape, 2, 4, memory * 100, 0, {},
+                                    reduction_factors=(3,)) == 3
+    nested = pydda.retrieval.get_dd_wind_field_nested(
+        Grids, u_init, u_init, u_init, num_levels='auto',
+        reduction_factor='auto', max_memory=1e12, num_workers=1, **kwargs)
+    assert nested[0].fields['u']['data'].shape == (10, 40, 40)
+    with pytest.raises(ValueError):
+        pydda.retrieval.get_dd_wind_field_nested(
+            Grids, u_init, u_init, u_init, num_levels=2,
+            reduction_factor='auto', **kwargs)
+
+
+def test_reduce_grid_res():
+    """ Coarsening should average over blocks, leaving out masked points,
+        without changing the original grid """
+    from pydda.retrieval.nesting import _reduce_pyart_grid_res
+    Grid = _make_two_radar_grids(grid_shape=(2, 5, 4))[0]
+    vel = np.ma.masked_all((2, 5, 4))
+    vel[:, 0, 0] = 1.0
+    vel[:, 1, 1] = 3.0
+    vel[:, 4, :] = 5.0
+    Grid.fields['velocity']['data'] = vel
+    x = Grid.x['data'].copy()
+    coarse_grid = _reduce_pyart_grid_res(Grid, 2)
+
+    coarse_vel = coarse_grid.fields['velocity']['data']
+    assert coarse_vel.shape == (2, 3, 2)
+    assert coarse_vel[0, 0, 0] == 2.0
+    assert coarse_vel.mask[0, 0, 1] and coarse_vel.mask[0, 1, 0]
+    assert np.all(coarse_vel[:, 2] == 5.0)
+    np.testing.assert_allclose(np.diff(coarse_grid.x['data']),
+                               2 * np.diff(x)[0])
+    np.testing.assert_allclose(coarse_grid.x['data'][0], x[:2].mean())
+    np.testing.assert_allclose(Grid.x['data'], x)
+    assert Grid.fields['velocity']['data'].shape == (2, 5, 4)
+
+    # Integer fields take the point at the center of each block, or the
+    # last point of a partial block at the edge
+    from pydda.retrieval.nesting import _block_average
+    index = np.arange(2 * 7 * 7).reshape((2, 7, 7))
+    coarse_index = _block_average(index, 3)
+    assert coarse_index.dtype == index.dtype
+    centers = [1, 4, 6]
+    np.testing.assert_array_equal(coarse_index,
+                                  index[:, centers][:, :, centers])
+
+
+def test_plan_retrieval():
+    """ The planner should pick a direct retrieval when it fits in memory
+        and a nested retrieval that fits otherwise """
+    Grids = _make_two_radar_grids(grid_shape=(10, 40, 40))
+    plan = pydda.retrieval.plan_retrieval(Grids, max_memory=1e12,
+                                          num_workers=1)
+    assert plan.method == 'direct'
+    assert plan.feasible
+
+    plan = pydda.retrieval.plan_retrieval(Grids, max_memory=5e6,
+                                          num_workers=4, max_iterations=50,
+                                          filt_iterations=0)
+    assert plan.method == 'nested'
+    assert plan.feasible
+    assert plan.estimated_memory <= 5e6
+
+    u_init = np.zeros((10, 40, 40))
+    new_grids = plan.execute(
+        Grids, u_init, u_init, u_init, Co=1.0, Cm=1.0, vel_name='velocity',
+        refl_field='reflectivity', filt_iterations=0, max_iterations=50,
+        output_mode='wind')
+    assert new_grids[0].fields['u']['data'].shape == (10, 40, 40)
+
+    plan = pydda.retrieval.plan_retrieval(Grids, max_memory=1e3)
+    assert not plan.feasible